@@ -44,11 +44,121 @@ class CollectionNode(BaseModel):
 
 CollectionNode.model_rebuild()
 
+
+def _sources(source) -> list[str]:
+    return [] if source is None else [source] if isinstance(source, str) else list(source)
+
+
+def _resolve_source(source, parent, paths, siblings, names):
+    """Resolve the `source` of a node in the collection node at `parent`: as a path,
+    then as the name of a sibling, then as the name of the only node with this name.
+
+    Args:
+        paths: Paths of all multiscale nodes.
+        siblings: Dict {(parent path, name): path}.
+        names: Dict {name: [path, ...]}.
+    Returns:
+        The path of the source node, or None, and the number of nodes with this name.
+    """
+    if source in paths:
+        return source, 1
+    sibling = siblings.get((parent, source))
+    if sibling is not None:
+        return sibling, 1
+    candidates = names.get(source, ())
+    return (candidates[0] if len(candidates) == 1 else None), len(candidates)
+
+
+def _collection_errors(entries) -> list[str]:
+    """Check a collection as a whole and return all errors found.
+
+    Paths must be unique and every `source` must name an existing node, which
+    is looked up as a path, then by name among the siblings, then by name in
+    the whole collection, where it must be unique. The source graph must not
+    have cycles. Every node is indexed once, without recursion.
+
+    Args:
+        entries: Iterable of (path, parent path, name, sources) for all nodes of the
+            collection, with sources None for collection nodes.
+    Returns:
+        The list of error messages, empty for a valid collection.
+    """
+    errors = []
+    paths = set()
+    parents = {}  # path of a multiscale node -> path of its parent collection
+    names = {}  # name -> paths of the multiscale nodes with this name
+    siblings = {}  # (parent path, name) -> path
+    edges = {}  # path of a multiscale node -> its (unresolved) sources
+
+    for path, parent, name, sources in entries:
+        if path in paths:
+            errors.append(f"Duplicate path '{path}'")
+            continue
+        paths.add(path)
+        if sources is not None:
+            parents[path] = parent
+            names.setdefault(name, []).append(path)
+            siblings[(parent, name)] = path
+            edges[path] = sources
+
+    def resolve(path, source):
+        resolved, n_candidates = _resolve_source(source, parents[path], parents, siblings, names)
+        if resolved is None and n_candidates:
+            errors.append(f"Node '{path}': source '{source}' is ambiguous, it matches {n_candidates} nodes")
+        elif resolved is None:
+            errors.append(f"Node '{path}': source '{source}' does not exist")
+        return resolved
+
+    for path, sources in edges.items():
+        edges[path] = [resolved for src in sources if (resolved := resolve(path, src)) is not None]
+
+    # Kahn's algorithm, the nodes that are never freed are on or behind a cycle.
+    n_sources = {path: len(sources) for path, sources in edges.items()}
+    derived = {}
+    for path, sources in edges.items():
+        for src in sources:
+            derived.setdefault(src, []).append(path)
+    queue = [path for path, n in n_sources.items() if n == 0]
+    while queue:
+        for child in derived.get(queue.pop(), ()):
+            n_sources[child] -= 1
+            if n_sources[child] == 0:
+                queue.append(child)
+    cyclic = sorted(path for path, n in n_sources.items() if n > 0)
+    if cyclic:
+        errors.append(f"The sources of these nodes form or depend on a cycle: {', '.join(cyclic)}")
+    return errors
+
+
 class OMECollection(BaseModel):
     version: str = "0.x"
     type: Literal["collection"] = "collection"
     name: str
     nodes: list[Union[CollectionNode, MultiscaleNode]]
 
+    def collection_errors(self) -> list[str]:
+        """Check the collection as a whole and return all errors found, see `_collection_errors`."""
+        def entries():
+            stack = [(self.nodes, "")]
+            while stack:
+                nodes, prefix = stack.pop()
+                for node in nodes:
+                    path = f"{prefix}/{node.name}" if prefix else node.name
+                    if isinstance(node, CollectionNode):
+                        stack.append((node.nodes, path))
+                        yield path, prefix, node.name, None
+                    else:
+                        yield path, prefix, node.name, _sources(node.attributes.source)
+
+        return _collection_errors(entries())
+
+    def validate_collection(self):
+        """Raise a ValueError listing all errors found by `collection_errors`."""
+        errors = self.collection_errors()
+        if errors:
+            raise ValueError(
+                f"Collection '{self.name}' is invalid ({len(errors)} errors):\n" + "\n".join(errors)
+            )
+
 class OMEWrapper(BaseModel):
     ome: OMECollection
\ No newline at end of file
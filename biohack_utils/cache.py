@@ -0,0 +1,86 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+
+class CollectionCache:
+    """Size-bounded LRU cache with a time-to-live for collection lookups.
+
+    Every entry is tagged with the image IDs and collection annotation IDs it
+    was derived from, so that writes can drop exactly the affected entries.
+
+    Args:
+        maxsize: Maximal number of cached entries.
+        ttl: Time in seconds after which an entry expires. None for no expiry.
+    """
+    def __init__(self, maxsize=1024, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expiry time, value, tags)
+        self._keys_by_tag = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """Returns a tuple (hit, value). The value is a copy of the cached one."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, copy.deepcopy(entry[1])
+
+    def store(self, key, value, image_ids=(), collection_ids=()):
+        tags = {("image", iid) for iid in image_ids} | {("collection", cid) for cid in collection_ids}
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expiry, copy.deepcopy(value), tags)
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, image_ids=(), collection_ids=()):
+        """Drop all entries derived from any of the given images or collections."""
+        tags = [("image", iid) for iid in image_ids] + [("collection", cid) for cid in collection_ids]
+        with self._lock:
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_tag.clear()
+
+    def stats(self):
+        """Hit/miss counters and current size, e.g. to choose `maxsize`."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
@@ -1,14 +1,34 @@
+import gc
+import json
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+from pydantic import TypeAdapter
+
 from biohack_utils.ConfigSchema import OMECollection, OMEWrapper, CollectionNode, NodeAttributes, MultiscaleNode
 from omero.rtypes import rstring
-from omero.model import MapAnnotationI, NamedValue
-import omero.sys
-from biohack_utils.omero_annotation import _create_collection, _link_collection_to_image, _add_node_annotation, _build_image_url, _append_link_to_node_annotation 
+from omero.model import ImageAnnotationLinkI, ImageI, MapAnnotationI, NamedValue
+from biohack_utils.queries import _annotation_links, _chunks, _map_annotations_by_id, _map_values_by_collection
+from biohack_utils.omero_annotation import _invalidate_cache, _create_collection, _link_collection_to_image, _add_node_annotation, _build_image_url, _append_links_to_node_annotations
 
 NS_COLLECTION = "ome/collection"
 NS_NODE = "ome/collection/nodes"
 
-def flatten(wrapper: OMEWrapper) -> list[dict]:
-    """Convert nested JSON to flat list with paths."""
+# Validators and serializers for many nodes at once, used by the fast flatten and unflatten.
+_NODE_ATTRIBUTES = TypeAdapter(list[NodeAttributes])
+_MULTISCALE_NODES = TypeAdapter(list[MultiscaleNode])
+
+
+def flatten(wrapper: OMEWrapper, fast: bool = False) -> list[dict]:
+    """Convert nested JSON to flat list with paths.
+
+    With `fast=True` the tree is traversed iteratively and the attributes of all
+    nodes are serialized in one batch, which gives the same records much faster
+    for large trees.
+    """
+    if fast:
+        return _flatten_fast(wrapper)
     result = []
     
     def traverse(nodes, prefix=""):
@@ -26,8 +46,15 @@ def flatten(wrapper: OMEWrapper) -> list[dict]:
     return result
 
 
-def unflatten(flat_records: list[dict], name: str, version: str = "0.x") -> OMEWrapper:
-    """Convert flat list back to nested JSON."""
+def unflatten(flat_records: list[dict], name: str, version: str = "0.x", fast: bool = False) -> OMEWrapper:
+    """Convert flat list back to nested JSON.
+
+    With `fast=True` the tree is built in a single pass over the records bucketed
+    by depth, with all multiscale nodes validated in one batch. The result is
+    identical, it is only faster for large collections.
+    """
+    if fast:
+        return _unflatten_fast(flat_records, name, version)
     collections = {}
     root_nodes = []
     
@@ -61,21 +88,198 @@ def unflatten(flat_records: list[dict], name: str, version: str = "0.x") -> OMEW
     return OMEWrapper(ome=OMECollection(version=version, name=name, nodes=root_nodes))
 
 
-def upload(conn, wrapper: OMEWrapper) -> int:
-    """Upload collection to OMERO. Returns collection_id."""
+@contextmanager
+def _gc_paused():
+    """Pause the cyclic garbage collector, which otherwise runs over and over
+    while a large tree of models is built, without finding anything to collect.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
 
-    
-    # Create collection annotation
+
+def _flatten_fast(wrapper: OMEWrapper) -> list[dict]:
+    """Iterative version of `flatten`, serializing all node attributes in one batch."""
+    names, paths, attributes = [], [], []
+    with _gc_paused():
+        # Stack of (nodes, index of the next node, path prefix).
+        stack = [(wrapper.ome.nodes, 0, "")]
+        while stack:
+            nodes, i, prefix = stack.pop()
+            while i < len(nodes):
+                node = nodes[i]
+                i += 1
+                path = f"{prefix}/{node.name}" if prefix else node.name
+                if isinstance(node, CollectionNode):
+                    stack.append((nodes, i, prefix))
+                    nodes, i, prefix = node.nodes, 0, path
+                else:
+                    names.append(node.name)
+                    paths.append(path)
+                    attributes.append(node.attributes)
+
+        dumped = _NODE_ATTRIBUTES.dump_python(attributes, by_alias=True, exclude_none=True)
+        result = []
+        for name, path, attrs in zip(names, paths, dumped):
+            record = {'name': name, 'path': path}
+            record.update(attrs)
+            result.append(record)
+    return result
+
+
+def _unflatten_fast(flat_records: list[dict], name: str, version: str = "0.x") -> OMEWrapper:
+    """Single-pass version of `unflatten`, building the collection nodes in a path trie."""
+    # Bucketing by depth keeps the (stable) order of sorting by depth.
+    buckets = {}
+    for record in flat_records:
+        parts = record['path'].split('/')
+        buckets.setdefault(len(parts), []).append((parts, record))
+    ordered = [item for depth in sorted(buckets) for item in buckets[depth]]
+
+    with _gc_paused():
+        # All nodes are validated in one call instead of one model at a time.
+        items = []
+        for parts, record in ordered:
+            attrs = record.copy()
+            del attrs['path']
+            items.append({'name': attrs.pop('name', parts[-1]), 'attributes': attrs})
+        nodes = _MULTISCALE_NODES.validate_python(items)
+
+        root_nodes = []
+        # Trie of the collection nodes: {part: (CollectionNode, children)}.
+        root = {}
+        for (parts, _), node in zip(ordered, nodes):
+            siblings, children = root_nodes, root
+            for part in parts[:-1]:
+                entry = children.get(part)
+                if entry is None:
+                    entry = children[part] = (CollectionNode(name=part, nodes=[]), {})
+                    siblings.append(entry[0])
+                siblings, children = entry[0].nodes, entry[1]
+            siblings.append(node)
+
+    # The nodes are already validated, only the collection metadata is.
+    collection = OMECollection(version=version, name=name, nodes=[])
+    collection.nodes = root_nodes
+    return OMEWrapper(ome=collection)
+
+
+def _batched(iterable, size):
+    """Yield lists of at most `size` items from an iterable."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _node_kv(record: dict, coll_id: int) -> dict:
+    """Key-value pairs of the node annotation for a flat record.
+
+    Lists are joined with commas and nested attributes are stored as JSON, see `_node_kv_to_record`.
+    """
+    node_kv = {'path': record['path'], 'collection_id': str(coll_id)}
+    for key, val in record.items():
+        if key not in ('path', 'omero:image_id'):
+            if isinstance(val, list):
+                val = ','.join(str(v) for v in val)
+            elif isinstance(val, dict):
+                val = json.dumps(val)
+            node_kv[key] = str(val)
+    return node_kv
+
+
+def _image_link(image_id: int, ann) -> ImageAnnotationLinkI:
+    link = ImageAnnotationLinkI()
+    link.setParent(ImageI(image_id, False))
+    link.setChild(ann)
+    return link
+
+
+def _upload_batches(conn, coll_id: int, records, batch_size: int = 1000, linked_images=None):
+    """Create the node annotations for flat records and link them, together with
+    the collection annotation, to their images.
+
+    The annotations and links are built locally and saved with one
+    `saveAndReturnArray` call per batch of records. Images in `linked_images`
+    (a set, updated in place) are already linked to the collection.
+    Yields the records and the node annotation IDs of every saved batch.
+    """
+    update_service = conn.getUpdateService()
+    coll_ann = MapAnnotationI(coll_id, False)
+    linked_images = set() if linked_images is None else linked_images
+
+    for i, batch in enumerate(_batched(records, batch_size)):
+        start = time.perf_counter()
+
+        coll_links, node_links = [], []
+        for record in batch:
+            image_id = int(record['omero:image_id'])
+            if image_id not in linked_images:
+                coll_links.append(_image_link(image_id, coll_ann))
+                linked_images.add(image_id)
+
+            node_ann = MapAnnotationI()
+            node_ann.setNs(rstring(NS_NODE))
+            node_ann.setMapValue([NamedValue(k, v) for k, v in _node_kv(record, coll_id).items()])
+            node_links.append(_image_link(image_id, node_ann))
+
+        # The new node annotations are saved together with their links.
+        saved = update_service.saveAndReturnArray(coll_links + node_links, conn.SERVICE_OPTS)
+        node_ids = [link.getChild().getId().getValue() for link in saved[len(coll_links):]]
+        print(
+            f"Batch {i}: saved {len(node_links)} nodes and {len(coll_links)} collection links "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+        yield batch, node_ids
+
+
+def _upload_records_bulk(conn, coll_id: int, records, batch_size: int = 1000, linked_images=None) -> list[int]:
+    """Upload flat records with `_upload_batches`. Returns the node annotation IDs."""
+    linked_images = set() if linked_images is None else set(linked_images)
+    return [
+        node_id
+        for _, node_ids in _upload_batches(conn, coll_id, records, batch_size, linked_images)
+        for node_id in node_ids
+    ]
+
+
+def _create_collection_annotation(conn, name: str, version: str) -> int:
+    """Save a (not yet linked) collection annotation. Returns its ID."""
     coll_ann = MapAnnotationI()
     coll_ann.setNs(rstring(NS_COLLECTION))
     coll_ann.setMapValue([
-        NamedValue("version", wrapper.ome.version),
-        NamedValue("name", wrapper.ome.name)
+        NamedValue("version", version),
+        NamedValue("name", name)
     ])
-    coll_id = conn.getUpdateService().saveAndReturnObject(coll_ann).getId().getValue()
+    return conn.getUpdateService().saveAndReturnObject(coll_ann).getId().getValue()
+
+
+def upload(conn, wrapper: OMEWrapper, bulk: bool = False, batch_size: int = 1000) -> int:
+    """Upload collection to OMERO. Returns collection_id.
+
+    The collection is validated as a whole before anything is uploaded.
+
+    With `bulk=True` all node annotations and image links are saved in batches
+    of `batch_size` nodes instead of about six round trips per node.
+    """
+
+    
+    wrapper.ome.validate_collection()
+
+    # Create collection annotation
+    coll_id = _create_collection_annotation(conn, wrapper.ome.name, wrapper.ome.version)
+    records = flatten(wrapper)
+
+    if bulk:
+        _upload_records_bulk(conn, coll_id, records, batch_size)
+        _invalidate_cache(image_ids={r['omero:image_id'] for r in records}, collection_ids=[coll_id])
+        return coll_id
     
     # Process each node
-    for record in flatten(wrapper):
+    for record in records:
         image_id = record['omero:image_id']
         image = conn.getObject("Image", image_id)
         
@@ -83,12 +287,7 @@ def upload(conn, wrapper: OMEWrapper) -> int:
         image.linkAnnotation(conn.getObject("MapAnnotation", coll_id))
         
         # Create node annotation
-        node_kv = {'path': record['path'], 'collection_id': str(coll_id)}
-        for key, val in record.items():
-            if key not in ('path', 'omero:image_id'):
-                if isinstance(val, list):
-                    val = ','.join(str(v) for v in val)
-                node_kv[key] = str(val)
+        node_kv = _node_kv(record, coll_id)
         
         node_ann = MapAnnotationI()
         node_ann.setNs(rstring(NS_NODE))
@@ -96,12 +295,132 @@ def upload(conn, wrapper: OMEWrapper) -> int:
         node_id = conn.getUpdateService().saveAndReturnObject(node_ann).getId().getValue()
         image.linkAnnotation(conn.getObject("MapAnnotation", node_id))
     
+    _invalidate_cache(image_ids={r['omero:image_id'] for r in records}, collection_ids=[coll_id])
     return coll_id
 
 
-#Some issue with the python API requires us to use a query here
+# Node annotation keys written from the schema. Other keys, e.g. the `attributes.link`
+# appended by `_append_links_to_node_annotations`, are kept by `sync`.
+_NODE_KEYS = {'path', 'name', 'collection_id'} | {
+    field.alias or name for name, field in NodeAttributes.model_fields.items()
+}
+
+
+def sync(conn, wrapper: OMEWrapper, collection_id: int, batch_size: int = 1000) -> dict:
+    """Update an existing collection in OMERO to match `wrapper`.
+
+    The nodes on the server are fetched with one paged query and compared by path
+    with the nodes of the wrapper. Only new nodes are created, changed node
+    annotations are updated in place and nodes missing from the wrapper are deleted,
+    so the number of server calls grows with the size of the diff and not of the
+    collection. Nodes that moved to another image are replaced. Keys of the node
+    annotations that are not part of the schema are kept. New annotations are
+    created before the stale ones are deleted, so a failed upload does not lose nodes.
+
+    Returns a dict with the number of created, updated, moved, removed and unchanged nodes.
+    """
+    wrapper.ome.validate_collection()
+    update_service = conn.getUpdateService()
+    server = {}
+    stale = []
+    for ann_id, (image_id, node_data) in _map_values_by_collection(conn, collection_id, NS_NODE).items():
+        # Nodes are keyed by path, or by name for older nodes without one, like in `ProvenanceGraph`.
+        # Only the first annotation per key is kept, like in `download`.
+        key = node_data.get('path') or node_data.get('name')
+        if key in server:
+            stale.append(ann_id)
+        else:
+            server[key] = (ann_id, image_id, node_data)
+
+    records = flatten(wrapper)
+    created, moved, updated = [], [], {}
+    for record in records:
+        node_kv = _node_kv(record, collection_id)
+        image_id = int(record['omero:image_id'])
+        ann_id, server_image_id, node_data = server.pop(record['path'], (None, None, None))
+        if ann_id is None:
+            created.append(record)
+            continue
+        extra = {k: v for k, v in node_data.items() if k not in _NODE_KEYS}
+        node_kv = {**extra, **node_kv}
+        if server_image_id != image_id:
+            stale.append(ann_id)
+            moved.append({**extra, **record})
+        elif node_data != node_kv:
+            updated[ann_id] = node_kv
+    removed = len(stale) - len(moved)
+    stale.extend(ann_id for ann_id, _, _ in server.values())
+    removed += len(server)
+
+    anns = _map_annotations_by_id(conn, list(updated) + [collection_id])
+    if collection_id not in anns:
+        raise ValueError(f"Collection annotation {collection_id} not found")
+    # Other keys of the collection annotation, e.g. its type, are kept.
+    server_coll_kv = {nv.name: nv.value for nv in anns[collection_id].getMapValue() or []}
+    coll_kv = {**server_coll_kv, "version": wrapper.ome.version, "name": wrapper.ome.name}
+    if server_coll_kv != coll_kv:
+        updated[collection_id] = coll_kv
+    for batch in _batched(updated.items(), batch_size):
+        for ann_id, kv in batch:
+            anns[ann_id].setMapValue([NamedValue(k, v) for k, v in kv.items()])
+        update_service.saveArray([anns[ann_id] for ann_id, _ in batch], conn.SERVICE_OPTS)
+
+    # The replacements are created first, so stale nodes are only deleted once they exist.
+    links = _annotation_links(conn, collection_id)
+    _upload_records_bulk(conn, collection_id, created + moved, batch_size, linked_images=links)
+
+    for chunk in _chunks(stale, batch_size):
+        conn.deleteObjects("Annotation", chunk, wait=True)
+
+    # Images that are not part of the collection anymore are unlinked from it.
+    member_ids = {int(record['omero:image_id']) for record in records}
+    unlinked = [link_id for image_id, link_id in links.items() if image_id not in member_ids]
+    for chunk in _chunks(unlinked, batch_size):
+        conn.deleteObjects("ImageAnnotationLink", chunk, wait=True)
+
+    _invalidate_cache(image_ids=member_ids | set(links), collection_ids=[collection_id])
+
+    summary = {
+        "created": len(created),
+        "updated": len(updated) - (collection_id in updated),
+        "moved": len(moved),
+        "removed": removed,
+        "unchanged": len(records) - len(created) - len(moved) - len(updated) + (collection_id in updated),
+    }
+    print(
+        f"Synced collection {collection_id}: created {summary['created']}, updated {summary['updated']}, "
+        f"moved {summary['moved']}, removed {summary['removed']} nodes, {summary['unchanged']} unchanged"
+    )
+    return summary
+
+
+def _json_attribute(val: str):
+    """Nested attribute stored as JSON by `_node_kv`, or the string itself if it is not JSON."""
+    try:
+        return json.loads(val)
+    except json.JSONDecodeError:
+        return val.split(',') if ',' in val else val
+
+
+def _node_kv_to_record(image_id: int, node_data: dict) -> dict:
+    """Flat record for the key-value pairs of a node annotation."""
+    record = {'omero:image_id': image_id, 'path': node_data['path']}
+    for key, val in node_data.items():
+        if key not in ('path', 'collection_id'):
+            if val.startswith('{'):
+                record[key] = _json_attribute(val)
+            elif ',' in val:
+                record[key] = val.split(',')
+            else:
+                record[key] = val
+    return record
+
+
 def download(conn, collection_id: int) -> OMEWrapper:
-    """Download collection from OMERO."""
+    """Download collection from OMERO.
+
+    All node annotations of the collection are fetched with one paged query.
+    """
     
     # Get collection metadata
     coll_ann = conn.getObject("MapAnnotation", collection_id)
@@ -110,64 +429,18 @@ def download(conn, collection_id: int) -> OMEWrapper:
     
     coll_data = {kv.name: kv.value for kv in coll_ann.getMapValue()}
     
-    # Get all images with this collection
-    images = list(conn.getObjectsByAnnotations("Image", [collection_id]))
+    node_anns = _map_values_by_collection(conn, collection_id, NS_NODE)
     
     flat_records = []
-    for img in images:
-        image_id = img.getId()
-        print(f"\nProcessing image {image_id}")
-        
-        # Force reload of annotations by getting a fresh image object
-        fresh_img = conn.getObject("Image", image_id)
-        
-        # Try getting MapAnnotations specifically with the node namespace
-        params = omero.sys.ParametersI()
-        params.addId(image_id)
-        
-        query = """
-            SELECT ann FROM ImageAnnotationLink link
-            JOIN link.child ann
-            JOIN link.parent img
-            WHERE img.id = :id
-            AND ann.class = MapAnnotation
-            AND ann.ns = :ns
-        """
-        
-        params.addString("ns", NS_NODE)
-        
-        query_service = conn.getQueryService()
-        results = query_service.findAllByQuery(query, params, conn.SERVICE_OPTS)
-        
-        print(f"  Found {len(results)} node annotations via query")
-        
-        for ann_obj in results:
-            # Wrap in gateway object for easier handling
-            ann = conn.getObject("MapAnnotation", ann_obj.getId().getValue())
-            
-            node_data = {kv.name: kv.value for kv in ann.getMapValue()}
-            
-            # Verify this node belongs to our collection
-            if node_data.get('collection_id') != str(collection_id):
-                continue
-            
-            print(f"  ✓ Match found!")
-            
-            # Build record
-            record = {'omero:image_id': image_id, 'path': node_data['path']}
-            
-            # Extract attributes
-            for key, val in node_data.items():
-                if key not in ('path', 'collection_id'):
-                    if ',' in val:
-                        record[key] = val.split(',')
-                    else:
-                        record[key] = val
-            
-            flat_records.append(record)
-            break  # Only process first matching annotation per image
+    seen_images = set()
+    for image_id, node_data in node_anns.values():
+        # Only use the first matching annotation per image
+        if image_id in seen_images:
+            continue
+        seen_images.add(image_id)
+        flat_records.append(_node_kv_to_record(image_id, node_data))
     
-    print(f"\nTotal flat records collected: {len(flat_records)}")
+    print(f"Total flat records collected: {len(flat_records)}")
     
     if not flat_records:
         raise ValueError(f"No node annotations found for collection {collection_id}")
@@ -217,7 +490,7 @@ def write_annotations_to_image_and_labels(conn, image_id, label_id):
     )
     
     # Build pseudo-network by linking all images
+    # Every node links to all images of the collection, the links are written in a single call.
     all_image_ids = image_id + [label_id]
-    for iid in all_image_ids:
-        link = _build_image_url(iid)
-        _append_link_to_node_annotation(conn, iid, link)
\ No newline at end of file
+    links = [_build_image_url(iid) for iid in all_image_ids]
+    _append_links_to_node_annotations(conn, {iid: links for iid in all_image_ids}, ann_id)
\ No newline at end of file
@@ -1,3 +1,5 @@
+from .omero_annotation import NS_COLLECTION, NS_NODE, _invalidate_cache
+from .queries import _chunks, _dataset_images, _images_by_annotation, _map_values_by_collections, _map_values_by_image
 from .util import connect_to_omero, omero_credential_parser
 
 
@@ -16,15 +18,92 @@ def delete_annotations(conn, image_id, ns):
     conn.deleteObjects("Annotation", fanns, wait=True)
 
 
+def delete_collections(
+    conn, collection_ids=None, image_ids=None, dataset_id=None, delete_images=False, dry_run=False, batch_size=1000,
+):
+    """Delete whole collections: the collection annotations and all their node annotations.
+
+    The collections are given directly, or are all collections of the given images or
+    of the images in a dataset. Everything to delete is resolved with a few bulk queries
+    and deleted with one `deleteObjects` call per batch.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        collection_ids: IDs of the collection annotations.
+        image_ids: Delete the collections these images are part of.
+        dataset_id: Delete the collections of the images in this dataset.
+        delete_images: Also delete the derived images (nodes of category "annotations", e.g. masks).
+        dry_run: Only print and return what would be deleted.
+        batch_size: Number of objects per `deleteObjects` call.
+    Returns:
+        A dict with the IDs of the collections, node annotations, member images and deleted images.
+    """
+    coll_ids = set(collection_ids or [])
+    if dataset_id is not None:
+        image_ids = list(image_ids or []) + _dataset_images(conn, dataset_id)
+    if image_ids:
+        for anns in _map_values_by_image(conn, image_ids, NS_COLLECTION).values():
+            coll_ids.update(anns)
+    coll_ids = sorted(coll_ids)
+
+    members = _images_by_annotation(conn, coll_ids)
+    node_ids, derived_ids = set(), set()
+    for ann_id, (image_id, kv) in _map_values_by_collections(conn, coll_ids, NS_NODE).items():
+        node_ids.add(ann_id)
+        if kv.get("category") == "annotations":
+            derived_ids.add(image_id)
+
+    summary = {
+        "collections": coll_ids,
+        "node_annotations": sorted(node_ids),
+        "members": sorted({mid for mids in members.values() for mid in mids}),
+        "images": sorted(derived_ids) if delete_images else [],
+    }
+    print(
+        f"{'Would delete' if dry_run else 'Deleting'} {len(coll_ids)} collections with "
+        f"{len(summary['node_annotations'])} node annotations of {len(summary['members'])} images"
+        + (f", and {len(summary['images'])} derived images" if delete_images else "")
+    )
+    if dry_run:
+        return summary
+
+    for chunk in _chunks(coll_ids + summary["node_annotations"], batch_size):
+        conn.deleteObjects("Annotation", chunk, wait=True)
+    for chunk in _chunks(summary["images"], batch_size):
+        conn.deleteObjects("Image", chunk, deleteAnns=True, wait=True)
+    _invalidate_cache(image_ids=summary["members"], collection_ids=coll_ids)
+    return summary
+
+
 def main():
     parser = omero_credential_parser()
+    parser.add_argument(
+        "--collection_id", type=int, nargs="+", default=None,
+        help="Delete these collections with all their node annotations.",
+    )
+    parser.add_argument(
+        "--image_ids", type=int, nargs="+", default=None, help="Delete all collections of these images."
+    )
+    parser.add_argument(
+        "--dataset_id", type=int, default=None, help="Delete all collections of the images in this dataset."
+    )
+    parser.add_argument(
+        "--delete_images", action="store_true", help="Also delete the derived images (e.g. masks) of the collections."
+    )
+    parser.add_argument("--dry_run", action="store_true", help="Only print what would be deleted.")
     args = parser.parse_args()
 
     conn = connect_to_omero(args)
 
-    try:
-        delete_annotations(conn, args.image_id, args.namespace)
-    except AttributeError:
-        print("Well, seems like there were no matching collection metadata.")
+    if args.collection_id or args.image_ids or args.dataset_id is not None:
+        delete_collections(
+            conn, collection_ids=args.collection_id, image_ids=args.image_ids, dataset_id=args.dataset_id,
+            delete_images=args.delete_images, dry_run=args.dry_run,
+        )
+    else:
+        try:
+            delete_annotations(conn, args.image_id, args.namespace)
+        except AttributeError:
+            print("Well, seems like there were no matching collection metadata.")
 
     conn.close()
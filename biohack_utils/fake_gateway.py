@@ -0,0 +1,477 @@
+"""In-memory stand-in for the parts of BlitzGateway used by biohack_utils.
+
+Meant for benchmarks and development without an OMERO server. Every server
+call is counted per method and can be delayed by a fixed latency to emulate
+the round trip to a remote server. Only the HQL queries defined in
+`biohack_utils.queries` are understood by the query service.
+"""
+import time
+from collections import Counter, defaultdict
+
+from omero.model import AnnotationAnnotationLinkI, ImageAnnotationLinkI, ImageI, MapAnnotationI, NamedValue
+from omero.rtypes import rlong, rstring, unwrap, wrap
+
+from biohack_utils import queries
+
+
+class FakeGateway:
+    """Fake BlitzGateway backed by dicts.
+
+    Args:
+        latency: Time in seconds added to every server call.
+    """
+    SERVICE_OPTS = None
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.images = {}  # image id -> {"name": ..., "dataset_id": ...}
+        self.datasets = {}  # dataset id -> {"name": ..., "image_ids": [...]}
+        self.annotations = {}  # annotation id -> {"ns": ..., "values": [(key, value), ...]}
+        self.files = {}  # file annotation id -> bytes, file annotations are stored without values
+        self.links = {}  # link id -> (image id, annotation id)
+        self.annotation_links = {}  # link id -> (parent annotation id, child annotation id)
+        self.events = {}  # annotation or link id -> id of the event that last created or updated it
+        self._event = 0
+        self._anns_by_image = defaultdict(dict)  # image id -> {annotation id: link id}
+        self._images_by_ann = defaultdict(dict)  # annotation id -> {image id: link id}
+        self._next_id = 1
+        self._query_service = _FakeQueryService(self)
+        self._update_service = _FakeUpdateService(self)
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    def reset_counters(self):
+        self.calls.clear()
+
+    @property
+    def _version(self):
+        # Changes whenever the stored objects change, used to reuse query results between pages.
+        return (
+            self._next_id, self._event, len(self.links), len(self.annotation_links), len(self.annotations), len(self.images)
+        )
+
+    def _call(self, method):
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id - 1
+
+    def _touch(self, oid):
+        self._event += 1
+        self.events[oid] = self._event
+
+    #
+    # Setup helpers, these are not counted as server calls.
+    #
+
+    def add_dataset(self, name="dataset"):
+        dataset_id = self._new_id()
+        self.datasets[dataset_id] = {"name": name, "image_ids": []}
+        return dataset_id
+
+    def add_image(self, name="image", dataset_id=None):
+        image_id = self._new_id()
+        self.images[image_id] = {"name": name, "dataset_id": dataset_id}
+        if dataset_id is not None:
+            self.datasets[dataset_id]["image_ids"].append(image_id)
+        return image_id
+
+    def add_map_annotation(self, ns, kv):
+        ann_id = self._new_id()
+        self.annotations[ann_id] = {"ns": ns, "values": [(str(k), str(v)) for k, v in kv.items()]}
+        self._touch(ann_id)
+        return ann_id
+
+    def link(self, image_id, ann_id):
+        if image_id not in self.images:
+            raise ValueError(f"Image {image_id} not found")
+        if ann_id not in self.annotations:
+            raise ValueError(f"Annotation {ann_id} not found")
+        if ann_id in self._anns_by_image[image_id]:
+            raise ValueError(f"Image {image_id} is already linked to annotation {ann_id}")
+        link_id = self._new_id()
+        self.links[link_id] = (image_id, ann_id)
+        self._anns_by_image[image_id][ann_id] = link_id
+        self._images_by_ann[ann_id][image_id] = link_id
+        self._touch(link_id)
+        return link_id
+
+    def link_annotations(self, parent_id, child_id):
+        for ann_id in (parent_id, child_id):
+            if ann_id not in self.annotations:
+                raise ValueError(f"Annotation {ann_id} not found")
+        link_id = self._new_id()
+        self.annotation_links[link_id] = (parent_id, child_id)
+        return link_id
+
+    #
+    # BlitzGateway surface
+    #
+
+    def getQueryService(self):
+        return self._query_service
+
+    def getUpdateService(self):
+        return self._update_service
+
+    def getObject(self, obj_type, oid):
+        self._call("getObject")
+        oid = int(oid)
+        if obj_type == "Image" and oid in self.images:
+            return _ImageWrapper(self, oid)
+        if obj_type == "Dataset" and oid in self.datasets:
+            return _DatasetWrapper(self, oid)
+        if obj_type == "FileAnnotation" and oid in self.files:
+            return _FileAnnotationWrapper(self, oid)
+        if obj_type in ("MapAnnotation", "Annotation") and oid in self.annotations:
+            return _MapAnnotationWrapper(self, oid)
+        return None
+
+    def createFileAnnfromLocalFile(self, path, origFilePathAndName=None, mimetype=None, ns=None, desc=None):
+        self._call("createFileAnnfromLocalFile")
+        ann_id = self._new_id()
+        self.annotations[ann_id] = {"ns": ns, "values": []}
+        with open(path, "rb") as f:
+            self.files[ann_id] = f.read()
+        return _FileAnnotationWrapper(self, ann_id)
+
+    def getObjectsByAnnotations(self, obj_type, ann_ids):
+        self._call("getObjectsByAnnotations")
+        if obj_type != "Image":
+            raise NotImplementedError(obj_type)
+        image_ids = dict.fromkeys(iid for aid in ann_ids for iid in self._images_by_ann.get(aid, ()))
+        return [_ImageWrapper(self, iid) for iid in image_ids]
+
+    def deleteObjects(self, graph_spec, obj_ids, deleteAnns=False, deleteChildren=False, dryRun=False, wait=False):
+        self._call("deleteObjects")
+        if dryRun:
+            return
+        for oid in obj_ids:
+            if graph_spec in ("Annotation", "MapAnnotation"):
+                self._delete_annotation(oid)
+            elif graph_spec == "Image":
+                self._delete_image(oid, deleteAnns)
+            elif graph_spec == "ImageAnnotationLink":
+                self._delete_link(oid)
+            else:
+                raise NotImplementedError(graph_spec)
+
+    def _delete_link(self, link_id):
+        image_id, ann_id = self.links.pop(link_id)
+        del self._anns_by_image[image_id][ann_id]
+        del self._images_by_ann[ann_id][image_id]
+
+    def _delete_annotation(self, ann_id):
+        for link_id in list(self._images_by_ann.get(ann_id, {}).values()):
+            self._delete_link(link_id)
+        self._images_by_ann.pop(ann_id, None)
+        for link_id, pair in list(self.annotation_links.items()):
+            if ann_id in pair:
+                del self.annotation_links[link_id]
+        self.annotations.pop(ann_id, None)
+        self.files.pop(ann_id, None)
+
+    def _delete_image(self, image_id, delete_anns):
+        for ann_id, link_id in list(self._anns_by_image.get(image_id, {}).items()):
+            self._delete_link(link_id)
+            if delete_anns and not self._images_by_ann[ann_id]:
+                self._delete_annotation(ann_id)
+        self._anns_by_image.pop(image_id, None)
+        image = self.images.pop(image_id, None)
+        if image is not None and image["dataset_id"] is not None:
+            self.datasets[image["dataset_id"]]["image_ids"].remove(image_id)
+
+
+class _ImageWrapper:
+    def __init__(self, conn, image_id):
+        self._conn = conn
+        self._id = image_id
+
+    def getId(self):
+        return self._id
+
+    def getName(self):
+        return self._conn.images[self._id]["name"]
+
+    def getParent(self):
+        self._conn._call("getParent")
+        dataset_id = self._conn.images[self._id]["dataset_id"]
+        return None if dataset_id is None else _DatasetWrapper(self._conn, dataset_id)
+
+    def listAnnotations(self, ns=None):
+        self._conn._call("listAnnotations")
+        ann_ids = self._conn._anns_by_image.get(self._id, ())
+        return [
+            _MapAnnotationWrapper(self._conn, aid) for aid in ann_ids
+            if ns is None or self._conn.annotations[aid]["ns"] == ns
+        ]
+
+    def linkAnnotation(self, ann):
+        self._conn._call("linkAnnotation")
+        self._conn.link(self._id, ann.getId())
+        return ann
+
+
+class _DatasetWrapper:
+    def __init__(self, conn, dataset_id):
+        self._conn = conn
+        self._id = dataset_id
+
+    def getId(self):
+        return self._id
+
+    def getName(self):
+        return self._conn.datasets[self._id]["name"]
+
+    def listChildren(self):
+        self._conn._call("listChildren")
+        return [_ImageWrapper(self._conn, iid) for iid in self._conn.datasets[self._id]["image_ids"]]
+
+
+class _MapAnnotationWrapper:
+    def __init__(self, conn, ann_id):
+        self._conn = conn
+        self._id = ann_id
+
+    def getId(self):
+        return self._id
+
+    def getNs(self):
+        return self._conn.annotations[self._id]["ns"]
+
+    def getValue(self):
+        return list(self._conn.annotations[self._id]["values"])
+
+    def getMapValue(self):
+        return [NamedValue(k, v) for k, v in self._conn.annotations[self._id]["values"]]
+
+
+class _FileAnnotationWrapper:
+    def __init__(self, conn, ann_id):
+        self._conn = conn
+        self._id = ann_id
+
+    def getId(self):
+        return self._id
+
+    def getNs(self):
+        return self._conn.annotations[self._id]["ns"]
+
+    def getFileInChunks(self, buf=2621440):
+        self._conn._call("getFileInChunks")
+        data = self._conn.files[self._id]
+        for start in range(0, len(data), buf):
+            yield data[start:start + buf]
+
+
+def _to_map_annotation(ann_id, ann):
+    obj = MapAnnotationI(ann_id, True)
+    obj.setNs(rstring(ann["ns"]))
+    obj.setMapValue([NamedValue(k, v) for k, v in ann["values"]])
+    return obj
+
+
+class _FakeQueryService:
+    def __init__(self, conn):
+        self._conn = conn
+        self._handlers = {
+            queries.MAP_VALUES_BY_IMAGE: self._map_values_by_image,
+            queries.MAP_VALUES_BY_COLLECTION: self._map_values_by_collection,
+            queries.MAP_VALUES_BY_COLLECTIONS: self._map_values_by_collections,
+            queries.MAP_VALUES_BY_NS: lambda ns: [
+                row for aid, ann in sorted(self._conn.annotations.items()) if ann["ns"] == ns
+                for iid in self._conn._images_by_ann.get(aid, ()) for row in self._values_rows(iid, aid)
+                if row[2] is not None
+            ],
+            queries.IMAGES_BY_ANNOTATION: self._images_by_annotation,
+            queries.COLLECTION_IMAGES_IN_DATASET: self._collection_images_in_dataset,
+            queries.COLLECTION_IMAGES_IN_DATASET_BY_CATEGORY: self._collection_images_in_dataset,
+            queries.CHILD_ANNOTATIONS: self._child_annotations,
+            queries.ANNOTATION_LINKS: lambda aid: [
+                (lid, iid) for iid, lid in sorted(self._conn._images_by_ann.get(aid, {}).items(), key=lambda x: x[1])
+            ],
+            queries.ANNOTATION_LINKS_BY_IMAGE: self._annotation_links_by_image,
+            queries.MAP_ANNOTATIONS_BY_ID: lambda ids: [
+                _to_map_annotation(aid, self._conn.annotations[aid]) for aid in sorted(ids)
+                if aid in self._conn.annotations and aid not in self._conn.files
+            ],
+            queries.DATASET_IMAGES: lambda did: [
+                (iid,) for iid in sorted(self._conn.datasets.get(did, {}).get("image_ids", ()))
+            ],
+            queries.CHANGED_MAP_ANNOTATIONS: self._changed_map_annotations,
+            queries.NEW_IMAGE_LINKS: self._new_image_links,
+            queries.MAP_ANNOTATION_IDS: lambda nss: [
+                (aid,) for aid, ann in sorted(self._conn.annotations.items())
+                if ann["ns"] in nss and aid not in self._conn.files
+            ],
+            queries.IMAGE_LINK_IDS: lambda nss: [
+                (lid,) for lid, (_, aid) in sorted(self._conn.links.items()) if self._conn.annotations[aid]["ns"] in nss
+            ],
+            queries.EXISTING_IMAGES: lambda ids: [(i,) for i in sorted(ids) if i in self._conn.images],
+            queries.EXISTING_ANNOTATIONS: lambda ids: [(i,) for i in sorted(ids) if i in self._conn.annotations],
+        }
+        self._last_result = None
+
+    def get(self, obj_type, oid, ctx=None):
+        self._conn._call("get")
+        oid = unwrap(oid)
+        if obj_type not in ("MapAnnotation", "Annotation") or oid not in self._conn.annotations:
+            raise ValueError(f"{obj_type} {oid} not found")
+        return _to_map_annotation(oid, self._conn.annotations[oid])
+
+    def projection(self, query, params, ctx=None):
+        self._conn._call("projection")
+        return [[wrap(col) for col in row] for row in self._run(query, params)]
+
+    def findAllByQuery(self, query, params, ctx=None):
+        self._conn._call("findAllByQuery")
+        return list(self._run(query, params))
+
+    def _run(self, query, params):
+        handler = self._handlers.get(query)
+        if handler is None:
+            raise NotImplementedError(f"Query not supported by the fake gateway:\n{query}")
+        values = {name: unwrap(value) for name, value in params.map.items()}
+        key = (query, repr(sorted(values.items())), self._conn._version)
+        if self._last_result is None or self._last_result[0] != key:
+            self._last_result = (key, handler(**values))
+        rows = self._last_result[1]
+        if params.theFilter is not None and params.theFilter.limit is not None:
+            offset = unwrap(params.theFilter.offset) or 0
+            rows = rows[offset:offset + unwrap(params.theFilter.limit)]
+        return rows
+
+    def _values_rows(self, image_id, ann_id):
+        values = self._conn.annotations[ann_id]["values"]
+        if not values:
+            return [(image_id, ann_id, None, None)]
+        return [(image_id, ann_id, k, v) for k, v in values]
+
+    def _map_values_by_image(self, ids, ns):
+        anns = self._conn.annotations
+        pairs = sorted(
+            (aid, iid) for iid in ids for aid in self._conn._anns_by_image.get(iid, ())
+            if anns[aid]["ns"] == ns
+        )
+        return [row for aid, iid in pairs for row in self._values_rows(iid, aid)]
+
+    def _map_values_by_collection(self, ns, cid):
+        rows = []
+        for aid, ann in sorted(self._conn.annotations.items()):
+            if ann["ns"] == ns and ("collection_id", cid) in ann["values"]:
+                for iid in self._conn._images_by_ann.get(aid, ()):
+                    rows.extend(self._values_rows(iid, aid))
+        return rows
+
+    def _map_values_by_collections(self, ns, cids):
+        rows = []
+        for aid, ann in sorted(self._conn.annotations.items()):
+            if ann["ns"] == ns and any(k == "collection_id" and v in cids for k, v in ann["values"]):
+                for iid in self._conn._images_by_ann.get(aid, ()):
+                    rows.extend(self._values_rows(iid, aid))
+        return rows
+
+    def _images_by_annotation(self, ids):
+        return [(aid, iid) for aid in sorted(ids) for iid in sorted(self._conn._images_by_ann.get(aid, ()))]
+
+    def _collection_images_in_dataset(self, did, cid, ns=None, cids=None, category=None):
+        conn = self._conn
+        image_ids = sorted(
+            iid for iid in conn.datasets.get(did, {}).get("image_ids", ())
+            if iid in conn.images and iid in conn._images_by_ann.get(cid, ())
+        )
+        if category is not None:
+            image_ids = [
+                iid for iid in image_ids
+                if any(
+                    conn.annotations[aid]["ns"] == ns
+                    and {("collection_id", cids), ("category", category)} <= set(conn.annotations[aid]["values"])
+                    for aid in conn._anns_by_image.get(iid, ())
+                )
+            ]
+        return [(iid, conn.images[iid]["name"]) for iid in image_ids]
+
+    def _annotation_links_by_image(self, ids, ns):
+        conn = self._conn
+        links = []
+        for iid in sorted(ids):
+            for aid, lid in sorted(conn._anns_by_image.get(iid, {}).items()):
+                if conn.annotations[aid]["ns"] == ns:
+                    link = ImageAnnotationLinkI(lid, True)
+                    link.setParent(ImageI(iid, False))
+                    link.setChild(_to_map_annotation(aid, conn.annotations[aid]))
+                    links.append(link)
+        return links
+
+    def _child_annotations(self, ids, ns):
+        anns = self._conn.annotations
+        return sorted(
+            (parent, child) for parent, child in self._conn.annotation_links.values()
+            if parent in ids and anns[child]["ns"] == ns
+        )
+
+    def _changed_map_annotations(self, nss, since):
+        conn = self._conn
+        rows = []
+        for aid, ann in sorted(conn.annotations.items()):
+            if ann["ns"] in nss and aid not in conn.files and conn.events[aid] > since:
+                rows.extend((aid, ann["ns"], conn.events[aid], k, v) for _, _, k, v in self._values_rows(None, aid))
+        return rows
+
+    def _new_image_links(self, nss, since):
+        conn = self._conn
+        return [
+            (lid, iid, aid, conn.events[lid]) for lid, (iid, aid) in sorted(conn.links.items())
+            if conn.annotations[aid]["ns"] in nss and conn.events[lid] > since
+        ]
+
+
+class _FakeUpdateService:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def saveObject(self, obj, ctx=None):
+        self._conn._call("saveObject")
+        self._save(obj)
+
+    def saveAndReturnObject(self, obj, ctx=None):
+        self._conn._call("saveAndReturnObject")
+        return self._save(obj)
+
+    def saveArray(self, objs, ctx=None):
+        self._conn._call("saveArray")
+        for obj in objs:
+            self._save(obj)
+
+    def saveAndReturnArray(self, objs, ctx=None):
+        self._conn._call("saveAndReturnArray")
+        return [self._save(obj) for obj in objs]
+
+    def _save(self, obj):
+        if isinstance(obj, ImageAnnotationLinkI):
+            child = obj.getChild()
+            if child.getId() is None or child.isLoaded():
+                child = self._save(child)
+            link_id = self._conn.link(unwrap(obj.getParent().getId()), unwrap(child.getId()))
+            obj.setId(rlong(link_id))
+            obj.setChild(child)
+            return obj
+        if isinstance(obj, AnnotationAnnotationLinkI):
+            link_id = self._conn.link_annotations(unwrap(obj.getParent().getId()), unwrap(obj.getChild().getId()))
+            obj.setId(rlong(link_id))
+            return obj
+        if isinstance(obj, MapAnnotationI):
+            ann = {"ns": unwrap(obj.getNs()), "values": [(nv.name, nv.value) for nv in obj.getMapValue() or []]}
+            ann_id = unwrap(obj.getId())
+            if ann_id is None:
+                ann_id = self._conn._new_id()
+            self._conn.annotations[ann_id] = ann
+            self._conn._touch(ann_id)
+            return _to_map_annotation(ann_id, ann)
+        raise NotImplementedError(f"Saving {type(obj).__name__} is not supported by the fake gateway")
@@ -0,0 +1,282 @@
+"""Round-trip and latency instrumentation for OMERO gateway calls.
+
+`instrument(conn)` returns a proxy around a BlitzGateway that records every
+server call (method, object type, latency, payload size where known) together
+with the biohack_utils function it was made from, and dumps a per-function
+summary at exit. Only the per-function aggregates are kept in memory, the
+individual calls can be streamed to a JSON Lines file. Without
+instrumentation the plain connection is used, so there is no cost when it is
+disabled.
+"""
+import atexit
+import functools
+import json
+import math
+import sys
+import threading
+import time
+import types
+from collections import Counter
+
+
+# Methods of the gateway's object wrappers (ImageWrapper, ...) that talk to the server.
+_WRAPPER_CALLS = {
+    "listAnnotations", "linkAnnotation", "listChildren", "getParent", "getPrimaryPixels",
+    "getPlane", "getPlanes", "getTile", "getTiles", "getThumbnail", "getAnnotation",
+}
+# Calls made from these modules are attributed to the function that used them.
+_HELPER_MODULES = {__name__, "biohack_utils.queries"}
+# Latencies are counted in logarithmic buckets from 1us, so the percentiles are exact to about 12%.
+_MIN_LATENCY = 1e-6
+_BUCKETS_PER_DECADE = 20
+
+
+class _CallerStats:
+    """Running aggregates of the calls made from one function."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.payload = None
+        self.methods = Counter()
+        self.latencies = Counter()  # bucket index -> number of calls
+
+    def add(self, method, latency, size):
+        self.count += 1
+        self.total += latency
+        if size is not None:
+            self.payload = (self.payload or 0) + size
+        self.methods[method] += 1
+        self.latencies[_bucket(latency)] += 1
+
+
+def _bucket(latency):
+    if latency <= _MIN_LATENCY:
+        return 0
+    return math.ceil(math.log10(latency / _MIN_LATENCY) * _BUCKETS_PER_DECADE)
+
+
+class CallRecorder:
+    """Summarises the recorded calls per calling function.
+
+    Args:
+        records_output: Path of a JSON Lines file every call is appended to as it is recorded.
+    """
+    def __init__(self, records_output=None):
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._records = None if records_output is None else open(records_output, "a", buffering=1 << 16)
+
+    def record(self, method, obj_type, latency, size, caller):
+        with self._lock:
+            self._stats.setdefault(caller, _CallerStats()).add(method, latency, size)
+            if self._records is not None:
+                self._records.write(json.dumps({
+                    "method": method, "type": obj_type, "latency": latency, "size": size, "caller": caller,
+                }) + "\n")
+
+    def summary(self):
+        """Per-function count, total and p50/p95/p99 latency in seconds, and the calls made."""
+        summary = {}
+        with self._lock:
+            for caller, stats in sorted(self._stats.items()):
+                summary[caller] = {
+                    "count": stats.count,
+                    "total": stats.total,
+                    "p50": _percentile(stats.latencies, 50),
+                    "p95": _percentile(stats.latencies, 95),
+                    "p99": _percentile(stats.latencies, 99),
+                    "payload": stats.payload,
+                    "methods": dict(stats.methods),
+                }
+        return summary
+
+    def close(self):
+        """Close the records file."""
+        with self._lock:
+            if self._records is not None:
+                self._records.close()
+                self._records = None
+
+    def dump(self, output=None):
+        """Write the summary as JSON to `output`, or print it if output is None or "-".
+        The records file is closed.
+        """
+        self.close()
+        summary = self.summary()
+        if output is None or output == "-":
+            print(f"{'function':<60} {'count':>7} {'total':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+            for caller, stats in summary.items():
+                print(
+                    f"{caller:<60} {stats['count']:>7} {stats['total']:>8.3f}s {stats['p50']:>8.4f}s "
+                    f"{stats['p95']:>8.4f}s {stats['p99']:>8.4f}s"
+                )
+        else:
+            with open(output, "w") as f:
+                json.dump(summary, f, indent=2)
+
+
+def _percentile(buckets, q):
+    """Nearest-rank percentile of a latency histogram, as the upper bound of its bucket."""
+    n = sum(buckets.values())
+    if not n:
+        return 0.0
+    rank = max(math.ceil(q / 100 * n), 1)
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen >= rank:
+            return _MIN_LATENCY * 10 ** (bucket / _BUCKETS_PER_DECADE)
+
+
+def _find_caller():
+    """Name of the innermost biohack_utils function on the stack, skipping the helper modules."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith("biohack_utils") and module not in _HELPER_MODULES:
+            return f"{module}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return "<external>"
+
+
+def _object_type(args):
+    if not args:
+        return None
+    first = args[0]
+    if isinstance(first, str):
+        return first
+    if isinstance(first, (list, tuple)):
+        return type(first[0]).__name__ if first else None
+    return type(first).__name__
+
+
+def _payload_size(args, result):
+    """Number of returned items, or else the number of items sent."""
+    if isinstance(result, (list, tuple, dict, bytes)):
+        return len(result)
+    for arg in args:
+        if isinstance(arg, (list, tuple, bytes)):
+            return len(arg)
+    return None
+
+
+def _unwrap_proxy(value):
+    if isinstance(value, list):
+        return [_unwrap_proxy(item) for item in value]
+    return value._proxied if isinstance(value, _Proxy) else value
+
+
+class _Proxy:
+    """Forwards attribute access to the wrapped object and records the calls of
+    the methods selected by `_recorded`.
+    """
+    def __init__(self, obj, recorder, prefix):
+        self._proxied = obj
+        self._proxy_recorder = recorder
+        self._proxy_prefix = prefix
+
+    def _recorded(self, name):
+        raise NotImplementedError
+
+    def __getattr__(self, name):
+        attr = getattr(self._proxied, name)
+        if not callable(attr) or not self._recorded(name):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            args = [_unwrap_proxy(arg) for arg in args]
+            kwargs = {key: _unwrap_proxy(val) for key, val in kwargs.items()}
+            caller = _find_caller()
+            start = time.perf_counter()
+            result = attr(*args, **kwargs)
+            latency = time.perf_counter() - start
+            if isinstance(result, types.GeneratorType):
+                return _traced_generator(
+                    result, self._proxy_recorder, f"{self._proxy_prefix}.{name}", _object_type(args), latency, caller
+                )
+            self._proxy_recorder.record(
+                f"{self._proxy_prefix}.{name}", _object_type(args), latency, _payload_size(args, result), caller
+            )
+            return _wrap_result(result, self._proxy_recorder)
+
+        return call
+
+
+def _traced_generator(generator, recorder, name, object_type, latency, caller):
+    """Yield the items of a lazily fetching generator, e.g. of `getPlanes`, adding up the time
+    spent fetching them. The call is recorded once the generator is exhausted or closed,
+    so tracing keeps the memory profile of the traced function.
+    """
+    n_items = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                break
+            finally:
+                latency += time.perf_counter() - start
+            n_items += 1
+            yield _wrap_result(item, recorder)
+    finally:
+        generator.close()
+        recorder.record(name, object_type, latency, n_items, caller)
+
+
+class _ServiceProxy(_Proxy):
+    def _recorded(self, name):
+        return not name.startswith("_")
+
+
+class _ObjectProxy(_Proxy):
+    def _recorded(self, name):
+        return name in _WRAPPER_CALLS
+
+
+def _wrap_result(result, recorder):
+    if isinstance(result, list):
+        return [_wrap_result(item, recorder) for item in result]
+    # BlitzObjectWrapper instances keep a reference to their gateway in `_conn`.
+    if hasattr(result, "_conn"):
+        return _ObjectProxy(result, recorder, type(result).__name__)
+    return result
+
+
+class InstrumentedGateway(_Proxy):
+    """Proxy around a BlitzGateway recording all server calls made through it."""
+    def __init__(self, conn, recorder=None):
+        super().__init__(conn, recorder or CallRecorder(), "BlitzGateway")
+
+    @property
+    def recorder(self):
+        return self._proxy_recorder
+
+    def _recorded(self, name):
+        return not name.startswith("_")
+
+    def __getattr__(self, name):
+        attr = getattr(self._proxied, name)
+        # Getting a service is local, the calls on the returned service are not.
+        if callable(attr) and ((name.startswith("get") and name.endswith("Service")) or name == "createRawPixelsStore"):
+            service_name = name[len("get"):] if name.startswith("get") else "RawPixelsStore"
+            return lambda *args, **kwargs: _ServiceProxy(attr(*args, **kwargs), self._proxy_recorder, service_name)
+        return super().__getattr__(name)
+
+
+def instrument(conn, output=None, records_output=None, dump_at_exit=True):
+    """Wrap a connection so that all server calls are recorded.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        output: Path of the JSON summary written at exit. None or "-" to print it.
+        records_output: Path of a JSON Lines file the individual calls are streamed to.
+        dump_at_exit: Whether to dump the summary when the interpreter exits.
+    Returns:
+        The instrumented connection. Its `recorder` holds the summary.
+    """
+    instrumented = InstrumentedGateway(conn, CallRecorder(records_output))
+    if dump_at_exit:
+        atexit.register(instrumented.recorder.dump, output)
+    return instrumented
@@ -0,0 +1,140 @@
+"""Checkpoint journal for resumable batch annotation.
+
+The journal is a local SQLite file recording for every source image the
+uploaded mask, the created collection and whether the collection is complete.
+A rerun of `pipeline.run_batch_annotation` with the same journal skips the
+finished images and continues the half-finished ones instead of uploading
+duplicate masks and collections.
+"""
+import sqlite3
+import threading
+
+from biohack_utils.omero_annotation import NS_NODE
+from biohack_utils.queries import (
+    EXISTING_ANNOTATIONS, EXISTING_IMAGES, _existing_ids, _images_by_annotation, _map_values_by_image,
+)
+
+
+class AnnotationJournal:
+    """SQLite journal of the batch annotation progress per source image.
+
+    Args:
+        path: Path of the SQLite file, it is created if it does not exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS items (
+                image_id INTEGER PRIMARY KEY,
+                mask_id INTEGER,
+                collection_id INTEGER,
+                annotated INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+        # Images already linked to / described in their half-finished collection, see `verify`.
+        self._partial = {}
+
+    def _execute(self, query, params=()):
+        with self._lock:
+            self._db.execute(query, params)
+            self._db.commit()
+
+    def get(self, image_id):
+        """The journal entry of an image as dict, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT mask_id, collection_id, annotated FROM items WHERE image_id = ?", (image_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"image_id": image_id, "mask_id": row[0], "collection_id": row[1], "annotated": bool(row[2])}
+
+    def record_mask(self, image_id, mask_id):
+        self._execute(
+            "INSERT INTO items (image_id, mask_id) VALUES (?, ?) "
+            "ON CONFLICT(image_id) DO UPDATE SET mask_id = excluded.mask_id",
+            (image_id, mask_id),
+        )
+
+    def record_collection(self, image_id, collection_id):
+        self._execute("UPDATE items SET collection_id = ? WHERE image_id = ?", (collection_id, image_id))
+
+    def record_annotated(self, image_id):
+        self._execute("UPDATE items SET annotated = 1 WHERE image_id = ?", (image_id,))
+        self._partial.pop(image_id, None)
+
+    def partial(self, image_id):
+        """Sets of the images already linked to and already having a node in the
+        journaled collection of `image_id`.
+        """
+        return self._partial.get(image_id, (set(), set()))
+
+    def verify(self, conn, image_ids=None):
+        """Check the journal against the server and correct it.
+
+        Entries whose mask was deleted are reset, entries whose collection was deleted
+        lose their collection, and half-finished collections are checked for the links
+        and nodes they already have. This takes a fixed number of bulk queries.
+
+        Returns a dict with the number of finished, half-finished and reset entries.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT image_id, mask_id, collection_id, annotated FROM items").fetchall()
+        if image_ids is not None:
+            wanted = set(image_ids)
+            rows = [row for row in rows if row[0] in wanted]
+
+        existing_masks = _existing_ids(conn, EXISTING_IMAGES, [row[1] for row in rows if row[1] is not None])
+        coll_ids = [row[2] for row in rows if row[2] is not None]
+        existing_colls = _existing_ids(conn, EXISTING_ANNOTATIONS, coll_ids)
+        members = _images_by_annotation(conn, existing_colls)
+        node_anns = _map_values_by_image(
+            conn, [iid for row in rows if row[2] in existing_colls for iid in row[:2]], NS_NODE
+        )
+
+        summary = {"finished": 0, "half_finished": 0, "reset": 0}
+        for image_id, mask_id, coll_id, annotated in rows:
+            if mask_id is None or mask_id not in existing_masks:
+                self._execute("DELETE FROM items WHERE image_id = ?", (image_id,))
+                summary["reset"] += 1
+                continue
+
+            if coll_id is not None and coll_id not in existing_colls:
+                self._execute("UPDATE items SET collection_id = NULL, annotated = 0 WHERE image_id = ?", (image_id,))
+                summary["half_finished"] += 1
+                continue
+            if coll_id is None:
+                summary["half_finished"] += 1
+                continue
+
+            linked = set(members[coll_id]) & {image_id, mask_id}
+            described = {
+                iid for iid in (image_id, mask_id)
+                if any(kv.get("collection_id") == str(coll_id) for kv in node_anns.get(iid, {}).values())
+            }
+            if linked == described == {image_id, mask_id}:
+                self._execute("UPDATE items SET annotated = 1 WHERE image_id = ?", (image_id,))
+                summary["finished"] += 1
+            else:
+                self._execute("UPDATE items SET annotated = 0 WHERE image_id = ?", (image_id,))
+                self._partial[image_id] = (linked, described)
+                summary["half_finished"] += 1
+
+        print(
+            f"Journal {self.path}: {summary['finished']} finished, "
+            f"{summary['half_finished']} half-finished, {summary['reset']} reset"
+        )
+        return summary
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
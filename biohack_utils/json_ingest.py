@@ -0,0 +1,360 @@
+"""Streaming upload of collection documents (RFC-8 JSON) to OMERO.
+
+The document is parsed incrementally: the `ome.nodes` tree is walked key by
+key and every multiscale node is validated and flattened as soon as its object
+is complete, so only one node and one upload batch are held in memory at a
+time. The paths, names and sources of all nodes for the validation of the whole
+collection, and the images already linked to it, are kept in a temporary
+SQLite index on disk. The flat records are fed in batches to the same writer
+as `config_utils.upload(bulk=True)`.
+
+The collection `name` has to come before its `nodes`, as does the `name` of
+every collection node, which is the order written by pydantic and by
+`zarr_export`.
+"""
+import json
+import sqlite3
+
+from omero.model import NamedValue
+
+from biohack_utils.ConfigSchema import MultiscaleNode, OMECollection, _sources
+from biohack_utils.config_utils import _create_collection_annotation, _upload_batches
+from biohack_utils.omero_annotation import _invalidate_cache
+
+
+_WHITESPACE = " \t\n\r"
+# Number of rows written to or read from the node index at a time.
+_INDEX_BATCH_SIZE = 10000
+
+
+class _JSONStream:
+    """Incremental JSON reader over a text file, reading `chunk_size` characters at a time.
+
+    Objects and arrays can be walked item by item, any other value is decoded at once.
+    """
+    def __init__(self, f, chunk_size=1 << 16):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Read the next chunk, dropping the consumed part of the buffer. Returns False at the end of the file."""
+        if self._eof:
+            return False
+        chunk = self._f.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """The next non-whitespace character, or "" at the end of the file."""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Invalid JSON: expected '{char}', got '{found or 'end of file'}'")
+        self._pos += 1
+
+    def value(self):
+        """Decode the next complete value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number or literal at the end of the buffer may continue in the next chunk.
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def items(self):
+        """Walk an object, yielding its keys. The caller consumes each value before the next key."""
+        self.expect("{")
+        if self.peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f"Invalid JSON: expected an object key, got {key!r}")
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self._pos += 1
+            else:
+                self.expect("}")
+                return
+
+    def elements(self):
+        """Walk an array, yielding once per element. The caller consumes each element."""
+        self.expect("[")
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == ",":
+                self._pos += 1
+            else:
+                self.expect("]")
+                return
+
+
+class _NodeIndex:
+    """Temporary on-disk SQLite index of the nodes of a collection.
+
+    Checks the collection as a whole like `OMECollection.collection_errors`, with
+    the same rules and messages, but without holding the nodes in memory.
+    It also serves as set of the images linked to the collection for `_upload_batches`.
+    """
+    def __init__(self):
+        # An empty path opens a private database on disk that is deleted when it is closed.
+        self._db = sqlite3.connect("")
+        self._db.executescript(
+            """
+            CREATE TABLE nodes (seq INTEGER PRIMARY KEY, path TEXT, parent TEXT, name TEXT, multiscale INTEGER);
+            CREATE TABLE sources (seq INTEGER, source TEXT);
+            CREATE TABLE linked (image_id INTEGER PRIMARY KEY);
+            """
+        )
+        self._pending_nodes, self._pending_sources = [], []
+        self._n_nodes = 0
+
+    def append(self, entry):
+        """Add the (path, parent path, name, sources) of a node, with sources None for collection nodes."""
+        path, parent, name, sources = entry
+        self._pending_nodes.append((self._n_nodes, path, parent, name, sources is not None))
+        self._pending_sources.extend((self._n_nodes, source) for source in sources or ())
+        self._n_nodes += 1
+        if len(self._pending_nodes) >= _INDEX_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        self._db.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?, ?)", self._pending_nodes)
+        self._db.executemany("INSERT INTO sources VALUES (?, ?)", self._pending_sources)
+        self._pending_nodes, self._pending_sources = [], []
+
+    def _rows(self, query):
+        cursor = self._db.execute(query)
+        while rows := cursor.fetchmany(_INDEX_BATCH_SIZE):
+            yield from rows
+
+    def errors(self):
+        """The list of collection errors, see `OMECollection.collection_errors`."""
+        self._flush()
+        db = self._db
+        db.executescript(
+            """
+            CREATE INDEX nodes_path ON nodes (path, seq);
+            CREATE TABLE firsts (seq INTEGER PRIMARY KEY);
+            INSERT INTO firsts SELECT MIN(seq) FROM nodes GROUP BY path;
+            -- The multiscale nodes, without duplicate paths.
+            CREATE TABLE ms (seq INTEGER PRIMARY KEY, path TEXT UNIQUE, parent TEXT, name TEXT);
+            INSERT INTO ms SELECT n.seq, n.path, n.parent, n.name FROM nodes n
+                JOIN firsts f ON n.seq = f.seq WHERE n.multiscale;
+            CREATE INDEX ms_parent_name ON ms (parent, name);
+            CREATE INDEX ms_name ON ms (name);
+            CREATE TABLE edges (path TEXT, src TEXT);
+            """
+        )
+        errors = [
+            f"Duplicate path '{path}'" for path, in self._rows(
+                "SELECT n.path FROM nodes n LEFT JOIN firsts f ON n.seq = f.seq WHERE f.seq IS NULL ORDER BY n.seq"
+            )
+        ]
+
+        # Resolve every source as a path, then as the name of a sibling, then as a unique name.
+        resolved = self._rows(
+            """
+            SELECT path, source, resolved,
+                CASE WHEN resolved IS NULL THEN (SELECT COUNT(*) FROM ms p WHERE p.name = source) END,
+                CASE WHEN resolved IS NULL THEN (SELECT MIN(p.path) FROM ms p WHERE p.name = source) END
+            FROM (
+                SELECT s.seq, s.rowid AS position, m.path, s.source, COALESCE(
+                    (SELECT p.path FROM ms p WHERE p.path = s.source),
+                    (SELECT p.path FROM ms p WHERE p.parent = m.parent AND p.name = s.source)
+                ) AS resolved
+                FROM sources s JOIN ms m ON s.seq = m.seq
+            )
+            ORDER BY seq, position
+            """
+        )
+        edges = []
+        for path, source, src, n_candidates, by_name in resolved:
+            if src is None and n_candidates == 1:
+                src = by_name
+            if src is not None:
+                edges.append((path, src))
+            elif n_candidates:
+                errors.append(f"Node '{path}': source '{source}' is ambiguous, it matches {n_candidates} nodes")
+            else:
+                errors.append(f"Node '{path}': source '{source}' does not exist")
+            if len(edges) >= _INDEX_BATCH_SIZE:
+                db.executemany("INSERT INTO edges VALUES (?, ?)", edges)
+                edges = []
+        db.executemany("INSERT INTO edges VALUES (?, ?)", edges)
+
+        # Kahn's algorithm in rounds: drop the edges of all sources without own sources left.
+        # The edges that are never dropped lead to nodes on or behind a cycle.
+        db.execute("CREATE INDEX edges_path ON edges (path)")
+        while db.execute("DELETE FROM edges WHERE src NOT IN (SELECT path FROM edges)").rowcount:
+            pass
+        cyclic = [path for path, in self._rows("SELECT DISTINCT path FROM edges ORDER BY path")]
+        if cyclic:
+            errors.append(f"The sources of these nodes form or depend on a cycle: {', '.join(cyclic)}")
+        return errors
+
+    def __contains__(self, image_id):
+        return self._db.execute("SELECT 1 FROM linked WHERE image_id = ?", (image_id,)).fetchone() is not None
+
+    def add(self, image_id):
+        self._db.execute("INSERT OR IGNORE INTO linked VALUES (?)", (image_id,))
+
+    def close(self):
+        self._db.close()
+
+
+def _iter_nodes(stream, prefix="", entries=None):
+    """Yield the flat record of every multiscale node of a `nodes` array, in the order of `flatten`.
+
+    If `entries` is given (a list or `_NodeIndex`), the (path, parent path, name, sources)
+    of every node are appended to it for the validation of the whole collection.
+    """
+    for _ in stream.elements():
+        node = {}
+        is_collection = False
+        for key in stream.items():
+            if key != "nodes":
+                node[key] = stream.value()
+                continue
+            if "name" not in node:
+                raise ValueError(f"Collection node in '{prefix or '/'}' has its 'nodes' before its 'name'")
+            is_collection = True
+            path = f"{prefix}/{node['name']}" if prefix else node["name"]
+            if entries is not None:
+                entries.append((path, prefix, node["name"], None))
+            yield from _iter_nodes(stream, path, entries)
+
+        if is_collection:
+            if node.get("type", "collection") != "collection":
+                raise ValueError(f"Node '{node['name']}' in '{prefix or '/'}' has nodes but type '{node['type']}'")
+            continue
+        node = MultiscaleNode.model_validate(node)
+        path = f"{prefix}/{node.name}" if prefix else node.name
+        if entries is not None:
+            entries.append((path, prefix, node.name, _sources(node.attributes.source)))
+        record = {"name": node.name, "path": path}
+        record.update(node.attributes.model_dump(by_alias=True, exclude_none=True))
+        yield record
+
+
+def _walk_document(stream, on_nodes):
+    """Walk a collection document, calling `on_nodes(name, version)` when the stream is at `ome.nodes`.
+
+    Returns the collection metadata (name and version) of the document.
+    """
+    meta = {}
+    found = False
+    for key in stream.items():
+        if key != "ome":
+            stream.value()
+            continue
+        for ome_key in stream.items():
+            if ome_key != "nodes":
+                meta[ome_key] = stream.value()
+                continue
+            if "name" not in meta:
+                raise ValueError("The collection has its 'nodes' before its 'name'")
+            on_nodes(meta["name"], meta.get("version", "0.x"))
+            found = True
+    if not found:
+        raise ValueError("The document has no 'ome.nodes'")
+    # Validates the collection metadata, e.g. its type.
+    OMECollection(**meta, nodes=[])
+    return meta
+
+
+def validate_json(path, chunk_size=1 << 16):
+    """Validate a collection document as a whole without loading it.
+
+    Every node is validated on its own and the collection as by `OMECollection.collection_errors`,
+    over a temporary index on disk, so the memory use does not grow with the document.
+    Returns the list of collection errors, invalid nodes raise a ValidationError.
+    """
+    index = _NodeIndex()
+
+    def consume(name, version):
+        for _ in _iter_nodes(stream, entries=index):
+            pass
+
+    try:
+        with open(path) as f:
+            stream = _JSONStream(f, chunk_size)
+            _walk_document(stream, consume)
+        return index.errors()
+    finally:
+        index.close()
+
+
+def upload_json(conn, path, batch_size=1000, validate=True, chunk_size=1 << 16):
+    """Upload a collection document to OMERO while it is parsed.
+
+    The memory use is bounded by one upload batch, the state kept for all nodes is on disk.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        path: Path to the JSON document with the collection under `ome`.
+        batch_size: Number of nodes saved per call.
+        validate: Validate the whole collection before uploading, in a first pass over the
+            file. Without it invalid nodes are only found once the batches before them are saved.
+        chunk_size: Number of characters read from the file at a time.
+    Returns:
+        The ID of the collection annotation.
+    """
+    if validate:
+        errors = validate_json(path, chunk_size)
+        if errors:
+            raise ValueError(f"Collection in {path} is invalid ({len(errors)} errors):\n" + "\n".join(errors))
+
+    result = {"n_nodes": 0}
+    linked_images = _NodeIndex()
+
+    def upload_nodes(name, version):
+        coll_id = _create_collection_annotation(conn, name, version)
+        result["coll_id"], result["version"] = coll_id, version
+        # The records are parsed lazily, one batch at a time.
+        for batch, node_ids in _upload_batches(conn, coll_id, _iter_nodes(stream), batch_size, linked_images):
+            result["n_nodes"] += len(node_ids)
+            _invalidate_cache(image_ids={record["omero:image_id"] for record in batch})
+
+    try:
+        with open(path) as f:
+            stream = _JSONStream(f, chunk_size)
+            meta = _walk_document(stream, upload_nodes)
+    finally:
+        linked_images.close()
+
+    coll_id = result["coll_id"]
+    if meta.get("version", "0.x") != result["version"]:
+        # The version came after the nodes.
+        coll_ann = conn.getQueryService().get("MapAnnotation", coll_id)
+        coll_ann.setMapValue([NamedValue("version", meta["version"]), NamedValue("name", meta["name"])])
+        conn.getUpdateService().saveObject(coll_ann)
+    _invalidate_cache(collection_ids=[coll_id])
+    print(f"Uploaded collection '{meta['name']}' with {result['n_nodes']} nodes from {path} as collection {coll_id}")
+    return coll_id
@@ -0,0 +1,202 @@
+"""Per-instance index of label images.
+
+For every label of a label image the bounding box, voxel count and centroid
+are computed plane by plane and stored as a small npz file annotation linked
+to the node annotation of the image. Clients can then look up a single object
+and read only the tiles it covers instead of downloading the full mask.
+"""
+import io
+import os
+import tempfile
+
+import numpy as np
+from omero.model import AnnotationAnnotationLinkI, FileAnnotationI, MapAnnotationI
+from scipy import ndimage
+
+from biohack_utils.omero_annotation import NS_LABEL_INDEX, NS_NODE
+from biohack_utils.queries import _child_annotations, _map_values_by_image
+
+
+_FIELDS = ("count", "sum_z", "sum_y", "sum_x", "min_z", "min_y", "min_x", "max_z", "max_y", "max_x")
+
+
+def _plane_stats(z, plane):
+    """Statistics of the labels of one plane, as (label IDs, {field: array}).
+
+    The plane is renumbered to the labels present, so the arrays do not depend on the label values.
+    """
+    ids, compact = np.unique(plane.ravel(), return_inverse=True)
+    compact = compact.reshape(plane.shape)
+    if ids[0] == 0:
+        ids = ids[1:]
+    else:
+        compact += 1
+    n = len(ids) + 1
+
+    counts = np.bincount(compact.ravel(), minlength=n)[1:]
+    rows = np.repeat(np.arange(plane.shape[0], dtype=np.float64), plane.shape[1])
+    cols = np.tile(np.arange(plane.shape[1], dtype=np.float64), plane.shape[0])
+    boxes = np.array([
+        (obj[0].start, obj[1].start, obj[0].stop, obj[1].stop) for obj in ndimage.find_objects(compact)
+    ], dtype=np.int64).reshape(-1, 4)
+    return ids.astype(np.uint64), {
+        "count": counts,
+        "sum_z": counts * float(z),
+        "sum_y": np.bincount(compact.ravel(), weights=rows, minlength=n)[1:],
+        "sum_x": np.bincount(compact.ravel(), weights=cols, minlength=n)[1:],
+        "min_z": np.full(len(ids), z, dtype=np.int64),
+        "min_y": boxes[:, 0],
+        "min_x": boxes[:, 1],
+        "max_z": np.full(len(ids), z + 1, dtype=np.int64),
+        "max_y": boxes[:, 2],
+        "max_x": boxes[:, 3],
+    }
+
+
+def _merge_stats(stats, ids, plane_stats):
+    """Add the statistics of one plane to the running statistics, which are sorted by label ID."""
+    new = ids[~np.isin(ids, stats["label"], assume_unique=True)]
+    if len(new):
+        labels = np.union1d(stats["label"], new)
+        old = np.searchsorted(labels, stats["label"])
+        for name in _FIELDS:
+            fill = np.iinfo(np.int64).max if name.startswith("min") else 0
+            grown = np.full(len(labels), fill, dtype=stats[name].dtype)
+            grown[old] = stats[name]
+            stats[name] = grown
+        stats["label"] = labels
+
+    rows = np.searchsorted(stats["label"], ids)
+    for name in _FIELDS:
+        if name.startswith("min"):
+            stats[name][rows] = np.minimum(stats[name][rows], plane_stats[name])
+        elif name.startswith("max"):
+            stats[name][rows] = np.maximum(stats[name][rows], plane_stats[name])
+        else:
+            stats[name][rows] += plane_stats[name]
+
+
+def _label_index(planes):
+    """Compute the index of a label image given as iterable of (Y, X) planes.
+
+    Returns a dict of arrays with one row per label: "label", "count",
+    "bbox" (z0, y0, x0, z1, y1, x1 with exclusive upper bounds) and "centroid" (z, y, x).
+    The running statistics are keyed by the label IDs present, so their size
+    does not depend on the largest label value.
+    """
+    stats = {name: np.zeros(0, dtype=np.float64 if name.startswith("sum") else np.int64) for name in _FIELDS}
+    stats["label"] = np.zeros(0, dtype=np.uint64)
+    for z, plane in enumerate(planes):
+        plane = np.asarray(plane)
+        if plane.size == 0 or not plane.any():
+            continue
+        _merge_stats(stats, *_plane_stats(z, plane))
+
+    count = stats["count"]
+    return {
+        "label": stats["label"],
+        "count": count,
+        "bbox": np.stack([stats[name] for name in _FIELDS[4:]], axis=1).reshape(-1, 6),
+        "centroid": np.stack([stats[name] / count for name in _FIELDS[1:4]], axis=1).reshape(-1, 3),
+    }
+
+
+def _save_label_index(conn, node_ann_ids, index, name):
+    """Upload the index as npz file annotation and link it to the node annotations,
+    replacing their previous index. Returns the file annotation ID.
+
+    The previous index is only deleted once the new one is linked, so a failed upload keeps it.
+    """
+    previous = {fid for fids in _child_annotations(conn, node_ann_ids, NS_LABEL_INDEX).values() for fid in fids}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, f"{name}.npz")
+        np.savez_compressed(path, **index)
+        file_ann = conn.createFileAnnfromLocalFile(
+            path, mimetype="application/octet-stream", ns=NS_LABEL_INDEX,
+            desc=f"Label index of {len(index['label'])} objects",
+        )
+
+    links = []
+    for node_ann_id in node_ann_ids:
+        link = AnnotationAnnotationLinkI()
+        link.setParent(MapAnnotationI(node_ann_id, False))
+        link.setChild(FileAnnotationI(file_ann.getId(), False))
+        links.append(link)
+    conn.getUpdateService().saveArray(links, conn.SERVICE_OPTS)
+
+    if previous:
+        conn.deleteObjects("Annotation", list(previous), wait=True)
+    return file_ann.getId()
+
+
+def build_label_index(conn, image_id, node_ann_id=None):
+    """Compute the label index of a label image and store it with its node annotation.
+
+    The planes are downloaded one at a time, so the full mask is never held in memory.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        image_id: The ID of the label image.
+        node_ann_id: The node annotation to link the index to.
+            Defaults to all node annotations of the image.
+    Returns:
+        The ID of the index file annotation.
+    """
+    if node_ann_id is None:
+        node_ann_ids = list(_map_values_by_image(conn, [image_id], NS_NODE).get(image_id, {}))
+        if not node_ann_ids:
+            raise RuntimeError(f"No node annotation (ns={NS_NODE}) found for Image {image_id}")
+    else:
+        node_ann_ids = [node_ann_id]
+
+    image = conn.getObject("Image", image_id)
+    if image is None:
+        raise ValueError(f"Image {image_id} not found")
+    pixels = image.getPrimaryPixels()
+    planes = pixels.getPlanes([(z, 0, 0) for z in range(image.getSizeZ())])
+
+    index = _label_index(planes)
+    file_ann_id = _save_label_index(conn, node_ann_ids, index, f"label_index_{image_id}")
+    print(f"Indexed {len(index['label'])} objects of image {image_id} in file annotation {file_ann_id}")
+    return file_ann_id
+
+
+def get_label_index(conn, node_ann_id):
+    """Load the label index linked to a node annotation.
+
+    Returns a dict of arrays as computed by `build_label_index`, or None if the node has no index.
+    """
+    file_ann_ids = _child_annotations(conn, [node_ann_id], NS_LABEL_INDEX)[node_ann_id]
+    if not file_ann_ids:
+        return None
+    file_ann = conn.getObject("FileAnnotation", file_ann_ids[-1])
+    buffer = io.BytesIO()
+    for chunk in file_ann.getFileInChunks():
+        buffer.write(chunk)
+    buffer.seek(0)
+    with np.load(buffer) as data:
+        return {key: data[key] for key in data.files}
+
+
+def get_object_bbox(index, label):
+    """Bounding box (z0, y0, x0, z1, y1, x1) of a label in an index, or None if it does not exist."""
+    row = np.searchsorted(index["label"], label)
+    if row == len(index["label"]) or index["label"][row] != label:
+        return None
+    return tuple(int(v) for v in index["bbox"][row])
+
+
+def read_object(conn, image_id, index, label):
+    """Read the part of a label image covered by the bounding box of one object.
+
+    Only the tiles of the bounding box are requested from the server.
+    Returns the (Z, Y, X) crop, or None if the label is not in the index.
+    """
+    bbox = get_object_bbox(index, label)
+    if bbox is None:
+        return None
+    z0, y0, x0, z1, y1, x1 = bbox
+    pixels = conn.getObject("Image", image_id).getPrimaryPixels()
+    tiles = pixels.getTiles([(z, 0, 0, (x0, y0, x1 - x0, y1 - y0)) for z in range(z0, z1)])
+    return np.stack(list(tiles))
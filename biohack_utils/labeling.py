@@ -0,0 +1,262 @@
+"""Out-of-core connected component labelling for label uploads.
+
+`label_blockwise` labels a volume block by block, in parallel, and merges the
+components that touch across block faces with the connected components of the
+graph of face pairs.
+The result is a lazy `RelabelledVolume` that can be streamed into
+`util._upload_volume_tiled` without ever holding the full volume in memory.
+"""
+import itertools
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from biohack_utils.util import _open_lazy
+
+
+# Label data types supported by OMERO, from small to large.
+_LABEL_DTYPES = (np.uint8, np.uint16, np.uint32)
+# Default memory shared by the workers labelling blocks, and the largest default block size per axis.
+DEFAULT_MEMORY_BUDGET = 2 * 1024 ** 3
+_MAX_BLOCK_SIZE = 512
+# Bytes per voxel of a block while it is labelled, on top of the source data:
+# the int64 labels of skimage and their uint32 copy.
+_LABEL_BYTES_PER_VOXEL = 12
+
+
+def _smallest_label_dtype(max_label):
+    """The smallest unsigned integer type supported by OMERO that holds `max_label`."""
+    for dtype in _LABEL_DTYPES:
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"{max_label} labels do not fit into a pixel type supported by OMERO.")
+
+
+def _default_block_shape(shape, itemsize, n_workers, memory_budget):
+    """Cubic blocks of at most `_MAX_BLOCK_SIZE` per axis, such that `n_workers` blocks fit into the budget."""
+    voxels = memory_budget / n_workers / (itemsize + _LABEL_BYTES_PER_VOXEL)
+    size = int(max(min(voxels ** (1 / len(shape)), _MAX_BLOCK_SIZE), 1))
+    return (size,) * len(shape)
+
+
+def _block_slices(shape, block_shape):
+    """Grid index and slices of all blocks."""
+    grid = [range(0, size, block) for size, block in zip(shape, block_shape)]
+    for start in itertools.product(*grid):
+        index = tuple(s // b for s, b in zip(start, block_shape))
+        yield index, tuple(slice(s, min(s + b, size)) for s, b, size in zip(start, block_shape, shape))
+
+
+def _label_block(source, labels_path, slices, connectivity):
+    """Label one block and write the local labels to the memory-mapped result."""
+    from skimage.measure import label
+
+    if isinstance(source, str):
+        source = _open_lazy(source)
+    block, n_labels = label(np.asarray(source[slices]), connectivity=connectivity, return_num=True)
+    labels = np.load(labels_path, mmap_mode="r+")
+    labels[slices] = block
+    labels.flush()
+    return n_labels
+
+
+def _read_global(labels, offsets, block_shape, slices):
+    """Read labels[slices] with the label offset of every block applied."""
+    out = np.asarray(labels[slices]).astype(np.uint64)
+    ranges = [range(s.start // b, (s.stop - 1) // b + 1) for s, b in zip(slices, block_shape)]
+    for index in itertools.product(*ranges):
+        sub = tuple(
+            slice(max(i * b, s.start) - s.start, min((i + 1) * b, s.stop) - s.start)
+            for i, b, s in zip(index, block_shape, slices)
+        )
+        view = out[sub]
+        view[view > 0] += offsets[index]
+    return out
+
+
+def _neighbour_shifts(ndim, connectivity):
+    """Offsets within a face that connect two voxels on opposite sides of it."""
+    max_shifted = ndim - 1 if connectivity is None else connectivity - 1
+    return [
+        shift for shift in itertools.product((-1, 0, 1), repeat=ndim - 1)
+        if sum(s != 0 for s in shift) <= max_shifted
+    ]
+
+
+def _read_plane(source, labels, offsets, block_shape, axis, position, tile, shape, halo=0):
+    """Values and global labels of the plane at `position` along `axis`, restricted to `tile`.
+
+    With a halo the tile is extended by that many voxels on both sides, zero-padded outside the volume.
+    """
+    ext = tuple(slice(max(s.start - halo, 0), min(s.stop + halo, size)) for s, size in zip(tile, shape))
+    slices = ext[:axis] + (slice(position, position + 1),) + ext[axis:]
+    values = np.squeeze(np.asarray(source[slices]), axis=axis)
+    global_labels = np.squeeze(_read_global(labels, offsets, block_shape, slices), axis=axis)
+    if halo == 0:
+        return values, global_labels
+
+    padded_shape = tuple(s.stop - s.start + 2 * halo for s in tile)
+    dst = tuple(slice(e.start - s.start + halo, e.stop - s.start + halo) for e, s in zip(ext, tile))
+    padded_values, padded_labels = np.zeros(padded_shape, values.dtype), np.zeros(padded_shape, np.uint64)
+    padded_values[dst], padded_labels[dst] = values, global_labels
+    return padded_values, padded_labels
+
+
+def _face_pairs(source, labels, offsets, block_shape, shape, connectivity):
+    """Yield arrays of global label pairs that are connected across a block face."""
+    ndim = len(shape)
+    shifts = _neighbour_shifts(ndim, connectivity)
+    for axis in range(ndim):
+        face_shape = shape[:axis] + shape[axis + 1:]
+        face_blocks = block_shape[:axis] + block_shape[axis + 1:]
+        for boundary in range(block_shape[axis], shape[axis], block_shape[axis]):
+            # The face is processed in tiles of the block size, reading a one voxel halo
+            # on the far side to catch diagonal connections between neighbouring tiles.
+            for _, tile in _block_slices(face_shape, face_blocks):
+                near_val, near_lab = _read_plane(
+                    source, labels, offsets, block_shape, axis, boundary - 1, tile, face_shape
+                )
+                far_val, far_lab = _read_plane(
+                    source, labels, offsets, block_shape, axis, boundary, tile, face_shape, halo=1
+                )
+                for shift in shifts:
+                    sub = tuple(slice(1 + d, 1 + d + n) for d, n in zip(shift, near_lab.shape))
+                    lab, val = far_lab[sub], far_val[sub]
+                    mask = (near_lab > 0) & (lab > 0) & (near_val == val)
+                    if mask.any():
+                        yield np.stack([near_lab[mask], lab[mask]], axis=1)
+
+
+def _relabel_table(n_total, pairs):
+    """Connected components of the graph of all block-local labels and their face pairs.
+    Returns the table mapping the labels to consecutive labels.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    n_nodes = n_total + 1
+    graph = coo_matrix(
+        (np.ones(len(pairs), dtype=np.int8), (pairs[:, 0].astype(np.intp), pairs[:, 1].astype(np.intp))),
+        shape=(n_nodes, n_nodes),
+    )
+    _, components = connected_components(graph, directed=False)
+
+    # Number the components in the order of their smallest label, so background stays 0.
+    _, first = np.unique(components, return_index=True)
+    order = np.empty(len(first), dtype=np.uint64)
+    order[np.argsort(first)] = np.arange(len(first), dtype=np.uint64)
+    return order[components]
+
+
+class RelabelledVolume:
+    """Lazy, read-only view of a blockwise labelled volume.
+
+    Indexing reads the block-local labels from the temporary memory-mapped file
+    and maps them to their final label.
+    """
+    def __init__(self, labels, offsets, block_shape, table, tmp_dir):
+        self._labels = labels
+        self._offsets = offsets
+        self._block_shape = block_shape
+        self._table = table
+        self._tmp_dir = tmp_dir
+        self.shape = labels.shape
+        self.ndim = labels.ndim
+        self.n_labels = int(table.max()) if table.size else 0
+        self.dtype = _smallest_label_dtype(self.n_labels)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        slices, squeeze = [], []
+        for axis, (k, size) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step != 1:
+                    raise IndexError("Only contiguous slices are supported.")
+                slices.append(slice(start, max(stop, start)))
+            else:
+                k = k + size if k < 0 else k
+                slices.append(slice(k, k + 1))
+                squeeze.append(axis)
+        data = self._table[_read_global(self._labels, self._offsets, self._block_shape, tuple(slices))]
+        return np.squeeze(data, axis=tuple(squeeze)).astype(self.dtype)
+
+    def __array__(self, dtype=None):
+        data = self[...] if self.ndim == 0 else self[tuple(slice(None) for _ in range(self.ndim))]
+        return data if dtype is None else data.astype(dtype)
+
+    def close(self):
+        """Remove the temporary files."""
+        self._labels = None
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def label_blockwise(
+    source, block_shape=None, connectivity=None, n_workers=None, tmp_dir=None, memory_budget=DEFAULT_MEMORY_BUDGET,
+):
+    """Connected component labelling of a volume that does not fit into memory.
+
+    Same result as `skimage.measure.label(source)` (up to the order of the labels):
+    neighbouring voxels with the same non-zero value are one component.
+
+    Args:
+        source: Path to a TIFF or Zarr array, or an array-like that is sliced lazily.
+            For a path the blocks are labelled in a process pool, otherwise in threads.
+        block_shape: Shape of the blocks labelled independently. Defaults to the largest
+            cubic blocks, up to 512 per axis, of which `n_workers` fit into `memory_budget`.
+        connectivity: Maximal number of orthogonal hops between neighbours, as in skimage.
+            Defaults to full connectivity.
+        n_workers: Number of parallel workers. Defaults to the number of CPUs.
+        tmp_dir: Directory for the temporary block labels, which are the size of the volume in uint32.
+        memory_budget: Bytes of memory for the blocks labelled at the same time, used for the default `block_shape`.
+
+    Returns:
+        The lazily relabelled volume. Its `dtype` is the smallest safe label type
+        and `n_labels` the number of components. Call `close()` to remove its temporary files.
+    """
+    array = _open_lazy(source) if isinstance(source, str) else source
+    shape = tuple(array.shape)
+    n_workers = n_workers or os.cpu_count()
+    if block_shape is None:
+        block_shape = _default_block_shape(shape, np.dtype(array.dtype).itemsize, n_workers, memory_budget)
+    block_shape = tuple(min(b, s) for b, s in zip(block_shape, shape))
+
+    tmp_dir = tempfile.mkdtemp(dir=tmp_dir, prefix="label_blockwise_")
+    labels_path = os.path.join(tmp_dir, "labels.npy")
+    np.lib.format.open_memmap(labels_path, mode="w+", dtype=np.uint32, shape=shape).flush()
+
+    blocks = list(_block_slices(shape, block_shape))
+    executor = ProcessPoolExecutor if isinstance(source, str) else ThreadPoolExecutor
+    with executor(max_workers=n_workers) as pool:
+        counts = list(pool.map(
+            _label_block, itertools.repeat(source), itertools.repeat(labels_path),
+            [slices for _, slices in blocks], itertools.repeat(connectivity),
+        ))
+
+    grid = tuple(len(range(0, s, b)) for s, b in zip(shape, block_shape))
+    counts = np.array(counts, dtype=np.uint64).reshape(grid)
+    offsets = (np.cumsum(counts) - counts.ravel()).reshape(grid)
+    n_total = int(counts.sum())
+
+    labels = np.load(labels_path, mmap_mode="r")
+    face_pairs = list(_face_pairs(array, labels, offsets, block_shape, shape, connectivity))
+    pairs = np.unique(np.concatenate(face_pairs), axis=0) if face_pairs else np.zeros((0, 2), dtype=np.uint64)
+    table = _relabel_table(n_total, pairs)
+
+    volume = RelabelledVolume(labels, offsets, block_shape, table, tmp_dir)
+    print(
+        f"Labelled {len(blocks)} blocks: {n_total} block-local components, "
+        f"{volume.n_labels} after merging {len(pairs)} face pairs, dtype {volume.dtype}"
+    )
+    return volume
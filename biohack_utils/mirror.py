@@ -0,0 +1,256 @@
+"""Local SQLite mirror of the collection graph.
+
+The mirror holds the collection and node annotations, their key-value pairs,
+the source edges between nodes and the image links of both namespaces. It is
+synced incrementally: only annotations updated and links created after the
+last synced server event are fetched, and deletions are detected from the
+list of IDs. Lookups like `_get_collections(conn, image_id, mirror=mirror)`
+are then answered locally without any server call.
+"""
+import sqlite3
+import threading
+
+from biohack_utils.omero_annotation import NS_COLLECTION, NS_NODE, _pick_node_info
+from biohack_utils.queries import (
+    CHANGED_MAP_ANNOTATIONS, IMAGE_LINK_IDS, MAP_ANNOTATION_IDS, NEW_IMAGE_LINKS, _chunks, _params, _projection,
+)
+
+
+# Upper bound for the number of ids bound to a single SQLite `IN` clause.
+_SQL_CHUNK_SIZE = 500
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS collections (
+    ann_id INTEGER PRIMARY KEY,
+    name TEXT,
+    version TEXT
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    ann_id INTEGER PRIMARY KEY,
+    collection_id INTEGER,
+    name TEXT,
+    path TEXT,
+    category TEXT,
+    origin TEXT
+);
+CREATE INDEX IF NOT EXISTS nodes_collection ON nodes (collection_id);
+CREATE TABLE IF NOT EXISTS attributes (
+    ann_id INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (ann_id, idx)
+);
+CREATE TABLE IF NOT EXISTS sources (
+    node_id INTEGER NOT NULL,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sources_node ON sources (node_id);
+CREATE INDEX IF NOT EXISTS sources_source ON sources (source);
+CREATE TABLE IF NOT EXISTS links (
+    link_id INTEGER PRIMARY KEY,
+    image_id INTEGER NOT NULL,
+    ann_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS links_image ON links (image_id);
+CREATE INDEX IF NOT EXISTS links_ann ON links (ann_id);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+
+class CollectionMirror:
+    """SQLite mirror of the `ome/collection` and `ome/collection/nodes` annotations.
+
+    Args:
+        path: Path of the SQLite file, or ":memory:" for a mirror that is not persisted.
+    """
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def _query(self, query, params=()):
+        with self._lock:
+            return self._db.execute(query, params).fetchall()
+
+    @property
+    def last_event(self):
+        """ID of the last server event included in the mirror."""
+        rows = self._query("SELECT value FROM state WHERE key = 'last_event'")
+        return rows[0][0] if rows else 0
+
+    def sync(self, conn):
+        """Fetch the annotations and links changed since the last sync and drop deleted ones.
+
+        Changes are found by their update or creation event, deletions by comparing
+        against the IDs on the server, which is a single ID-only query per kind.
+
+        Returns a dict with the number of updated annotations, new links and removed objects.
+        """
+        namespaces = [NS_COLLECTION, NS_NODE]
+        since = self.last_event
+
+        changed = {}
+        for ann_id, ns, event, key, value in _projection(
+            conn, CHANGED_MAP_ANNOTATIONS, _params(nss=namespaces, since=since)
+        ):
+            entry = changed.setdefault(ann_id, (ns, []))
+            if key is not None:
+                entry[1].append((key, value))
+            since = max(since, event)
+
+        new_links = []
+        for link_id, image_id, ann_id, event in _projection(
+            conn, NEW_IMAGE_LINKS, _params(nss=namespaces, since=self.last_event)
+        ):
+            new_links.append((link_id, image_id, ann_id))
+            since = max(since, event)
+
+        ann_ids = {row[0] for row in _projection(conn, MAP_ANNOTATION_IDS, _params(nss=namespaces))}
+        link_ids = {row[0] for row in _projection(conn, IMAGE_LINK_IDS, _params(nss=namespaces))}
+
+        with self._lock:
+            db = self._db
+            removed_anns = [
+                (ann_id,) for (ann_id,) in db.execute("SELECT ann_id FROM collections UNION SELECT ann_id FROM nodes")
+                if ann_id not in ann_ids
+            ]
+            removed_links = [(link_id,) for (link_id,) in db.execute("SELECT link_id FROM links") if link_id not in link_ids]
+            # Changed annotations are replaced, their links stay.
+            for table, column in (("collections", "ann_id"), ("nodes", "ann_id"), ("attributes", "ann_id"),
+                                  ("sources", "node_id")):
+                db.executemany(f"DELETE FROM {table} WHERE {column} = ?", removed_anns + [(i,) for i in changed])
+            db.executemany("DELETE FROM links WHERE ann_id = ?", removed_anns)
+            db.executemany("DELETE FROM links WHERE link_id = ?", removed_links)
+
+            for ann_id, (ns, values) in changed.items():
+                kv = dict(values)
+                if ns == NS_COLLECTION:
+                    db.execute(
+                        "INSERT INTO collections VALUES (?, ?, ?)", (ann_id, kv.get("name"), kv.get("version"))
+                    )
+                else:
+                    coll_id = kv.get("collection_id")
+                    db.execute(
+                        "INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?)",
+                        (ann_id, int(coll_id) if coll_id and coll_id.isdigit() else None, kv.get("name"),
+                         kv.get("path"), kv.get("category"), kv.get("origin")),
+                    )
+                    if kv.get("source"):
+                        db.executemany(
+                            "INSERT INTO sources VALUES (?, ?)", [(ann_id, src) for src in kv["source"].split(",")]
+                        )
+                db.executemany(
+                    "INSERT INTO attributes VALUES (?, ?, ?, ?)",
+                    [(ann_id, idx, key, value) for idx, (key, value) in enumerate(values)],
+                )
+
+            db.executemany("INSERT OR REPLACE INTO links VALUES (?, ?, ?)", new_links)
+            db.execute("INSERT OR REPLACE INTO state VALUES ('last_event', ?)", (since,))
+            db.commit()
+
+        summary = {
+            "annotations": len(changed), "links": len(new_links),
+            "removed_annotations": len(removed_anns), "removed_links": len(removed_links),
+        }
+        print(
+            f"Synced mirror {self.path}: {summary['annotations']} annotations, {summary['links']} new links, "
+            f"removed {summary['removed_annotations']} annotations and {summary['removed_links']} links"
+        )
+        return summary
+
+    def _attributes(self, ann_ids):
+        result = {ann_id: {} for ann_id in ann_ids}
+        for chunk in _chunks(list(result), _SQL_CHUNK_SIZE):
+            marks = ",".join("?" * len(chunk))
+            for ann_id, key, value in self._query(
+                f"SELECT ann_id, key, value FROM attributes WHERE ann_id IN ({marks}) ORDER BY ann_id, idx", chunk
+            ):
+                result[ann_id][key] = value
+        return result
+
+    def collection_ids(self, image_id):
+        """IDs of the collections an image is linked to."""
+        return [row[0] for row in self._query(
+            "SELECT c.ann_id FROM links l JOIN collections c ON c.ann_id = l.ann_id WHERE l.image_id = ? "
+            "ORDER BY c.ann_id", (image_id,)
+        )]
+
+    def node_info(self, image_id):
+        """Key-value pairs of the first node annotation of an image, or None."""
+        rows = self._query(
+            "SELECT n.ann_id FROM links l JOIN nodes n ON n.ann_id = l.ann_id WHERE l.image_id = ? "
+            "ORDER BY n.ann_id LIMIT 1", (image_id,)
+        )
+        return self._attributes([rows[0][0]])[rows[0][0]] if rows else None
+
+    def collections(self, image_id):
+        """All collections of an image, in the format of `omero_annotation._get_collections`."""
+        result = []
+        for coll_id in self.collection_ids(image_id):
+            name, version = self._query("SELECT name, version FROM collections WHERE ann_id = ?", (coll_id,))[0]
+            member_ids = [row[0] for row in self._query(
+                "SELECT image_id FROM links WHERE ann_id = ? ORDER BY image_id", (coll_id,)
+            )]
+            node_rows = self._query(
+                "SELECT l.image_id, n.ann_id FROM links c JOIN links l ON l.image_id = c.image_id "
+                "JOIN nodes n ON n.ann_id = l.ann_id WHERE c.ann_id = ? ORDER BY n.ann_id", (coll_id,)
+            )
+            attributes = self._attributes([ann_id for _, ann_id in node_rows])
+            node_anns = {}
+            for member_id, ann_id in node_rows:
+                node_anns.setdefault(member_id, {})[ann_id] = attributes[ann_id]
+            result.append({
+                "collection_id": coll_id,
+                "name": name,
+                "version": version,
+                "members": [
+                    {"image_id": mid, "nodes": _pick_node_info(node_anns.get(mid), coll_id)} for mid in member_ids
+                ],
+            })
+        return result
+
+    def nodes(self):
+        """All node annotations, in the format of `queries._map_values_by_ns`:
+        a dict {annotation_id: (image_id, {key: value})}.
+        """
+        rows = self._query(
+            "SELECT n.ann_id, l.image_id FROM nodes n JOIN links l ON l.ann_id = n.ann_id ORDER BY n.ann_id"
+        )
+        attributes = self._attributes([ann_id for ann_id, _ in rows])
+        return {ann_id: (image_id, attributes[ann_id]) for ann_id, image_id in rows}
+
+    def derived_nodes(self, source, collection_id=None):
+        """Nodes whose `source` is the given node name, optionally within one collection.
+
+        Returns a list of dicts with the image ID, collection ID and node key-value pairs.
+        """
+        query = (
+            "SELECT l.image_id, n.collection_id, n.ann_id FROM sources s "
+            "JOIN nodes n ON n.ann_id = s.node_id JOIN links l ON l.ann_id = n.ann_id WHERE s.source = ?"
+        )
+        params = [source]
+        if collection_id is not None:
+            query += " AND n.collection_id = ?"
+            params.append(collection_id)
+        rows = self._query(query + " ORDER BY n.ann_id", params)
+        attributes = self._attributes([ann_id for _, _, ann_id in rows])
+        return [
+            {"image_id": image_id, "collection_id": coll_id, "nodes": attributes[ann_id]}
+            for image_id, coll_id, ann_id in rows
+        ]
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -3,9 +3,41 @@ import json
 from omero.rtypes import rstring
 from omero.model import MapAnnotationI, NamedValue
 
+from biohack_utils.cache import CollectionCache
+from biohack_utils.queries import (
+    _collection_images_in_dataset, _images_by_annotation, _map_annotations_by_image, _map_values_by_image,
+)
+
 
 NS_COLLECTION = "ome/collection"
 NS_NODE = "ome/collection/nodes"
+NS_LABEL_INDEX = "ome/collection/nodes/label_index"
+
+# Opt-in cache for collection lookups, see `enable_cache`.
+_cache = None
+
+
+def enable_cache(maxsize=1024, ttl=300.0):
+    """Cache the results of `_get_collections` and `_get_node_info` on the client.
+
+    Entries are evicted least-recently-used beyond `maxsize` and expire after
+    `ttl` seconds. The write helpers in this module and `config_utils.upload`
+    invalidate the entries of the images and collections they modify.
+    Returns the cache, e.g. to inspect its hit/miss counters via `stats()`.
+    """
+    global _cache
+    _cache = CollectionCache(maxsize=maxsize, ttl=ttl)
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+
+def _invalidate_cache(image_ids=(), collection_ids=()):
+    if _cache is not None:
+        _cache.invalidate(image_ids=image_ids, collection_ids=collection_ids)
 
 
 def _build_image_url(image_id):
@@ -59,6 +91,51 @@ def _append_link_to_node_annotation(conn, image_id, link):
 
     update_service = conn.getUpdateService()
     update_service.saveObject(iann)
+    _invalidate_cache(image_ids=[image_id])
+
+
+def _append_links_to_node_annotations(conn, links_by_image, collection_ann_id=None):
+    """Append links to the 'attributes.link' field of the node annotations of many images.
+
+    All node annotations are loaded with one query and saved with a single `saveArray`
+    call. For every image the node annotation of `collection_ann_id` is updated, or the
+    first one if it is not given or the image has none of this collection.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        links_by_image: Dict {image_id: [link, ...]}.
+        collection_ann_id: The collection whose node annotations are updated.
+    """
+    node_anns = _map_annotations_by_image(conn, list(links_by_image), NS_NODE)
+
+    updated = []
+    for image_id, new_links in links_by_image.items():
+        anns = node_anns.get(image_id)
+        if not anns:
+            raise RuntimeError(
+                f"No node annotation (ns={NS_NODE}) found for Image {image_id}"
+            )
+        kvs = [{nv.name: nv.value for nv in ann.getMapValue() or []} for ann in anns]
+        index = next(
+            (i for i, kv in enumerate(kvs) if kv.get("collection_id") == str(collection_ann_id)), 0
+        )
+        node_ann, kv = anns[index], kvs[index]
+
+        raw_links = kv.get("attributes.link")
+        if raw_links is None:
+            links = []
+        else:
+            links = json.loads(raw_links)
+            if not isinstance(links, list):
+                links = [str(links)]
+        links.extend(link for link in dict.fromkeys(new_links) if link not in links)
+
+        kv["attributes.link"] = json.dumps(links)
+        node_ann.setMapValue([NamedValue(str(k), str(v)) for k, v in kv.items()])
+        updated.append(node_ann)
+
+    conn.getUpdateService().saveArray(updated, conn.SERVICE_OPTS)
+    _invalidate_cache(image_ids=list(links_by_image))
 
 
 def _map_ann_to_dict(ann):
@@ -83,7 +160,9 @@ def _create_collection(conn, name, version="0.x"):
     update_service = conn.getUpdateService()
     saved = update_service.saveAndReturnObject(map_annotation)
 
-    return saved.getId().getValue()
+    collection_ann_id = saved.getId().getValue()
+    _invalidate_cache(collection_ids=[collection_ann_id])
+    return collection_ann_id
 
 
 def _link_collection_to_image(conn, collection_ann_id, image_id):
@@ -98,6 +177,7 @@ def _link_collection_to_image(conn, collection_ann_id, image_id):
         raise ValueError("Annotation {} not found".format(collection_ann_id))
 
     image.linkAnnotation(annotation)
+    _invalidate_cache(image_ids=[image_id], collection_ids=[collection_ann_id])
 
 
 def _create_map_annotation(conn, kv, namespace):
@@ -137,6 +217,7 @@ def _add_node_annotation(
 
     ann = _create_map_annotation(conn, kv, NS_NODE)
     image.linkAnnotation(ann)
+    _invalidate_cache(image_ids=[image_id], collection_ids=[collection_ann_id])
     return ann.getId()
 
 
@@ -147,42 +228,101 @@ def _get_collection_members(conn, collection_ann_id):
     return [img.getId() for img in images]
 
 
-def _get_node_info(conn, image_id):
+def _get_node_info(conn, image_id, mirror=None):
     """Get the node annotation (first one) for an image.
     Returns a dict or None.
+
+    With a `mirror.CollectionMirror` the lookup is answered from the local mirror.
     """
-    img = conn.getObject("Image", image_id)
-    if img is None:
+    if mirror is not None:
+        return mirror.node_info(image_id)
+
+    if _cache is not None:
+        hit, node_info = _cache.lookup(("node_info", image_id))
+        if hit:
+            return node_info
+
+    node_info = None
+    for nodes in get_node_infos(conn, [image_id])[image_id].values():
+        node_info = nodes[0]
+        break
+
+    if _cache is not None:
+        _cache.store(("node_info", image_id), node_info, image_ids=[image_id])
+    return node_info
+
+
+def get_node_infos(conn, image_ids, collection_id=None):
+    """Get the node annotations of many images at once.
+
+    The annotations are fetched with chunked `IN (:ids)` queries, a single
+    round trip per thousand images.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        image_ids: The image IDs.
+        collection_id: Only return the node annotations of this collection.
+    Returns:
+        A dict {image_id: {collection_id: [node dict, ...]}} with an entry for every
+        requested image, ordered by annotation ID. Collection IDs are ints, and None
+        for node annotations without one.
+    """
+    image_ids = [int(iid) for iid in image_ids]
+    node_anns = _map_values_by_image(conn, image_ids, NS_NODE)
+
+    result = {}
+    for image_id in image_ids:
+        by_collection = result.setdefault(image_id, {})
+        for kv in node_anns.get(image_id, {}).values():
+            coll_id = kv.get("collection_id")
+            if coll_id is not None and coll_id.isdigit():
+                coll_id = int(coll_id)
+            if collection_id is None or coll_id == int(collection_id):
+                by_collection.setdefault(coll_id, []).append(kv)
+    return result
+
+
+def _pick_node_info(node_anns, collection_ann_id):
+    """Pick the node annotation of an image that belongs to the given collection,
+    falling back to the first one. Returns a dict or None.
+    """
+    if not node_anns:
         return None
+    for kv in node_anns.values():
+        if kv.get("collection_id") == str(collection_ann_id):
+            return kv
+    return next(iter(node_anns.values()))
 
-    anns = list(img.listAnnotations(ns=NS_NODE))
-    for ann in anns:
-        return _map_ann_to_dict(ann)
-    return None
 
-
-def _get_collections(conn, image_id):
+def _get_collections(conn, image_id, mirror=None):
     """Get all collections an image is part of.
     Returns a list of dicts of how collections metadata should look like.
+
+    The collection annotations, their members and the members' node annotations
+    are each resolved with a single (chunked) query, independent of the number of members.
+    With a `mirror.CollectionMirror` the lookup is answered from the local mirror.
     """
-    img = conn.getObject("Image", image_id)
-    if img is None:
-        return []
+    if mirror is not None:
+        return mirror.collections(image_id)
 
-    coll_anns = list(img.listAnnotations(ns=NS_COLLECTION))
+    if _cache is not None:
+        hit, collections = _cache.lookup(("collections", image_id))
+        if hit:
+            return collections
 
-    collections = []
-    for coll_ann in coll_anns:
-        coll_ann_id = coll_ann.getId()
-        coll_info = _map_ann_to_dict(coll_ann)
+    coll_anns = _map_values_by_image(conn, [image_id], NS_COLLECTION).get(image_id, {})
+
+    members_by_coll = _images_by_annotation(conn, list(coll_anns))
+    all_member_ids = {mid for member_ids in members_by_coll.values() for mid in member_ids}
+    node_anns = _map_values_by_image(conn, all_member_ids, NS_NODE)
 
-        member_ids = _get_collection_members(conn, coll_ann_id)
+    collections = []
+    for coll_ann_id, coll_info in coll_anns.items():
         members = []
-        for member_id in member_ids:
-            node_info = _get_node_info(conn, member_id)
+        for member_id in members_by_coll[coll_ann_id]:
             members.append({
                 "image_id": member_id,
-                "nodes": node_info,
+                "nodes": _pick_node_info(node_anns.get(member_id), coll_ann_id),
             })
 
         collections.append({
@@ -192,16 +332,22 @@ def _get_collections(conn, image_id):
             "members": members,
         })
 
+    if _cache is not None:
+        _cache.store(
+            ("collections", image_id), collections,
+            image_ids=[image_id, *all_member_ids], collection_ids=list(coll_anns),
+        )
     return collections
 
 
-def _find_related_images(conn, image_id, node_type=None):
+def _find_related_images(conn, image_id, node_type=None, mirror=None):
     """Given an image, find all related images in the same collection(s).
-    Optionally filter by node_type (e.g., "label", "multiscale").
+    Optionally filter by the category of their node, node_type (e.g., "intensities", "annotations").
+    With a `mirror.CollectionMirror` the lookup is answered from the local mirror.
 
     Returns list of dicts
     """
-    collections = _get_collections(conn, image_id)
+    collections = _get_collections(conn, image_id, mirror=mirror)
 
     related = []
     for coll in collections:
@@ -211,7 +357,7 @@ def _find_related_images(conn, image_id, node_type=None):
             if mid == image_id:
                 continue
             node_info = member["nodes"]
-            if node_type is None or (node_info and node_info.get("type") == node_type):
+            if node_type is None or (node_info and node_info.get("category") == node_type):
                 related.append({
                     "image_id": mid,
                     "collection_id": coll_id,
@@ -230,55 +376,33 @@ def _find_images_with_collection_id_in_dataset(
 ):
     """
     Find images in a given dataset that are members of a collection
-    (identified by collection_id) and optionally have a given node_type.
+    (identified by collection_id) and optionally have a node of the given
+    category (node_type) in that collection.
+
+    Dataset, collection and category are all filtered on the server in a single
+    paged query, and at most `limit` images are fetched.
 
     Returns a list of tuples:
         (image_id, image_name, collection_id)
     where collection_id is the collection annotation ID.
     """
-    dataset = conn.getObject("Dataset", dataset_id)
-    if dataset is None:
-        print(f"Dataset {dataset_id} not found")
-        return []
-
     collection_id = int(collection_id)
-
-    # All members of this collection
-    member_ids = set(_get_collection_members(conn, collection_id))
-
-    # All images in the dataset
-    dataset_images = list(dataset.listChildren())
-    dataset_by_id = {img.getId(): img for img in dataset_images}
-
-    images = []
-    for mid in member_ids:
-        if mid not in dataset_by_id:
-            continue
-
-        if limit is not None and len(images) >= limit:
-            break
-
-        img = dataset_by_id[mid]
-
-        if node_type is not None:
-            node_info = _get_node_info(conn, mid)
-            if not node_info or node_info.get("type") != node_type:
-                continue
-
-        images.append((mid, img.getName(), collection_id))
-        print(
-            f"Match: Image ID={mid}, "
-            f"Name='{img.getName()}', "
-            f"Collection ID={collection_id}"
-        )
+    rows = _collection_images_in_dataset(
+        conn, collection_id, int(dataset_id), NS_NODE, category=node_type, limit=limit,
+    )
+    images = [(image_id, name, collection_id) for image_id, name in rows]
 
     print(f"Found {len(images)} images with collection_id={collection_id} in dataset {dataset_id}")
     return images
 
 
-def fetch_omero_labels_in_napari(conn, image_id, return_raw=False, label_node_type="Labels"):
+def fetch_omero_labels_in_napari(conn, image_id, return_raw=False, label_node_type="Labels", cache=None):
     """Fetch label data for a given raw image using collections/nodes.
 
+    With a `cache` (a `tile_cache.TileCache` or the path of its directory) the
+    lazy arrays read their tiles through the persistent local cache, so repeated
+    views do not fetch them from the server again.
+
     Returns the raw and label array data.
     """
     raw_img = conn.getObject("Image", image_id)
@@ -289,6 +413,15 @@ def fetch_omero_labels_in_napari(conn, image_id, return_raw=False, label_node_ty
     if not collections:
         raise RuntimeError("Image is not part of any collection (namespace NS_COLLECTION).")
 
+    if cache is None:
+        from napari_omero.plugins.loaders import get_data_lazy
+    else:
+        from biohack_utils.tile_cache import cached_lazy_array
+
+        # A cache given as path is opened by every lazy array and closed with it.
+        def get_data_lazy(img):
+            return cached_lazy_array(conn, img, cache)
+
     labels_dict = {}
 # hack this to make it compatible with different naming of the kpv
     if label_node_type == 'Labels':
@@ -321,7 +454,6 @@ def fetch_omero_labels_in_napari(conn, image_id, return_raw=False, label_node_ty
             node_name = node_info.get("name") or f"image_{mid}"
             print(f"Found label image: ID={mid}, node_name='{node_name}'")
 
-            from napari_omero.plugins.loaders import get_data_lazy
             label_array = get_data_lazy(img)
 
             labels_dict[node_name] = label_array
@@ -0,0 +1,295 @@
+"""Concurrent batch annotation of images in OMERO.
+
+The stages of the batch annotation workflow (download the image, segment it,
+upload the mask, create the collection) run in their own worker threads that
+are connected by bounded queues. Network transfers thus overlap with the
+segmentation, and a slow stage holds back the stages before it.
+"""
+import queue
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from biohack_utils.ConfigSchema import MultiscaleNode, NodeAttributes, OMECollection, OMEWrapper
+from biohack_utils.config_utils import _create_collection_annotation, _upload_records_bulk, flatten, upload
+from biohack_utils.omero_annotation import _invalidate_cache
+
+
+_DONE = object()
+
+
+def _join_session(conn):
+    """Open a new gateway that is joined to the session of `conn`."""
+    from omero.gateway import BlitzGateway
+
+    joined = BlitzGateway(host=conn.host, port=conn.port, secure=conn.secure)
+    if not joined.connect(sUuid=conn.c.getSessionId()):
+        raise RuntimeError("Could not join the OMERO session")
+    joined.SERVICE_OPTS.setOmeroGroup(conn.SERVICE_OPTS.getOmeroGroup())
+    return joined
+
+
+class SessionPool:
+    """Bounded pool of gateways joined to the session of an existing connection.
+
+    A BlitzGateway must not be used from several threads at once, so every
+    worker borrows its own gateway for the duration of a task.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        size: Maximal number of joined gateways.
+        factory: Function creating a new gateway from `conn`. Defaults to joining its session.
+    """
+    def __init__(self, conn, size=4, factory=None):
+        self._conn = conn
+        self._size = size
+        self._factory = _join_session if factory is None else factory
+        self._idle = queue.Queue()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def session(self):
+        """Borrow a gateway, waiting for one to be returned if the pool is exhausted."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = len(self._sessions) < self._size
+                if create:
+                    conn = self._factory(self._conn)
+                    self._sessions.append(conn)
+            if not create:
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        # Only close the joined gateways, not the session they share with the original connection.
+        for conn in self._sessions:
+            if conn is not self._conn:
+                conn.close(hard=False)
+        self._sessions.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _load_image(conn, image_id):
+    """Load the pixel data of an image as (T, Z, Y, X, C) array."""
+    import ezomero
+
+    _, image = ezomero.get_image(conn, image_id)
+    return image
+
+
+def _upload_mask(conn, mask, name, dataset_id=None):
+    """Upload a 2D (Y, X) or 3D (Z, Y, X) mask. Returns the image ID."""
+    planes = [mask] if mask.ndim == 2 else list(mask)
+    dataset = None if dataset_id is None else conn.getObject("Dataset", dataset_id)
+    image = conn.createImageFromNumpySeq(
+        iter(planes),
+        name,
+        sizeZ=len(planes),
+        sizeC=1,
+        sizeT=1,
+        dataset=dataset,
+        description="Segmentation mask",
+    )
+    return image.getId()
+
+
+def _annotate(conn, image_id, mask_id, collection_name, node_name, journal=None):
+    """Create a collection holding the source image and its mask. Returns the collection ID.
+
+    With a journal, a collection created by an earlier, interrupted run is completed instead.
+    """
+    source = MultiscaleNode(name="source_image", attributes=NodeAttributes(**{
+        "omero:image_id": image_id, "category": "intensities", "origin": "raw",
+        "description": "Original image",
+    }))
+    mask = MultiscaleNode(name=node_name, attributes=NodeAttributes(**{
+        "omero:image_id": mask_id, "category": "annotations", "origin": "masks",
+        "source": "source_image", "description": "Segmentation masks",
+    }))
+    wrapper = OMEWrapper(ome=OMECollection(name=collection_name, nodes=[source, mask]))
+    if journal is None:
+        return upload(conn, wrapper, bulk=True)
+
+    entry = journal.get(image_id)
+    coll_id = entry["collection_id"]
+    linked, described = journal.partial(image_id)
+    if coll_id is None:
+        coll_id = _create_collection_annotation(conn, wrapper.ome.name, wrapper.ome.version)
+        journal.record_collection(image_id, coll_id)
+        linked, described = set(), set()
+
+    records = [record for record in flatten(wrapper) if record["omero:image_id"] not in described]
+    _upload_records_bulk(conn, coll_id, records, linked_images=linked)
+    _invalidate_cache(image_ids=[image_id, mask_id], collection_ids=[coll_id])
+    journal.record_annotated(image_id)
+    return coll_id
+
+
+class _Stage:
+    """A pool of worker threads applying `func` to the items of `inbox`.
+
+    `func` gets an item (index, image_id, payload) and returns the new payload.
+    """
+    def __init__(self, name, func, inbox, outbox, n_workers, failed):
+        self.name = name
+        self._func = func
+        self._inbox = inbox
+        self._outbox = outbox
+        self._failed = failed
+        self._running = n_workers
+        self._lock = threading.Lock()
+        self.errors = []
+        self.threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True) for i in range(n_workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            item = self._inbox.get()
+            if item is _DONE:
+                # Let the other workers of this stage see the end of the input as well.
+                self._inbox.put(_DONE)
+                break
+            # After a failure the remaining items are only drained.
+            if self._failed.is_set():
+                continue
+            index, image_id, payload = item
+            try:
+                self._outbox.put((index, image_id, self._func(index, image_id, payload)))
+            except Exception as e:
+                self.errors.append((image_id, e))
+                self._failed.set()
+
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            self._outbox.put(_DONE)
+
+
+def run_batch_annotation(
+    conn,
+    image_ids,
+    segment,
+    dataset_id=None,
+    collection_name="micro_sam_segmentation",
+    node_name=None,
+    n_sessions=4,
+    workers=None,
+    queue_size=4,
+    session_factory=None,
+    journal=None,
+):
+    """Segment images and store the masks with a collection linking them to their source.
+
+    The images are downloaded, segmented, the masks uploaded and the collections
+    created concurrently. The stages are connected by queues of `queue_size` items,
+    so at most that many downloaded images or masks wait for the next stage.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        image_ids: The IDs of the images to segment.
+        segment: Function returning the mask for an image array of shape (T, Z, Y, X, C).
+        dataset_id: Dataset the masks are uploaded to.
+        collection_name: Name of the collection created for each image.
+        node_name: Node name of the masks in the collection. Defaults to `collection_name`.
+        n_sessions: Number of joined OMERO sessions shared by the download, upload and annotate stages.
+        workers: Number of workers per stage, e.g. {"download": 2, "segment": 1, "upload": 2, "annotate": 1}.
+        queue_size: Maximal number of items waiting between two stages.
+        session_factory: Function creating a new gateway from `conn`. Defaults to joining its session.
+        journal: An `AnnotationJournal` to make the run resumable. It is verified against the server
+            first, then images with an uploaded mask are not segmented again, finished images are skipped
+            and the collections of half-finished ones are completed.
+
+    Returns:
+        A list of dicts with "image_id", "mask_id" and "collection_id", in the order of `image_ids`.
+    """
+    node_name = collection_name if node_name is None else node_name
+    n_workers = {"download": 2, "segment": 1, "upload": 2, "annotate": 1}
+    n_workers.update(workers or {})
+
+    results = {}
+    if journal is not None:
+        journal.verify(conn, image_ids)
+        for index, image_id in enumerate(image_ids):
+            entry = journal.get(image_id)
+            if entry is not None and entry["annotated"]:
+                results[index] = {k: entry[k] for k in ("image_id", "mask_id", "collection_id")}
+
+    def journaled_mask(image_id):
+        entry = None if journal is None else journal.get(image_id)
+        return None if entry is None else entry["mask_id"]
+
+    with SessionPool(conn, n_sessions, factory=session_factory) as pool:
+
+        # Images whose mask is already uploaded pass the first stages with a None payload.
+        def download(index, image_id, _):
+            if journaled_mask(image_id) is not None:
+                return None
+            with pool.session() as session:
+                return _load_image(session, image_id)
+
+        def run_segmentation(index, image_id, image):
+            return None if image is None else np.asarray(segment(image))
+
+        def upload_mask(index, image_id, mask):
+            if mask is None:
+                return journaled_mask(image_id)
+            with pool.session() as session:
+                mask_id = _upload_mask(session, mask, f"segmentation_{image_id}", dataset_id)
+            if journal is not None:
+                journal.record_mask(image_id, mask_id)
+            return mask_id
+
+        def annotate(index, image_id, mask_id):
+            with pool.session() as session:
+                collection_id = _annotate(session, image_id, mask_id, collection_name, node_name, journal)
+            print(f"Annotated image {image_id}: mask {mask_id}, collection {collection_id}")
+            return {"image_id": image_id, "mask_id": mask_id, "collection_id": collection_id}
+
+        funcs = [("download", download), ("segment", run_segmentation), ("upload", upload_mask), ("annotate", annotate)]
+        queues = [queue.Queue(maxsize=queue_size) for _ in range(len(funcs))] + [queue.Queue()]
+        failed = threading.Event()
+        stages = [
+            _Stage(name, func, queues[i], queues[i + 1], n_workers[name], failed)
+            for i, (name, func) in enumerate(funcs)
+        ]
+        for stage in stages:
+            stage.start()
+
+        for index, image_id in enumerate(image_ids):
+            if failed.is_set():
+                break
+            if index not in results:
+                queues[0].put((index, image_id, None))
+        queues[0].put(_DONE)
+
+        while (item := queues[-1].get()) is not _DONE:
+            index, _, result = item
+            results[index] = result
+
+        for stage in stages:
+            for thread in stage.threads:
+                thread.join()
+
+    errors = [(stage.name, image_id, e) for stage in stages for image_id, e in stage.errors]
+    if errors:
+        stage_name, image_id, e = errors[0]
+        raise RuntimeError(f"Stage '{stage_name}' failed for image {image_id}") from e
+    return [results[index] for index in sorted(results)]
@@ -0,0 +1,121 @@
+"""Provenance graph of images, built from the `source` attributes of node annotations.
+
+Every derived node (e.g. a mask) names its source node, which is resolved
+within its collection like in `OMECollection.collection_errors`. The resulting
+edges between images of all collections are kept as adjacency lists keyed by
+image ID, so ancestor, descendant and lineage queries only visit their result.
+The graph is built from one bulk fetch of all node annotations, from the server
+or from a `mirror.CollectionMirror`.
+"""
+from biohack_utils.ConfigSchema import _resolve_source
+from biohack_utils.omero_annotation import NS_NODE
+from biohack_utils.queries import _map_values_by_collections, _map_values_by_ns
+
+
+class ProvenanceGraph:
+    """Graph of the images derived from each other.
+
+    Args:
+        node_anns: Dict {annotation_id: (image_id, {key: value})} of node annotations.
+    """
+    def __init__(self, node_anns):
+        self._sources = {}  # image id -> ids of the images it is derived from
+        self._derived = {}  # image id -> ids of the images derived from it
+        self.categories = {}  # image id -> categories of its nodes
+
+        collections = {}
+        for image_id, kv in node_anns.values():
+            collections.setdefault(kv.get("collection_id"), []).append((image_id, kv))
+            if kv.get("category"):
+                self.categories.setdefault(image_id, set()).add(kv["category"])
+
+        for nodes in collections.values():
+            images, records, parents, siblings, names = {}, {}, {}, {}, {}
+            for image_id, kv in nodes:
+                path = kv.get("path") or kv.get("name")
+                if path is None or path in images:
+                    continue
+                parent = path.rsplit("/", 1)[0] if "/" in path else ""
+                name = kv.get("name", path.rsplit("/", 1)[-1])
+                images[path], records[path], parents[path] = image_id, kv, parent
+                siblings[(parent, name)] = path
+                names.setdefault(name, []).append(path)
+
+            for path, kv in records.items():
+                if not kv.get("source"):
+                    continue
+                for source in kv["source"].split(","):
+                    resolved, _ = _resolve_source(source, parents[path], images, siblings, names)
+                    if resolved is not None:
+                        self._add_edge(images[resolved], images[path])
+
+    def _add_edge(self, source_id, image_id):
+        sources = self._sources.setdefault(image_id, [])
+        if source_id not in sources:
+            sources.append(source_id)
+            self._derived.setdefault(source_id, []).append(image_id)
+
+    @classmethod
+    def from_server(cls, conn, collection_ids=None):
+        """Build the graph from all node annotations on the server, or those of the given collections.
+
+        All node annotations are fetched with one paged query, chunked by collection ID if given.
+        """
+        if collection_ids is None:
+            return cls(_map_values_by_ns(conn, NS_NODE))
+        return cls(_map_values_by_collections(conn, collection_ids, NS_NODE))
+
+    @classmethod
+    def from_mirror(cls, mirror):
+        """Build the graph from the node annotations of a synced `mirror.CollectionMirror`."""
+        return cls(mirror.nodes())
+
+    def sources(self, image_id):
+        """IDs of the images an image is directly derived from."""
+        return list(self._sources.get(image_id, ()))
+
+    def derived(self, image_id):
+        """IDs of the images directly derived from an image."""
+        return list(self._derived.get(image_id, ()))
+
+    def _walk(self, image_id, edges, category):
+        seen = {image_id}
+        queue = [image_id]
+        result = []
+        for current in queue:
+            for other in edges.get(current, ()):
+                if other in seen:
+                    continue
+                seen.add(other)
+                queue.append(other)
+                if category is None or category in self.categories.get(other, ()):
+                    result.append(other)
+        return result
+
+    def ancestors(self, image_id, category=None):
+        """IDs of all images an image is transitively derived from, nearest first.
+
+        Optionally only images with a node of the given category, e.g. "intensities".
+        """
+        return self._walk(image_id, self._sources, category)
+
+    def descendants(self, image_id, category=None):
+        """IDs of all images transitively derived from an image, nearest first.
+
+        Optionally only images with a node of the given category, e.g. "annotations" for all masks.
+        """
+        return self._walk(image_id, self._derived, category)
+
+    def lineage(self, image_id):
+        """All derivation paths leading to an image, as lists of image IDs
+        from an image without sources to `image_id`.
+        """
+        paths = []
+        stack = [[image_id]]
+        while stack:
+            path = stack.pop()
+            sources = [src for src in self._sources.get(path[-1], ()) if src not in path]
+            if not sources:
+                paths.append(path[::-1])
+            stack.extend(path + [src] for src in reversed(sources))
+        return paths
@@ -0,0 +1,368 @@
+"""Bulk HQL lookups used by the collection helpers.
+
+Every lookup in here takes many ids at once and binds them to a chunked
+`IN (:ids)` clause, so the number of server round trips does not grow
+with the number of collection members.
+"""
+import omero.sys
+from omero.rtypes import rlist, rlong, rstring, unwrap
+
+
+# Upper bound for the number of ids bound to a single `IN (:ids)` clause.
+ID_CHUNK_SIZE = 1000
+# Number of rows fetched per page for projection queries.
+PAGE_SIZE = 10000
+
+
+# Key-value pairs of all map annotations in a namespace linked to a set of images.
+# The outer join keeps annotations without any key-value pair.
+MAP_VALUES_BY_IMAGE = """
+    SELECT link.parent.id, ann.id, mv.name, mv.value
+    FROM ImageAnnotationLink link
+    JOIN link.child ann
+    LEFT OUTER JOIN ann.mapValue mv
+    WHERE link.parent.id IN (:ids)
+    AND ann.ns = :ns
+    ORDER BY ann.id, index(mv)
+"""
+
+# Key-value pairs of all node annotations of a collection, with the image they are linked to.
+MAP_VALUES_BY_COLLECTION = """
+    SELECT link.parent.id, ann.id, mv.name, mv.value
+    FROM ImageAnnotationLink link
+    JOIN link.child ann
+    JOIN ann.mapValue mv
+    WHERE ann.ns = :ns
+    AND ann.id IN (
+        SELECT a.id FROM MapAnnotation a JOIN a.mapValue v
+        WHERE a.ns = :ns AND v.name = 'collection_id' AND v.value = :cid
+    )
+    ORDER BY ann.id, index(mv)
+"""
+
+# As above, for all node annotations that carry one of a set of collection IDs.
+MAP_VALUES_BY_COLLECTIONS = """
+    SELECT link.parent.id, ann.id, mv.name, mv.value
+    FROM ImageAnnotationLink link
+    JOIN link.child ann
+    JOIN ann.mapValue mv
+    WHERE ann.ns = :ns
+    AND ann.id IN (
+        SELECT a.id FROM MapAnnotation a JOIN a.mapValue v
+        WHERE a.ns = :ns AND v.name = 'collection_id' AND v.value IN (:cids)
+    )
+    ORDER BY ann.id, index(mv)
+"""
+
+# Key-value pairs of all map annotations in a namespace, with the image they are linked to.
+MAP_VALUES_BY_NS = """
+    SELECT link.parent.id, ann.id, mv.name, mv.value
+    FROM ImageAnnotationLink link
+    JOIN link.child ann
+    JOIN ann.mapValue mv
+    WHERE ann.ns = :ns
+    ORDER BY ann.id, index(mv)
+"""
+
+# All images linked to a set of (collection) annotations.
+IMAGES_BY_ANNOTATION = """
+    SELECT link.child.id, link.parent.id
+    FROM ImageAnnotationLink link
+    WHERE link.child.id IN (:ids)
+    ORDER BY link.child.id, link.parent.id
+"""
+
+# Image links of a single annotation, with their IDs.
+ANNOTATION_LINKS = """
+    SELECT link.id, link.parent.id
+    FROM ImageAnnotationLink link
+    WHERE link.child.id = :aid
+    ORDER BY link.id
+"""
+
+# Image links to map annotations in a namespace, with the annotations and their key-value pairs loaded.
+ANNOTATION_LINKS_BY_IMAGE = """
+    SELECT DISTINCT link
+    FROM ImageAnnotationLink link
+    JOIN FETCH link.child ann
+    LEFT OUTER JOIN FETCH ann.mapValue
+    WHERE link.parent.id IN (:ids)
+    AND ann.ns = :ns
+"""
+
+# Map annotations by ID, loaded with their key-value pairs so they can be modified and saved.
+MAP_ANNOTATIONS_BY_ID = """
+    SELECT DISTINCT ann
+    FROM MapAnnotation ann
+    LEFT OUTER JOIN FETCH ann.mapValue
+    WHERE ann.id IN (:ids)
+"""
+
+# Images of a dataset that are linked to a collection annotation.
+COLLECTION_IMAGES_IN_DATASET = """
+    SELECT img.id, img.name
+    FROM DatasetImageLink dil
+    JOIN dil.child img, ImageAnnotationLink ial
+    WHERE dil.parent.id = :did
+    AND ial.parent.id = img.id
+    AND ial.child.id = :cid
+    ORDER BY img.id
+"""
+
+# As above, restricted to images whose node annotation in this collection has the given category.
+COLLECTION_IMAGES_IN_DATASET_BY_CATEGORY = """
+    SELECT img.id, img.name
+    FROM DatasetImageLink dil
+    JOIN dil.child img, ImageAnnotationLink ial
+    WHERE dil.parent.id = :did
+    AND ial.parent.id = img.id
+    AND ial.child.id = :cid
+    AND EXISTS (
+        SELECT nl.id FROM ImageAnnotationLink nl
+        JOIN nl.child na JOIN na.mapValue coll JOIN na.mapValue cat
+        WHERE nl.parent.id = img.id AND na.ns = :ns
+        AND coll.name = 'collection_id' AND coll.value = :cids
+        AND cat.name = 'category' AND cat.value = :category
+    )
+    ORDER BY img.id
+"""
+
+
+# All images of a dataset.
+DATASET_IMAGES = """
+    SELECT link.child.id
+    FROM DatasetImageLink link
+    WHERE link.parent.id = :did
+    ORDER BY link.child.id
+"""
+
+# Annotations in a namespace linked to a set of (node) annotations.
+CHILD_ANNOTATIONS = """
+    SELECT link.parent.id, link.child.id
+    FROM AnnotationAnnotationLink link
+    WHERE link.parent.id IN (:ids)
+    AND link.child.ns = :ns
+    ORDER BY link.parent.id, link.child.id
+"""
+
+
+# Map annotations in a set of namespaces changed after an update event, with their key-value pairs.
+CHANGED_MAP_ANNOTATIONS = """
+    SELECT ann.id, ann.ns, ann.details.updateEvent.id, mv.name, mv.value
+    FROM MapAnnotation ann
+    LEFT OUTER JOIN ann.mapValue mv
+    WHERE ann.ns IN (:nss)
+    AND ann.details.updateEvent.id > :since
+    ORDER BY ann.id, index(mv)
+"""
+
+# Image links to annotations in a set of namespaces created after an event.
+NEW_IMAGE_LINKS = """
+    SELECT link.id, link.parent.id, link.child.id, link.details.creationEvent.id
+    FROM ImageAnnotationLink link
+    WHERE link.child.ns IN (:nss)
+    AND link.details.creationEvent.id > :since
+    ORDER BY link.id
+"""
+
+# IDs of all map annotations and image links in a set of namespaces, to detect deletions.
+MAP_ANNOTATION_IDS = """
+    SELECT ann.id FROM MapAnnotation ann
+    WHERE ann.ns IN (:nss)
+    ORDER BY ann.id
+"""
+IMAGE_LINK_IDS = """
+    SELECT link.id FROM ImageAnnotationLink link
+    WHERE link.child.ns IN (:nss)
+    ORDER BY link.id
+"""
+
+
+# The subset of the given IDs for which an image or annotation exists.
+EXISTING_IMAGES = """
+    SELECT img.id FROM Image img
+    WHERE img.id IN (:ids)
+    ORDER BY img.id
+"""
+EXISTING_ANNOTATIONS = """
+    SELECT ann.id FROM Annotation ann
+    WHERE ann.id IN (:ids)
+    ORDER BY ann.id
+"""
+
+
+def _chunks(values, size=ID_CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _params(**values):
+    """Build query parameters, lists are bound as `rlist`s."""
+    params = omero.sys.ParametersI()
+    for name, value in values.items():
+        if isinstance(value, (list, tuple, set)):
+            params.add(name, rlist([rstring(v) if isinstance(v, str) else rlong(v) for v in value]))
+        elif isinstance(value, str):
+            params.addString(name, value)
+        else:
+            params.addLong(name, value)
+    return params
+
+
+def _projection(conn, query, params, page_size=PAGE_SIZE, limit=None):
+    """Run a projection query page by page and yield the unwrapped rows.
+
+    The query needs a stable ORDER BY clause for the paging to be correct.
+    With a `limit` no more than that many rows are fetched from the server.
+    """
+    query_service = conn.getQueryService()
+    offset = 0
+    while limit is None or offset < limit:
+        size = page_size if limit is None else min(page_size, limit - offset)
+        params.page(offset, size)
+        rows = query_service.projection(query, params, conn.SERVICE_OPTS)
+        for row in rows:
+            yield unwrap(row)
+        if len(rows) < size:
+            break
+        offset += size
+
+
+def _map_values_by_image(conn, image_ids, ns):
+    """Get the key-value pairs of all `ns` map annotations of the given images.
+
+    Returns a dict {image_id: {annotation_id: {key: value}}}, annotations are
+    ordered by their ID.
+    """
+    result = {}
+    for chunk in _chunks(set(image_ids)):
+        params = _params(ids=chunk, ns=ns)
+        for image_id, ann_id, key, value in _projection(conn, MAP_VALUES_BY_IMAGE, params):
+            kv = result.setdefault(image_id, {}).setdefault(ann_id, {})
+            if key is not None:
+                kv[key] = value
+    return result
+
+
+def _map_values_by_collection(conn, collection_id, ns):
+    """Get the key-value pairs of all `ns` map annotations that carry the given
+    `collection_id`, fetched in pages of a single query.
+
+    Returns a dict {annotation_id: (image_id, {key: value})}, ordered by annotation ID.
+    """
+    result = {}
+    params = _params(ns=ns, cid=str(collection_id))
+    for image_id, ann_id, key, value in _projection(conn, MAP_VALUES_BY_COLLECTION, params):
+        result.setdefault(ann_id, (image_id, {}))[1][key] = value
+    return result
+
+
+def _map_values_by_collections(conn, collection_ids, ns):
+    """Get the key-value pairs of all `ns` map annotations that carry one of the
+    given `collection_id`s, with one paged query per chunk of collections.
+
+    Returns a dict {annotation_id: (image_id, {key: value})}, ordered by annotation ID within a chunk.
+    """
+    result = {}
+    for chunk in _chunks(sorted({str(cid) for cid in collection_ids})):
+        params = _params(ns=ns, cids=chunk)
+        for image_id, ann_id, key, value in _projection(conn, MAP_VALUES_BY_COLLECTIONS, params):
+            result.setdefault(ann_id, (image_id, {}))[1][key] = value
+    return result
+
+
+def _map_values_by_ns(conn, ns):
+    """Get the key-value pairs of all `ns` map annotations linked to an image,
+    fetched in pages of a single query.
+
+    Returns a dict {annotation_id: (image_id, {key: value})}, ordered by annotation ID.
+    """
+    result = {}
+    for image_id, ann_id, key, value in _projection(conn, MAP_VALUES_BY_NS, _params(ns=ns)):
+        result.setdefault(ann_id, (image_id, {}))[1][key] = value
+    return result
+
+
+def _images_by_annotation(conn, annotation_ids):
+    """Get the IDs of all images linked to the given annotations.
+
+    Returns a dict {annotation_id: [image_id, ...]}.
+    """
+    result = {ann_id: [] for ann_id in annotation_ids}
+    for chunk in _chunks(set(annotation_ids)):
+        for ann_id, image_id in _projection(conn, IMAGES_BY_ANNOTATION, _params(ids=chunk)):
+            result[ann_id].append(image_id)
+    return result
+
+
+def _annotation_links(conn, annotation_id):
+    """Get the image links of an annotation. Returns a dict {image_id: link_id}."""
+    return {
+        image_id: link_id
+        for link_id, image_id in _projection(conn, ANNOTATION_LINKS, _params(aid=annotation_id))
+    }
+
+
+def _map_annotations_by_image(conn, image_ids, ns):
+    """Load the `ns` map annotations of the given images, e.g. to modify and save them.
+
+    Returns a dict {image_id: [MapAnnotationI, ...]}, annotations are ordered by their ID.
+    """
+    query_service = conn.getQueryService()
+    result = {}
+    for chunk in _chunks(set(image_ids)):
+        for link in query_service.findAllByQuery(ANNOTATION_LINKS_BY_IMAGE, _params(ids=chunk, ns=ns), conn.SERVICE_OPTS):
+            result.setdefault(unwrap(link.getParent().getId()), []).append(link.getChild())
+    for anns in result.values():
+        anns.sort(key=lambda ann: unwrap(ann.getId()))
+    return result
+
+
+def _map_annotations_by_id(conn, annotation_ids):
+    """Load map annotations by ID. Returns a dict {annotation_id: MapAnnotationI}."""
+    query_service = conn.getQueryService()
+    result = {}
+    for chunk in _chunks(set(annotation_ids)):
+        for ann in query_service.findAllByQuery(MAP_ANNOTATIONS_BY_ID, _params(ids=chunk), conn.SERVICE_OPTS):
+            result[unwrap(ann.getId())] = ann
+    return result
+
+
+def _collection_images_in_dataset(conn, collection_id, dataset_id, ns, category=None, limit=None):
+    """Get the images of a dataset that are members of a collection, optionally
+    only those whose node in the collection has the given category.
+
+    Returns a list of (image_id, image_name) tuples, ordered by image ID.
+    """
+    if category is None:
+        query, params = COLLECTION_IMAGES_IN_DATASET, _params(did=dataset_id, cid=collection_id)
+    else:
+        query = COLLECTION_IMAGES_IN_DATASET_BY_CATEGORY
+        params = _params(did=dataset_id, cid=collection_id, ns=ns, cids=str(collection_id), category=category)
+    return [tuple(row) for row in _projection(conn, query, params, limit=limit)]
+
+
+def _dataset_images(conn, dataset_id):
+    """Get the IDs of all images in a dataset."""
+    return [row[0] for row in _projection(conn, DATASET_IMAGES, _params(did=dataset_id))]
+
+
+def _child_annotations(conn, annotation_ids, ns):
+    """Get the IDs of the `ns` annotations linked to the given annotations.
+
+    Returns a dict {annotation_id: [child_annotation_id, ...]}.
+    """
+    result = {ann_id: [] for ann_id in annotation_ids}
+    for chunk in _chunks(set(annotation_ids)):
+        for ann_id, child_id in _projection(conn, CHILD_ANNOTATIONS, _params(ids=chunk, ns=ns)):
+            result[ann_id].append(child_id)
+    return result
+
+
+def _existing_ids(conn, query, ids):
+    """Run one of the EXISTING_* queries for the given IDs. Returns a set of IDs."""
+    existing = set()
+    for chunk in _chunks(set(ids)):
+        existing.update(row[0] for row in _projection(conn, query, _params(ids=chunk)))
+    return existing
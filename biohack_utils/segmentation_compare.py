@@ -0,0 +1,240 @@
+"""Comparison of competing segmentations stored in a collection.
+
+The mask nodes derived from a reference node are compared pairwise. The masks
+are streamed plane by plane and every pair of planes is reduced to a sparse
+contingency table of (label, label) overlap counts, with `bincount` or `unique`
+on combined label keys. The instance IoUs, the one-to-one matching and the
+summary scores are computed from the accumulated table. Only one plane per
+mask is held in memory, and independent pairs are compared in parallel
+processes, each with its own gateway joined to the session of the caller.
+"""
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+from biohack_utils.omero_annotation import NS_NODE
+from biohack_utils.provenance import ProvenanceGraph
+from biohack_utils.queries import _map_values_by_collection
+
+
+# The gateway of a worker process, see `_init_worker`.
+_worker_conn = None
+
+
+# Number of pending per-plane table entries that triggers a merge, see `_contingency`.
+_MERGE_ENTRIES = 1 << 20
+
+
+def _plane_contingency(a, b):
+    """Overlap counts of the labels of two planes, as arrays (labels a, labels b, counts)."""
+    a = a.ravel()
+    b = b.ravel()
+    n_a = int(a.max()) + 1
+    n_b = int(b.max()) + 1
+    # Large or sparse label IDs are renumbered, so that the combined keys stay small and do not overflow.
+    if n_a * n_b > 4 * a.size:
+        ids_a, a = np.unique(a, return_inverse=True)
+        ids_b, b = np.unique(b, return_inverse=True)
+        n_a, n_b = len(ids_a), len(ids_b)
+    else:
+        ids_a = ids_b = None
+    keys = a.astype(np.int64) * n_b + b
+    # A dense bincount is faster than sorting as long as the key range is not much larger than the plane.
+    if n_a * n_b <= 4 * keys.size:
+        counts = np.bincount(keys, minlength=n_a * n_b)
+        keys = np.flatnonzero(counts)
+        counts = counts[keys]
+    else:
+        keys, counts = np.unique(keys, return_counts=True)
+    labels_a, labels_b = keys // n_b, keys % n_b
+    if ids_a is not None:
+        labels_a, labels_b = ids_a[labels_a], ids_b[labels_b]
+    return labels_a.astype(np.uint64), labels_b.astype(np.uint64), counts.astype(np.int64)
+
+
+def _merge_contingency(tables):
+    """Sum contingency tables given as (labels a, labels b, counts)."""
+    labels_a = np.concatenate([table[0] for table in tables])
+    labels_b = np.concatenate([table[1] for table in tables])
+    counts = np.concatenate([table[2] for table in tables])
+    if len(counts) == 0:
+        return labels_a, labels_b, counts
+    order = np.lexsort((labels_b, labels_a))
+    labels_a, labels_b, counts = labels_a[order], labels_b[order], counts[order]
+    first = np.ones(len(counts), dtype=bool)
+    first[1:] = (labels_a[1:] != labels_a[:-1]) | (labels_b[1:] != labels_b[:-1])
+    first = np.flatnonzero(first)
+    return labels_a[first], labels_b[first], np.add.reduceat(counts, first)
+
+
+def _contingency(planes_a, planes_b):
+    """Contingency table of two label images given as iterables of (Y, X) planes.
+
+    The plane tables are merged once they hold as many entries as the merged table,
+    so every entry is merged O(log Z) times for Z planes.
+    """
+    table = (np.zeros(0, np.uint64), np.zeros(0, np.uint64), np.zeros(0, np.int64))
+    pending, n_pending = [], 0
+    for z, (a, b) in enumerate(itertools.zip_longest(planes_a, planes_b)):
+        if a is None or b is None or a.shape != b.shape:
+            raise ValueError(f"The masks differ in shape at plane {z}")
+        pending.append(_plane_contingency(a, b))
+        n_pending += len(pending[-1][2])
+        if n_pending >= max(len(table[2]), _MERGE_ENTRIES):
+            table = _merge_contingency([table] + pending)
+            pending, n_pending = [], 0
+    return _merge_contingency([table] + pending) if pending else table
+
+
+def _match(labels_a, labels_b, counts, iou_threshold):
+    """IoU matrix and one-to-one matching of the objects of a contingency table.
+
+    The labels are renumbered to the objects present, so the sizes and the IoU matrix
+    do not depend on the label values. Returns the IoU matrix, the IoUs of the matches
+    and the label IDs of the rows and columns of the matrix.
+    """
+    ids_a, index_a = np.unique(labels_a, return_inverse=True)
+    ids_b, index_b = np.unique(labels_b, return_inverse=True)
+    index_a, index_b = index_a.ravel(), index_b.ravel()
+    sizes_a = np.bincount(index_a, weights=counts, minlength=len(ids_a))
+    sizes_b = np.bincount(index_b, weights=counts, minlength=len(ids_b))
+
+    # Drop the background (label 0), which is the first ID if present.
+    offset_a = int(len(ids_a) > 0 and ids_a[0] == 0)
+    offset_b = int(len(ids_b) > 0 and ids_b[0] == 0)
+    objects = (labels_a > 0) & (labels_b > 0)
+    la, lb, inter = index_a[objects], index_b[objects], counts[objects]
+    iou = inter / (sizes_a[la] + sizes_b[lb] - inter)
+    la, lb = la - offset_a, lb - offset_b
+    iou_matrix = sparse.csr_matrix((iou, (la, lb)), shape=(len(ids_a) - offset_a, len(ids_b) - offset_b))
+
+    # Greedy one-to-one matching by decreasing IoU, which is exact for thresholds of at least 0.5.
+    used_a, used_b, matched = set(), set(), []
+    for k in np.argsort(-iou, kind="stable"):
+        if iou[k] < iou_threshold:
+            break
+        if la[k] not in used_a and lb[k] not in used_b:
+            used_a.add(la[k])
+            used_b.add(lb[k])
+            matched.append(iou[k])
+
+    return iou_matrix, matched, ids_a[offset_a:], ids_b[offset_b:]
+
+
+def compare_masks(planes_a, planes_b, iou_threshold=0.5):
+    """Compare two label images given as iterables of (Y, X) planes.
+
+    Args:
+        planes_a: The planes of the first (reference) mask.
+        planes_b: The planes of the second mask.
+        iou_threshold: Minimal IoU of two objects to be matched.
+    Returns:
+        A dict with the sparse "iou" matrix (objects of a x objects of b), the label IDs
+        of its rows and columns as "labels_a" and "labels_b", the number of "matched"
+        objects, of "unmatched_a" and "unmatched_b" objects, the "f1" score of the
+        matching and the "mean_iou" of the matched objects.
+    """
+    iou, matched, labels_a, labels_b = _match(*_contingency(planes_a, planes_b), iou_threshold)
+    n_a, n_b, n_matched = len(labels_a), len(labels_b), len(matched)
+    return {
+        "iou": iou,
+        "labels_a": labels_a,
+        "labels_b": labels_b,
+        "matched": n_matched,
+        "unmatched_a": n_a - n_matched,
+        "unmatched_b": n_b - n_matched,
+        "f1": 2 * n_matched / (n_a + n_b) if n_a + n_b else 1.0,
+        "mean_iou": float(np.mean(matched)) if matched else 0.0,
+    }
+
+
+def _iter_planes(conn, image_id):
+    image = conn.getObject("Image", image_id)
+    if image is None:
+        raise ValueError(f"Image {image_id} not found")
+    return image.getPrimaryPixels().getPlanes([(z, 0, 0) for z in range(image.getSizeZ())])
+
+
+def _compare_pair(image_a, image_b, iou_threshold, conn=None):
+    conn = _worker_conn if conn is None else conn
+    result = compare_masks(_iter_planes(conn, image_a), _iter_planes(conn, image_b), iou_threshold)
+    return dict(result, image_a=image_a, image_b=image_b)
+
+
+def _connect_worker(host, port, secure, session_id, group):
+    from omero.gateway import BlitzGateway
+
+    conn = BlitzGateway(host=host, port=port, secure=secure)
+    if not conn.connect(sUuid=session_id):
+        raise RuntimeError("Could not join the OMERO session")
+    conn.SERVICE_OPTS.setOmeroGroup(group)
+    return conn
+
+
+def _init_worker(*connect_args):
+    global _worker_conn
+    _worker_conn = _connect_worker(*connect_args)
+
+
+def _mask_pairs(node_anns, reference):
+    """Pairs of mask images to compare for the reference node (a name or path) of a collection.
+
+    A reference mask is compared with all other masks of the same source, for any
+    other reference all masks derived from it are compared with each other.
+    """
+    nodes = {}
+    for image_id, kv in node_anns.values():
+        for key in (kv.get("path"), kv.get("name")):
+            nodes.setdefault(key, []).append((image_id, kv))
+    candidates = nodes.get(reference, [])
+    if len({image_id for image_id, _ in candidates}) != 1:
+        raise ValueError(f"Reference node '{reference}' {'is ambiguous' if candidates else 'not found'}")
+    ref_id, ref_kv = candidates[0]
+
+    graph = ProvenanceGraph(node_anns)
+    masks = {image_id for image_id, kv in node_anns.values() if kv.get("origin") == "masks"}
+    if ref_id in masks:
+        others = {mid for src in graph.sources(ref_id) for mid in graph.derived(src) if mid in masks}
+        return [(ref_id, mid) for mid in sorted(others - {ref_id})]
+    derived = sorted(mid for mid in graph.derived(ref_id) if mid in masks)
+    return list(itertools.combinations(derived, 2))
+
+
+def compare_segmentations(conn, collection_id, reference, iou_threshold=0.5, n_workers=None):
+    """Compare the competing segmentations of a collection.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        collection_id: The ID of the collection annotation.
+        reference: Name or path of the reference node. For an image node all masks derived
+            from it are compared pairwise, a mask node is compared to the other masks of its source.
+        iou_threshold: Minimal IoU of two objects to be matched.
+        n_workers: Number of processes comparing pairs in parallel, each over its own joined
+            session. With a single worker the pairs are compared over `conn`.
+    Returns:
+        A list with the result of `compare_masks` per pair, with the IDs of the compared images.
+    """
+    pairs = _mask_pairs(_map_values_by_collection(conn, collection_id, NS_NODE), reference)
+    n_workers = min(n_workers or os.cpu_count(), max(len(pairs), 1))
+
+    if n_workers == 1:
+        results = [_compare_pair(a, b, iou_threshold, conn) for a, b in pairs]
+    else:
+        connect_args = (
+            conn.host, conn.port, conn.secure, conn.c.getSessionId(), conn.SERVICE_OPTS.getOmeroGroup(),
+        )
+        with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=connect_args) as pool:
+            results = list(pool.map(
+                _compare_pair, *zip(*pairs), itertools.repeat(iou_threshold),
+            ))
+
+    for result in results:
+        print(
+            f"Image {result['image_a']} vs {result['image_b']}: {result['matched']} matched, "
+            f"{result['unmatched_a']} / {result['unmatched_b']} unmatched, F1 {result['f1']:.3f}, "
+            f"mean IoU {result['mean_iou']:.3f}"
+        )
+    return results
@@ -0,0 +1,345 @@
+"""Persistent on-disk cache for tiles of OMERO images.
+
+Tiles are stored as .npy files next to a SQLite index that keeps their size
+and last access time, so the cache survives restarts and is bounded by
+evicting the least recently used tiles. The total size is kept in the index by
+triggers and read inside the write transaction of every `put`, so several
+processes can share one cache directory. Tiles are keyed by image ID, a version
+of the pixel data (checksum and last update), resolution level and position,
+so a modified image is never served from stale tiles.
+
+`cached_lazy_array` returns a dask array like napari-omero's `get_data_lazy`
+whose chunks are read through the cache.
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+
+import numpy as np
+from omero.rtypes import unwrap
+
+from biohack_utils.util import _NUMPY_TYPES
+
+
+# Number of cache hits whose access time is written to the index at once.
+TOUCH_BATCH_SIZE = 256
+# Number of index rows read per query while evicting.
+EVICT_BATCH_SIZE = 256
+
+
+class TileCache:
+    """Size-bounded LRU cache of image tiles on the local disk.
+
+    Args:
+        path: Directory of the cache, it is created if it does not exist.
+        max_bytes: Maximal size of the cached tiles, least recently used tiles are evicted beyond it.
+        low_water: Fraction of `max_bytes` the cache is reduced to when it is full,
+            so that not every `put` of a full cache has to evict.
+    """
+    def __init__(self, path, max_bytes=10 * 1024 ** 3, low_water=0.9):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        os.makedirs(path, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS tiles (
+                key TEXT PRIMARY KEY,
+                file TEXT NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used)")
+        # The size of all tiles, shared by all processes using the cache.
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._db.execute(
+            "INSERT OR IGNORE INTO meta (key, value) SELECT 'size', COALESCE(SUM(nbytes), 0) FROM tiles"
+        )
+        self._db.execute(
+            """CREATE TRIGGER IF NOT EXISTS tiles_insert AFTER INSERT ON tiles BEGIN
+                UPDATE meta SET value = value + NEW.nbytes WHERE key = 'size';
+            END"""
+        )
+        self._db.execute(
+            """CREATE TRIGGER IF NOT EXISTS tiles_delete AFTER DELETE ON tiles BEGIN
+                UPDATE meta SET value = value - OLD.nbytes WHERE key = 'size';
+            END"""
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+        # Access times of cache hits not yet written to the index, see `_flush_touched`.
+        self._touched = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with self._lock:
+            self._write(self._evict)
+
+    def get(self, key):
+        """The cached tile for `key`, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT file FROM tiles WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._touched[key] = time.time()
+            if len(self._touched) >= TOUCH_BATCH_SIZE:
+                self._flush_touched()
+            self.hits += 1
+        try:
+            return np.load(os.path.join(self.path, row[0]))
+        except (OSError, ValueError):
+            # The file was removed or is damaged, e.g. by another process evicting it.
+            self._remove([(key, row[0])])
+            return None
+
+    def put(self, key, tile):
+        """Store a tile, evicting the least recently used tiles if the cache is full."""
+        tile = np.ascontiguousarray(tile)
+        file_name = f"{uuid.uuid4().hex}.npy"
+        tmp = os.path.join(self.path, file_name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, tile)
+        os.replace(tmp, os.path.join(self.path, file_name))
+
+        def insert():
+            old = self._db.execute("SELECT file FROM tiles WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self._db.execute("DELETE FROM tiles WHERE key = ?", (key,))
+            self._db.execute(
+                "INSERT INTO tiles (key, file, nbytes, last_used) VALUES (?, ?, ?, ?)",
+                (key, file_name, tile.nbytes, time.time()),
+            )
+            return ([] if old is None else [old[0]]) + self._evict()
+
+        with self._lock:
+            self._write(insert)
+
+    def _write(self, update):
+        """Run `update` in a write transaction and remove the files it returns once it is committed.
+
+        The transaction is started immediately, so the size read within it is not changed
+        by other processes until the commit.
+        """
+        self._flush_touched()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            files = update()
+            self._db.commit()
+        except BaseException:
+            self._db.rollback()
+            raise
+        for file_name in files:
+            self._remove_file(file_name)
+
+    def _size(self):
+        return self._db.execute("SELECT value FROM meta WHERE key = 'size'").fetchone()[0]
+
+    def _flush_touched(self):
+        """Write the access times of the recent cache hits to the index, in one transaction."""
+        if self._touched:
+            self._db.executemany(
+                "UPDATE tiles SET last_used = ? WHERE key = ?", [(t, key) for key, t in self._touched.items()]
+            )
+            self._db.commit()
+            self._touched = {}
+
+    def _evict(self):
+        """If the cache is full, evict the least recently used tiles until it is at its low-water mark.
+
+        Must run within `_write`. Returns the files of the evicted tiles.
+        """
+        size = self._size()
+        if size <= self.max_bytes:
+            return []
+        target = self.max_bytes * self.low_water
+        evicted = []
+        while size > target:
+            rows = self._db.execute(
+                "SELECT key, file, nbytes FROM tiles ORDER BY last_used LIMIT ? OFFSET ?",
+                (EVICT_BATCH_SIZE, len(evicted)),
+            ).fetchall()
+            if not rows:
+                break
+            for key, file_name, nbytes in rows:
+                if size <= target:
+                    break
+                evicted.append((key, file_name))
+                size -= nbytes
+        self._db.executemany("DELETE FROM tiles WHERE key = ?", [(key,) for key, _ in evicted])
+        self.evictions += len(evicted)
+        return [file_name for _, file_name in evicted]
+
+    def _remove(self, entries):
+        with self._lock:
+            for key, file_name in entries:
+                # Only the entry of this file, another process may have stored the tile again.
+                self._db.execute("DELETE FROM tiles WHERE key = ? AND file = ?", (key, file_name))
+                self._remove_file(file_name)
+            self._db.commit()
+
+    def _remove_file(self, file_name):
+        try:
+            os.remove(os.path.join(self.path, file_name))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            files = [row[0] for row in self._db.execute("SELECT file FROM tiles")]
+            self._db.execute("DELETE FROM tiles")
+            self._db.commit()
+        for file_name in files:
+            self._remove_file(file_name)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            n_tiles = self._db.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+            size = self._size()
+        return {
+            "tiles": n_tiles,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _image_version(image):
+    """Version of the pixel data of an image: its checksum and last update event."""
+    pixels = image.getPrimaryPixels()._obj
+    sha1 = unwrap(pixels.getSha1())
+    event = image._obj.getDetails().getUpdateEvent()
+    update = None if event is None else unwrap(event.getId())
+    return f"{sha1}-{update}"
+
+
+class _CachedPixels:
+    """Array-like (T, C, Z, Y, X) view of one resolution level of an image, read tile by tile.
+
+    Tiles missing from the cache are fetched through a RawPixelsStore and stored.
+    """
+    def __init__(self, conn, image, cache, level=0):
+        self._conn = conn
+        self._cache = cache
+        self._lock = threading.Lock()
+        self._pixels_id = image.getPrimaryPixels().getId()
+        # The store is kept in a list shared with the finalizer, which closes it once this view is collected.
+        self._stores = []
+        self._finalizer = weakref.finalize(self, _close_stores, self._stores)
+        store = self._raw_store()
+        n_levels = store.getResolutionLevels()
+        if not 0 <= level < n_levels:
+            raise ValueError(f"Image {image.getId()} has {n_levels} resolution levels, got level {level}")
+        # OMERO counts resolution levels from the smallest one, level 0 here is the full resolution.
+        self._omero_level = n_levels - 1 - level
+        store.setResolutionLevel(self._omero_level)
+        if n_levels == 1:
+            size_x, size_y = image.getSizeX(), image.getSizeY()
+        else:
+            description = store.getResolutionDescriptions()[level]
+            size_x, size_y = description.sizeX, description.sizeY
+        self.tile_size = tuple(store.getTileSize()[::-1])
+        self.shape = (image.getSizeT(), image.getSizeC(), image.getSizeZ(), size_y, size_x)
+        self.dtype = np.dtype(_NUMPY_TYPES[image.getPrimaryPixels().getPixelsType().getValue()])
+        self.ndim = 5
+        self._prefix = f"{image.getId()}/{_image_version(image)}/{level}"
+
+    def _raw_store(self):
+        if not self._stores:
+            store = self._conn.createRawPixelsStore()
+            self._stores.append(store)
+            store.setPixelsId(self._pixels_id, True, self._conn.SERVICE_OPTS)
+        return self._stores[0]
+
+    def _tile(self, t, c, z, y, x, height, width):
+        key = f"{self._prefix}/{t}/{c}/{z}/{y}/{x}/{height}/{width}"
+        tile = self._cache.get(key)
+        if tile is not None:
+            return tile
+        # A RawPixelsStore must not be used concurrently.
+        with self._lock:
+            data = self._raw_store().getTile(z, c, t, x, y, width, height, self._conn.SERVICE_OPTS)
+        tile = np.frombuffer(data, dtype=self.dtype.newbyteorder(">")).reshape(height, width).astype(self.dtype)
+        self._cache.put(key, tile)
+        return tile
+
+    def __getitem__(self, key):
+        ts, cs, zs, ys, xs = (
+            range(*k.indices(size)) if isinstance(k, slice) else range(k, k + 1)
+            for k, size in zip(key, self.shape)
+        )
+        out = np.empty((len(ts), len(cs), len(zs), len(ys), len(xs)), dtype=self.dtype)
+        if out.size == 0:
+            return out
+        tile_y, tile_x = self.tile_size
+        y0, y1, x0, x1 = ys.start, ys.stop, xs.start, xs.stop
+        for ti, t in enumerate(ts):
+            for ci, c in enumerate(cs):
+                for zi, z in enumerate(zs):
+                    # Read the whole tiles the requested region overlaps, so they are cached aligned.
+                    for ty in range(y0 // tile_y * tile_y, y1, tile_y):
+                        for tx in range(x0 // tile_x * tile_x, x1, tile_x):
+                            height, width = min(tile_y, self.shape[3] - ty), min(tile_x, self.shape[4] - tx)
+                            tile = self._tile(t, c, z, ty, tx, height, width)
+                            sy, sx = max(y0, ty), max(x0, tx)
+                            ey, ex = min(y1, ty + height), min(x1, tx + width)
+                            out[ti, ci, zi, sy - y0:ey - y0, sx - x0:ex - x0] = tile[sy - ty:ey - ty, sx - tx:ex - tx]
+        return out
+
+    def close(self):
+        """Close the RawPixelsStore, a later read opens a new one."""
+        with self._lock:
+            _close_stores(self._stores)
+
+
+def _close_stores(stores):
+    while stores:
+        try:
+            stores.pop().close()
+        except Exception:
+            # The session may already be closed, e.g. at exit.
+            pass
+
+
+def cached_lazy_array(conn, image, cache, level=0):
+    """Lazy (T, C, Z, Y, X) dask array of an image whose tiles are read through a `TileCache`.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        image: The image (wrapper).
+        cache: A `TileCache`, or the path of its directory.
+        level: Resolution level, 0 is the full resolution.
+    Returns:
+        The dask array, with one chunk per server tile. Its RawPixelsStore, and the cache
+        if it is opened from a path, are closed when the array is garbage collected, or at exit.
+    """
+    import dask.array as da
+
+    if isinstance(cache, str):
+        cache = TileCache(cache)
+        pixels = _CachedPixels(conn, image, cache, level)
+        weakref.finalize(pixels, cache.close)
+    else:
+        pixels = _CachedPixels(conn, image, cache, level)
+    chunks = (1, 1, 1) + pixels.tile_size
+    return da.from_array(pixels, chunks=chunks, asarray=False, fancy=False, name=f"omero-{pixels._prefix}")
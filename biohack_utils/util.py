@@ -1,4 +1,9 @@
 import argparse
+import os
+import queue
+import threading
+import time
+
 import numpy as np
 
 from omero.gateway import BlitzGateway
@@ -25,6 +30,173 @@ def _upload_volume(conn, curr, iname):
     return image.id
 
 
+# OMERO pixel types of the supported numpy dtypes.
+_PIXEL_TYPES = {
+    "int8": "int8", "uint8": "uint8", "int16": "int16", "uint16": "uint16",
+    "int32": "int32", "uint32": "uint32", "float32": "float", "float64": "double",
+}
+# numpy dtypes of the OMERO pixel types.
+_NUMPY_TYPES = {pixel_type: dtype for dtype, pixel_type in _PIXEL_TYPES.items()}
+
+
+def _open_lazy(path):
+    """Open a TIFF (memory-mapped if possible) or Zarr array without loading it."""
+    import zarr
+
+    if os.path.isdir(path) or path.rstrip("/").endswith(".zarr"):
+        return zarr.open(path, mode="r")
+
+    import tifffile
+    try:
+        return tifffile.memmap(path, mode="r")
+    except ValueError:  # Compressed or tiled TIFFs cannot be memory-mapped.
+        return zarr.open(tifffile.imread(path, aszarr=True), mode="r")
+
+
+def _iter_tiles(source, shape, tile_size):
+    """Yield (c, z, y, x, tile) for a (Y, X), (Z, Y, X) or (C, Z, Y, X) array-like
+    or an iterable of (Y, X) planes, ordered by channel and then z.
+
+    Only the yielded tile is read from an array-like, an iterable is read one plane at a time.
+    """
+    size_c, size_z, size_y, size_x = shape
+    tile_y, tile_x = tile_size
+    if hasattr(source, "shape"):
+        n_lead = len(source.shape) - 2
+        for c in range(size_c):
+            for z in range(size_z):
+                lead = (c, z)[2 - n_lead:]
+                for y in range(0, size_y, tile_y):
+                    for x in range(0, size_x, tile_x):
+                        yield c, z, y, x, np.asarray(source[lead + (slice(y, y + tile_y), slice(x, x + tile_x))])
+        return
+
+    for i, plane in enumerate(source):
+        c, z = divmod(i, size_z)
+        for y in range(0, size_y, tile_y):
+            for x in range(0, size_x, tile_x):
+                yield c, z, y, x, np.asarray(plane[y:y + tile_y, x:x + tile_x])
+
+
+def _upload_volume_tiled(
+    conn, source, iname, shape=None, dtype=None, tile_size=None, max_tiles=16, dataset=None, description=None
+):
+    """Upload a 2D (Y, X), 3D (Z, Y, X) or 4D (C, Z, Y, X) image tile by tile.
+
+    The source is read lazily while the tiles are written through a RawPixelsStore,
+    with at most `max_tiles` tiles held in memory at any time.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        source: Path to a TIFF or Zarr array, an array-like that is sliced lazily
+            (e.g. a numpy memmap or zarr array) or an iterable of (Y, X) planes ordered by channel and z.
+        iname: Name of the uploaded image.
+        shape: Shape of the image, required if `source` is an iterable of planes.
+        dtype: Data type of the image, required if `source` is an iterable of planes.
+        tile_size: (Y, X) size of the tiles. Defaults to the tile size preferred by the server.
+        max_tiles: Maximal number of tiles held in memory.
+        dataset: Dataset (wrapper) to put the image in.
+        description: Description of the image.
+    Returns:
+        The ID of the created image.
+    """
+    if isinstance(source, str):
+        source = _open_lazy(source)
+    shape = tuple(source.shape) if shape is None else tuple(shape)
+    dtype = np.dtype(source.dtype if dtype is None else dtype)
+    if not 2 <= len(shape) <= 4:
+        raise ValueError("Input data must have 2D, 3D or 4D shape.")
+    if dtype.name not in _PIXEL_TYPES:
+        raise ValueError(f"Data type {dtype} is not supported by OMERO.")
+    shape = (1,) * (4 - len(shape)) + shape
+    size_c, size_z, size_y, size_x = shape
+
+    query_service = conn.getQueryService()
+    pixels_type = query_service.findByQuery(
+        f"from PixelsType as p where p.value='{_PIXEL_TYPES[dtype.name]}'", None, conn.SERVICE_OPTS
+    )
+    pixels_service = conn.getPixelsService()
+    image_id = pixels_service.createImage(
+        size_x, size_y, size_z, 1, list(range(size_c)), pixels_type, iname, description or "", conn.SERVICE_OPTS
+    ).getValue()
+    image = conn.getObject("Image", image_id)
+    pixels_id = image.getPrimaryPixels().getId()
+
+    if dataset is not None:
+        from omero.model import DatasetImageLinkI, DatasetI, ImageI
+        link = DatasetImageLinkI()
+        link.setParent(DatasetI(dataset.getId(), False))
+        link.setChild(ImageI(image_id, False))
+        conn.getUpdateService().saveObject(link, conn.SERVICE_OPTS)
+
+    # Tiles are read in a separate thread, the bounded queue caps the memory.
+    tiles = queue.Queue(maxsize=max_tiles)
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        """Queue an item, unless the upload was stopped. Returns whether it was queued."""
+        while not stop.is_set():
+            try:
+                tiles.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in _iter_tiles(source, shape, tile_size):
+                if not put(item):
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(None)
+
+    reader = threading.Thread(target=read, daemon=True)
+    raw_pixels_store = conn.createRawPixelsStore()
+    try:
+        raw_pixels_store.setPixelsId(pixels_id, True, conn.SERVICE_OPTS)
+        if tile_size is None:
+            tile_size = tuple(raw_pixels_store.getTileSize(conn.SERVICE_OPTS))[::-1]
+        reader.start()
+
+        start = time.perf_counter()
+        n_bytes, min_val, max_val = 0, {}, {}
+        big_endian = dtype.newbyteorder(">")
+        while (item := tiles.get()) is not None:
+            c, z, y, x, tile = item
+            raw_pixels_store.setTile(
+                tile.astype(big_endian, copy=False).tobytes(), z, c, 0, x, y, tile.shape[1], tile.shape[0],
+                conn.SERVICE_OPTS,
+            )
+            n_bytes += tile.nbytes
+            min_val[c] = min(min_val.get(c, tile.min()), tile.min())
+            max_val[c] = max(max_val.get(c, tile.max()), tile.max())
+        if errors:
+            raise errors[0]
+
+        elapsed = time.perf_counter() - start
+        print(
+            f"Uploaded {n_bytes / 1e6:.1f} MB to image {image_id} in {elapsed:.1f}s "
+            f"({n_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s)"
+        )
+        raw_pixels_store.save(conn.SERVICE_OPTS)
+    finally:
+        # Also stops the reader if writing a tile failed, the queued tiles are dropped with the queue.
+        stop.set()
+        if reader.ident is not None:
+            reader.join()
+        raw_pixels_store.close()
+
+    for c in range(size_c):
+        pixels_service.setChannelGlobalMinMax(pixels_id, c, float(min_val[c]), float(max_val[c]), conn.SERVICE_OPTS)
+    image = conn.getObject("Image", image_id)
+    image.resetDefaults()
+    return image_id
+
+
 def _find_images_with_collection_id_in_dataset(conn, namespace, collection_id, dataset_id, limit=None):
     dataset = conn.getObject("Dataset", dataset_id)
     if dataset is None:
@@ -118,6 +290,16 @@ def connect_to_omero(args):
         print("Failed to connect")
         exit(1)
 
+    # Opt-in recording of all server calls, see biohack_utils.instrumentation.
+    # BIOHACK_TRACE=1 enables it without --trace, the summary goes to BIOHACK_TRACE_OUTPUT or is printed.
+    trace = getattr(args, "trace", None)
+    if trace is None and os.environ.get("BIOHACK_TRACE", "").lower() not in ("", "0", "false", "no", "off"):
+        trace = os.environ.get("BIOHACK_TRACE_OUTPUT", "-")
+    if trace:
+        from biohack_utils.instrumentation import instrument
+        records_output = getattr(args, "trace_records", None) or os.environ.get("BIOHACK_TRACE_RECORDS")
+        conn = instrument(conn, output=trace, records_output=records_output)
+
     return conn
 
 
@@ -127,4 +309,12 @@ def omero_credential_parser():
     parser.add_argument("-p", "--password", type=str, required=True)
     parser.add_argument("--image_id", type=int)
     parser.add_argument("--namespace", type=str, default="ome/collection")
+    parser.add_argument(
+        "--trace", type=str, default=None,
+        help="Record all OMERO calls and write a per-function summary to this JSON file at exit ('-' to print it)."
+    )
+    parser.add_argument(
+        "--trace_records", type=str, default=None,
+        help="With --trace, also stream every recorded call to this JSON Lines file."
+    )
     return parser
@@ -0,0 +1,256 @@
+"""Export of an OMERO collection to an OME-Zarr collection (RFC-8).
+
+Every multiscale node of the collection becomes an OME-Zarr image group,
+label nodes are written to the `labels/` group of their source image, and
+the root `zarr.json` holds the collection document with the relative path
+of every node. The pixels are read tile by tile by a pool of threads, each
+with its own RawPixelsStore, and written directly to the Zarr chunks.
+"""
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+from biohack_utils.ConfigSchema import CollectionNode, _resolve_source
+from biohack_utils.config_utils import download, flatten
+from biohack_utils.util import _NUMPY_TYPES
+
+
+OME_ZARR_VERSION = "0.5"
+
+
+class _PixelReaders:
+    """One RawPixelsStore per reader thread and pixels, a store must not be used concurrently."""
+    def __init__(self, conn):
+        self._conn = conn
+        self._local = threading.local()
+        self._stores = []
+        self._lock = threading.Lock()
+
+    def read(self, pixels_id, omero_level, dtype, z, c, t, x, y, width, height):
+        stores = getattr(self._local, "stores", None)
+        if stores is None:
+            stores = self._local.stores = {}
+        store = stores.get((pixels_id, omero_level))
+        if store is None:
+            store = self._conn.createRawPixelsStore()
+            store.setPixelsId(pixels_id, True, self._conn.SERVICE_OPTS)
+            store.setResolutionLevel(omero_level)
+            stores[(pixels_id, omero_level)] = store
+            with self._lock:
+                self._stores.append(store)
+        data = store.getTile(z, c, t, x, y, width, height, self._conn.SERVICE_OPTS)
+        return np.frombuffer(data, dtype=dtype.newbyteorder(">")).reshape(height, width)
+
+    def close(self):
+        with self._lock:
+            for store in self._stores:
+                store.close()
+            self._stores.clear()
+        self._local = threading.local()
+
+
+def _level_shapes(conn, image):
+    """(Y, X) shapes of the resolution levels of an image, full resolution first,
+    and the number of levels as counted by OMERO.
+    """
+    store = conn.createRawPixelsStore()
+    try:
+        store.setPixelsId(image.getPrimaryPixels().getId(), True, conn.SERVICE_OPTS)
+        n_levels = store.getResolutionLevels()
+        if n_levels == 1:
+            return [(image.getSizeY(), image.getSizeX())], n_levels
+        return [(d.sizeY, d.sizeX) for d in store.getResolutionDescriptions()], n_levels
+    finally:
+        store.close()
+
+
+def _node_paths(records):
+    """Relative path of the image group of every record in the exported tree.
+
+    Label nodes go to the `labels/` group of their source image if it is part of
+    the collection, and to the top-level `labels/` group otherwise. Sources are
+    resolved like in `OMECollection.collection_errors`: as a path, then as the name
+    of a sibling, then as the name of the only node with this name.
+    """
+    parents, siblings, names = {}, {}, {}
+    for record in records:
+        path = record["path"]
+        parent = path.rsplit("/", 1)[0] if "/" in path else ""
+        parents[path] = parent
+        siblings[(parent, record["name"])] = path
+        names.setdefault(record["name"], []).append(path)
+
+    paths = {}
+    for record in records:
+        if record.get("category") != "annotations":
+            paths[record["path"]] = record["path"]
+    images = set(paths)
+    used = set(paths.values())
+    for record in records:
+        if record.get("category") != "annotations":
+            continue
+        source = record.get("source")
+        source = source[0] if isinstance(source, list) and source else source
+        resolved = None
+        if source:
+            resolved, _ = _resolve_source(source, parents[record["path"]], parents, siblings, names)
+        label_path = f"{paths[resolved]}/labels/{record['name']}" if resolved in images else None
+        # Two labels of the same name and source fall back to their own top-level group.
+        if label_path is None or label_path in used:
+            label_path = f"labels/{record['path']}"
+        paths[record["path"]] = label_path
+        used.add(label_path)
+    return paths
+
+
+def _collection_document(wrapper, paths):
+    """The RFC-8 collection metadata, with the relative path of every multiscale node."""
+    def convert(nodes, prefix=""):
+        converted = []
+        for node in nodes:
+            path = f"{prefix}/{node.name}" if prefix else node.name
+            data = {"name": node.name, "type": node.type}
+            if isinstance(node, CollectionNode):
+                data["nodes"] = convert(node.nodes, path)
+            else:
+                data["path"] = f"./{paths[path]}"
+                data["attributes"] = node.attributes.model_dump(by_alias=True, exclude_none=True)
+            converted.append(data)
+        return converted
+
+    return {
+        "version": wrapper.ome.version,
+        "type": "collection",
+        "name": wrapper.ome.name,
+        "nodes": convert(wrapper.ome.nodes),
+        "attributes": {},
+    }
+
+
+def _create_image_group(root, path, image, level_shapes, chunk_size, is_label):
+    """Create the OME-Zarr image group of a node. Returns its arrays, the kept axes and the dtype."""
+    sizes = {"t": image.getSizeT(), "c": image.getSizeC(), "z": image.getSizeZ()}
+    # Singleton t, c and z axes are dropped, labels never have a channel axis.
+    axes = [ax for ax in "tcz" if sizes[ax] > 1 and not (is_label and ax == "c")] + ["y", "x"]
+    dtype = np.dtype(_NUMPY_TYPES[image.getPrimaryPixels().getPixelsType().getValue()])
+
+    group = root.require_group(path)
+    arrays, datasets = [], []
+    full_y, full_x = level_shapes[0]
+    for level, (size_y, size_x) in enumerate(level_shapes):
+        shape = tuple(sizes[ax] for ax in axes[:-2]) + (size_y, size_x)
+        chunks = (1,) * (len(axes) - 2) + (min(chunk_size[0], size_y), min(chunk_size[1], size_x))
+        arrays.append(group.create_array(
+            str(level), shape=shape, chunks=chunks, dtype=dtype, fill_value=0, dimension_names=axes,
+        ))
+        scale = [1.0] * (len(axes) - 2) + [full_y / size_y, full_x / size_x]
+        datasets.append({"path": str(level), "coordinateTransformations": [{"type": "scale", "scale": scale}]})
+
+    ome = {
+        "version": OME_ZARR_VERSION,
+        "multiscales": [{
+            "name": image.getName(),
+            "axes": [{"name": ax, "type": {"t": "time", "c": "channel"}.get(ax, "space")} for ax in axes],
+            "datasets": datasets,
+        }],
+    }
+    if is_label:
+        ome["image-label"] = {"source": {"image": "../../"}}
+    group.attrs["ome"] = ome
+    return arrays, axes, dtype
+
+
+def _tile_tasks(image, arrays, axes, n_levels, chunk_size):
+    """Yield (array, index, omero_level, z, c, t, x, y, width, height) for every chunk of a node."""
+    sizes = {"t": image.getSizeT(), "c": image.getSizeC(), "z": image.getSizeZ()}
+    lead = axes[:-2]
+    for level, array in enumerate(arrays):
+        size_y, size_x = array.shape[-2:]
+        ranges = [range(sizes[ax]) for ax in "tcz"]
+        if "c" not in axes:
+            ranges[1] = range(1)
+        for t in ranges[0]:
+            for c in ranges[1]:
+                for z in ranges[2]:
+                    coords = {"t": t, "c": c, "z": z}
+                    index = tuple(coords[ax] for ax in lead)
+                    for y in range(0, size_y, chunk_size[0]):
+                        for x in range(0, size_x, chunk_size[1]):
+                            height, width = min(chunk_size[0], size_y - y), min(chunk_size[1], size_x - x)
+                            yield array, index, n_levels - 1 - level, z, c, t, x, y, width, height
+
+
+def export_collection(conn, collection_id, out_path, n_readers=8, chunk_size=(1024, 1024), max_pending=None):
+    """Export a collection and the pixels of all its images to an OME-Zarr collection.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        collection_id: The ID of the collection annotation.
+        out_path: Path of the OME-Zarr collection that is created.
+        n_readers: Number of threads reading tiles from the server in parallel.
+        chunk_size: (Y, X) shape of the Zarr chunks, which is also the size of the requested tiles.
+        max_pending: Maximal number of tiles read but not yet written, bounding the memory.
+            Defaults to four per reader.
+    Returns:
+        The RFC-8 collection document written to the root `zarr.json`.
+    """
+    import zarr
+
+    wrapper = download(conn, collection_id)
+    records = flatten(wrapper)
+    paths = _node_paths(records)
+    max_pending = 4 * n_readers if max_pending is None else max_pending
+
+    root = zarr.open_group(out_path, mode="w", zarr_format=3)
+    labels = {}
+    readers = _PixelReaders(conn)
+    n_bytes, start = 0, time.perf_counter()
+
+    def copy_tile(pixels_id, dtype, array, index, omero_level, z, c, t, x, y, width, height):
+        tile = readers.read(pixels_id, omero_level, dtype, z, c, t, x, y, width, height)
+        array[index + (slice(y, y + height), slice(x, x + width))] = tile
+        return tile.nbytes
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_readers) as pool:
+            for record in records:
+                image = conn.getObject("Image", record["omero:image_id"])
+                if image is None:
+                    raise ValueError(f"Image {record['omero:image_id']} of node '{record['path']}' not found")
+                is_label = record.get("category") == "annotations"
+                level_shapes, n_levels = _level_shapes(conn, image)
+                arrays, axes, dtype = _create_image_group(
+                    root, paths[record["path"]], image, level_shapes, chunk_size, is_label
+                )
+                pixels_id = image.getPrimaryPixels().getId()
+                if is_label:
+                    parent, name = os.path.split(paths[record["path"]])
+                    labels.setdefault(parent, []).append(name)
+
+                pending = set()
+                for task in _tile_tasks(image, arrays, axes, n_levels, chunk_size):
+                    if len(pending) >= max_pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        n_bytes += sum(future.result() for future in done)
+                    pending.add(pool.submit(copy_tile, pixels_id, dtype, *task))
+                n_bytes += sum(future.result() for future in wait(pending).done)
+                # The stores of this image are not needed anymore.
+                readers.close()
+                print(f"Exported node '{record['path']}' (image {image.getId()}) to {paths[record['path']]}")
+    finally:
+        readers.close()
+
+    for parent, names in labels.items():
+        root.require_group(parent).attrs["ome"] = {"version": OME_ZARR_VERSION, "labels": names}
+
+    document = _collection_document(wrapper, paths)
+    root.attrs["ome"] = document
+    elapsed = time.perf_counter() - start
+    print(
+        f"Exported collection {collection_id} with {len(records)} nodes to {out_path}: "
+        f"{n_bytes / 1e6:.1f} MB in {elapsed:.1f}s ({n_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s)"
+    )
+    return document
@@ -0,0 +1,163 @@
+"""Import of a local OME-Zarr collection (RFC-8) into OMERO.
+
+The collection `zarr.json` is parsed, every referenced multiscale image is
+uploaded tile by tile from its full resolution level, several images in
+parallel over joined sessions, and the collection is then registered with
+the uploaded image IDs filled in. Only a bounded number of tiles per upload
+is held in memory, independent of the size of the collection.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from biohack_utils.ConfigSchema import CollectionNode, MultiscaleNode, NodeAttributes, OMECollection, OMEWrapper
+from biohack_utils.config_utils import upload
+from biohack_utils.pipeline import SessionPool
+from biohack_utils.util import _upload_volume_tiled
+
+
+class _ChannelZView:
+    """Lazy (C, Z, Y, X) view of a zarr array with OME-Zarr axes."""
+    def __init__(self, array, axes):
+        self._array = array
+        self._axes = axes
+        sizes = dict(zip(axes, array.shape))
+        if sizes.get("t", 1) != 1:
+            raise ValueError(f"Images with a time axis are not supported, got axes {axes}")
+        self.shape = (sizes.get("c", 1), sizes.get("z", 1), sizes["y"], sizes["x"])
+        self.dtype = array.dtype
+
+    def __getitem__(self, key):
+        c, z, y, x = key
+        index = {"t": 0, "c": c, "z": z, "y": y, "x": x}
+        return self._array[tuple(index[ax] for ax in self._axes)]
+
+
+def _open_multiscale(root, path):
+    """Lazy (C, Z, Y, X) view of the full resolution level of the image group at `path`."""
+    group = root[path]
+    multiscale = group.attrs["ome"]["multiscales"][0]
+    axes = [axis["name"] if isinstance(axis, dict) else axis for axis in multiscale["axes"]]
+    is_label = "image-label" in group.attrs["ome"]
+    return _ChannelZView(group[multiscale["datasets"][0]["path"]], axes), is_label
+
+
+def _iter_multiscale_nodes(nodes, prefix=""):
+    """Yield (tree path, node) for the multiscale nodes of an RFC-8 node list."""
+    for node in nodes:
+        tree_path = f"{prefix}/{node['name']}" if prefix else node["name"]
+        if node.get("type") == "collection":
+            yield from _iter_multiscale_nodes(node.get("nodes", []), tree_path)
+        else:
+            yield tree_path, node
+
+
+def _category(node, is_label):
+    """Category of a node, nodes without one are classified by their `ome-iviewer:voxelType`
+    attribute or by being an OME-Zarr label image.
+    """
+    attrs = node.get("attributes", {})
+    if "category" in attrs:
+        return attrs["category"]
+    is_label = is_label or attrs.get("ome-iviewer:voxelType") == "labels"
+    return "annotations" if is_label else "intensities"
+
+
+def _node_attributes(node, category, group_path, intensity_nodes):
+    """NodeAttributes kwargs of a node without the image ID.
+
+    Derived nodes without a source get the intensity node they are nested in,
+    or else the first intensity node of the collection.
+    """
+    attrs = dict(node.get("attributes", {}))
+    attrs.pop("omero:image_id", None)
+    attrs["category"] = category
+    if "origin" not in attrs:
+        attrs["origin"] = "masks" if category == "annotations" else "raw"
+    if attrs["origin"] != "raw" and "source" not in attrs:
+        nested = [(path, name) for path, name in intensity_nodes if group_path.startswith(path + "/")]
+        if nested:
+            attrs["source"] = max(nested, key=lambda item: len(item[0]))[1]
+        elif intensity_nodes:
+            attrs["source"] = intensity_nodes[0][1]
+        else:
+            raise ValueError(f"No source found for the node '{node['name']}'")
+    # Nested attributes are stored as JSON by `config_utils._node_kv`.
+    return attrs
+
+
+def _build_wrapper(ome, image_ids, node_attributes):
+    """Rebuild the collection tree with the uploaded image IDs as OMEWrapper."""
+    def convert(nodes, prefix=""):
+        converted = []
+        for node in nodes:
+            tree_path = f"{prefix}/{node['name']}" if prefix else node["name"]
+            if node.get("type") == "collection":
+                converted.append(CollectionNode(name=node["name"], nodes=convert(node.get("nodes", []), tree_path)))
+            else:
+                attrs = dict(node_attributes[tree_path], **{"omero:image_id": image_ids[tree_path]})
+                converted.append(MultiscaleNode(name=node["name"], attributes=NodeAttributes(**attrs)))
+        return converted
+
+    return OMEWrapper(ome=OMECollection(
+        version=ome.get("version", "0.x"), name=ome["name"], nodes=convert(ome["nodes"])
+    ))
+
+
+def import_collection(
+    conn, path, dataset_id=None, n_uploads=4, max_tiles=16, session_factory=None, batch_size=1000,
+):
+    """Upload the images of a local OME-Zarr collection and register the collection in OMERO.
+
+    Args:
+        conn: BlitzGateway connection to omero.web.
+        path: Path to the OME-Zarr collection, its root `zarr.json` holds the RFC-8 `ome.nodes`.
+        dataset_id: Dataset the images are added to.
+        n_uploads: Number of images uploaded in parallel, each over its own joined session.
+        max_tiles: Maximal number of tiles held in memory per upload.
+        session_factory: Function creating a new gateway from `conn`. Defaults to joining its session.
+        batch_size: Number of nodes saved per call when registering the collection.
+    Returns:
+        The ID of the collection annotation.
+    """
+    import zarr
+
+    root = zarr.open_group(path, mode="r")
+    ome = root.attrs["ome"]
+    if ome.get("type") != "collection":
+        raise ValueError(f"{path} is not an OME-Zarr collection")
+
+    nodes = list(_iter_multiscale_nodes(ome["nodes"]))
+    group_paths = {tree_path: os.path.normpath(node["path"]) for tree_path, node in nodes}
+    views = {tree_path: _open_multiscale(root, group_paths[tree_path]) for tree_path, _ in nodes}
+
+    categories = {tree_path: _category(node, views[tree_path][1]) for tree_path, node in nodes}
+    intensity_nodes = [
+        (group_paths[tree_path], node["name"]) for tree_path, node in nodes
+        if categories[tree_path] == "intensities"
+    ]
+    node_attributes = {
+        tree_path: _node_attributes(node, categories[tree_path], group_paths[tree_path], intensity_nodes)
+        for tree_path, node in nodes
+    }
+    # Validate the collection before transferring any pixels.
+    _build_wrapper(ome, {tree_path: 0 for tree_path, _ in nodes}, node_attributes).ome.validate_collection()
+
+    with SessionPool(conn, n_uploads, factory=session_factory) as pool:
+
+        def upload_node(tree_path):
+            with pool.session() as session:
+                dataset = None if dataset_id is None else session.getObject("Dataset", dataset_id)
+                image_id = _upload_volume_tiled(
+                    session, views[tree_path][0], tree_path.replace("/", "_"), max_tiles=max_tiles, dataset=dataset,
+                )
+            print(f"Uploaded node '{tree_path}' from {group_paths[tree_path]} as image {image_id}")
+            return image_id
+
+        with ThreadPoolExecutor(max_workers=n_uploads) as executor:
+            tree_paths = [tree_path for tree_path, _ in nodes]
+            image_ids = dict(zip(tree_paths, executor.map(upload_node, tree_paths)))
+
+    wrapper = _build_wrapper(ome, image_ids, node_attributes)
+    coll_id = upload(conn, wrapper, bulk=True, batch_size=batch_size)
+    print(f"Imported collection '{ome['name']}' with {len(nodes)} images as collection {coll_id}")
+    return coll_id
@@ -0,0 +1,133 @@
+import argparse
+import contextlib
+import io
+import json
+import time
+
+from biohack_utils.ConfigSchema import MultiscaleNode, NodeAttributes, OMECollection, OMEWrapper
+from biohack_utils.config_utils import download, flatten, sync, unflatten, upload
+from biohack_utils.delete_annotations import delete_annotations, delete_collections
+from biohack_utils.delete_stuff import _delete_anns, _delete_ims
+from biohack_utils.fake_gateway import FakeGateway
+from biohack_utils.mirror import CollectionMirror
+from biohack_utils.provenance import ProvenanceGraph
+from biohack_utils.omero_annotation import (
+    NS_COLLECTION, NS_NODE, _find_images_with_collection_id_in_dataset, _get_collections, get_node_infos,
+)
+
+
+def _make_collection(conn, n_nodes, dataset_id):
+    """Create `n_nodes` images and a collection of one raw image and its derived masks."""
+    image_ids = [conn.add_image(f"image_{i}", dataset_id) for i in range(n_nodes)]
+    nodes = [MultiscaleNode(
+        name="raw", attributes=NodeAttributes(**{"omero:image_id": image_ids[0], "category": "intensities", "origin": "raw"})
+    )]
+    for i, image_id in enumerate(image_ids[1:]):
+        attrs = {"omero:image_id": image_id, "category": "annotations", "origin": "masks", "source": "raw"}
+        nodes.append(MultiscaleNode(name=f"mask_{i}", attributes=NodeAttributes(**attrs)))
+    return OMEWrapper(ome=OMECollection(name="benchmark", nodes=nodes)), image_ids
+
+
+def _measure(results, conn, operation, n_nodes, func, *args, **kwargs):
+    if conn is not None:
+        conn.reset_counters()
+    # The helpers print progress, which is part of the cost but not of the report.
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+    results.append({
+        "operation": operation,
+        "nodes": n_nodes,
+        "seconds": elapsed,
+        "round_trips": None if conn is None else conn.round_trips,
+        "calls": None if conn is None else dict(conn.calls),
+    })
+    print(
+        f"{operation:<55} {n_nodes:>8} {elapsed:>10.3f}s "
+        f"{'-' if conn is None else conn.round_trips:>10}"
+    )
+    return out
+
+
+def run_benchmark(n_nodes, latency=0.0, legacy=True):
+    """Run all benchmarked operations for a collection of `n_nodes` nodes."""
+    results = []
+
+    conn = FakeGateway(latency=latency)
+    dataset_id = conn.add_dataset()
+    wrapper, image_ids = _make_collection(conn, n_nodes, dataset_id)
+
+    flat = _measure(results, None, "flatten", n_nodes, flatten, wrapper)
+    _measure(results, None, "unflatten", n_nodes, unflatten, flat, "benchmark")
+
+    if legacy:
+        legacy_conn = FakeGateway(latency=latency)
+        legacy_dataset = legacy_conn.add_dataset()
+        legacy_wrapper, _ = _make_collection(legacy_conn, n_nodes, legacy_dataset)
+        _measure(results, legacy_conn, "upload", n_nodes, upload, legacy_conn, legacy_wrapper)
+
+    coll_id = _measure(results, conn, "upload(bulk=True)", n_nodes, upload, conn, wrapper, bulk=True)
+    _measure(results, conn, "download", n_nodes, download, conn, coll_id)
+    _measure(results, conn, "sync(unchanged)", n_nodes, sync, conn, wrapper, coll_id)
+    _measure(results, conn, "_get_collections", n_nodes, _get_collections, conn, image_ids[0])
+    _measure(results, conn, "get_node_infos", n_nodes, get_node_infos, conn, image_ids)
+    mirror = CollectionMirror()
+    _measure(results, conn, "CollectionMirror.sync", n_nodes, mirror.sync, conn)
+    _measure(
+        results, conn, "_get_collections(mirror)", n_nodes, _get_collections, conn, image_ids[0], mirror=mirror,
+    )
+    graph = _measure(results, conn, "ProvenanceGraph.from_server", n_nodes, ProvenanceGraph.from_server, conn)
+    _measure(
+        results, None, "ProvenanceGraph.descendants(masks)", n_nodes,
+        graph.descendants, image_ids[0], category="annotations",
+    )
+    _measure(
+        results, conn, "_find_images_with_collection_id_in_dataset", n_nodes,
+        _find_images_with_collection_id_in_dataset, conn, coll_id, dataset_id,
+    )
+    _measure(
+        results, conn, "_find_images_with_collection_id_in_dataset(masks)", n_nodes,
+        _find_images_with_collection_id_in_dataset, conn, coll_id, dataset_id, node_type="annotations", limit=100,
+    )
+    _measure(results, conn, "delete_annotations", n_nodes, delete_annotations, conn, image_ids[-1], NS_NODE)
+    _measure(results, conn, "_delete_anns", n_nodes, _delete_anns, conn, image_ids[-2], NS_COLLECTION)
+    _measure(results, conn, "_delete_ims", n_nodes, _delete_ims, conn, image_ids[-3])
+    # Deletes the collection, so it runs last.
+    _measure(
+        results, conn, "delete_collections(dry_run=True)", n_nodes,
+        delete_collections, conn, collection_ids=[coll_id], dry_run=True,
+    )
+    _measure(
+        results, conn, "delete_collections(delete_images=True)", n_nodes,
+        delete_collections, conn, collection_ids=[coll_id], delete_images=True,
+    )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark biohack_utils against an in-memory OMERO gateway, "
+                    "reporting wall time and server round trips per operation."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000],
+                        help="Number of nodes in the benchmarked collection.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Latency in seconds added to every server call.")
+    parser.add_argument("--skip_legacy", action="store_true",
+                        help="Skip the per-node upload, which is slow for large sizes with latency.")
+    parser.add_argument("--json", type=str, default=None, help="Write the results to this JSON file.")
+    args = parser.parse_args()
+
+    print(f"{'operation':<55} {'nodes':>8} {'wall time':>11} {'round trips':>10}")
+    results = []
+    for n_nodes in args.sizes:
+        results.extend(run_benchmark(n_nodes, latency=args.latency, legacy=not args.skip_legacy))
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
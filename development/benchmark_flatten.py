@@ -0,0 +1,75 @@
+import argparse
+import contextlib
+import gc
+import io
+import time
+
+from biohack_utils.config_utils import flatten, unflatten
+
+
+def _make_records(n_nodes):
+    """Flat records of an HCS-like collection: plate/row/column/field with a raw image and a mask per field."""
+    records = []
+    for i in range(n_nodes // 2):
+        row, col, field = chr(ord("A") + i // 2400 % 16), i // 100 % 24 + 1, i % 100
+        prefix = f"plate_{i // 38400}/{row}/{col}/{field}"
+        records.append({
+            "name": "raw", "path": f"{prefix}/raw",
+            "omero:image_id": 2 * i + 1, "category": "intensities", "origin": "raw",
+        })
+        records.append({
+            "name": "nuclei", "path": f"{prefix}/nuclei",
+            "omero:image_id": 2 * i + 2, "category": "annotations", "origin": "masks", "source": "raw",
+            "description": "Nuclei segmentation",
+        })
+    return records
+
+
+def _time(func, *args, repeat=3, **kwargs):
+    best, out = None, None
+    for _ in range(repeat):
+        out = None
+        gc.collect()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            out = func(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark flatten and unflatten with and without the fast path on HCS-like collections."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000],
+                        help="Number of nodes in the benchmarked collection.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per measurement, the best is reported.")
+    parser.add_argument("--skip_default", action="store_true",
+                        help="Only measure the fast path, e.g. for large sizes.")
+    args = parser.parse_args()
+
+    print(f"{'operation':<25} {'nodes':>8} {'default':>10} {'fast':>10} {'speedup':>8} identical")
+    for n_nodes in args.sizes:
+        records = _make_records(n_nodes)
+        fast_time, fast_wrapper = _time(unflatten, records, "hcs", fast=True, repeat=args.repeat)
+        fast_flat_time, fast_flat = _time(flatten, fast_wrapper, fast=True, repeat=args.repeat)
+        if args.skip_default:
+            print(f"{'unflatten':<25} {n_nodes:>8} {'-':>10} {fast_time:>9.3f}s")
+            print(f"{'flatten':<25} {n_nodes:>8} {'-':>10} {fast_flat_time:>9.3f}s")
+            continue
+
+        default_time, wrapper = _time(unflatten, records, "hcs", repeat=args.repeat)
+        print(
+            f"{'unflatten':<25} {n_nodes:>8} {default_time:>9.3f}s {fast_time:>9.3f}s "
+            f"{default_time / fast_time:>7.1f}x {wrapper == fast_wrapper}"
+        )
+        default_flat_time, flat = _time(flatten, wrapper, repeat=args.repeat)
+        print(
+            f"{'flatten':<25} {n_nodes:>8} {default_flat_time:>9.3f}s {fast_flat_time:>9.3f}s "
+            f"{default_flat_time / fast_flat_time:>7.1f}x {flat == fast_flat}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+from biohack_utils.segmentation_compare import compare_segmentations
+from biohack_utils.util import connect_to_omero, omero_credential_parser
+
+
+def main():
+    parser = omero_credential_parser()
+    parser.add_argument("--collection_id", type=int, required=True, help="ID of the collection annotation.")
+    parser.add_argument(
+        "--reference", type=str, required=True,
+        help="Name or path of the reference node: an image whose masks are compared, or a mask."
+    )
+    parser.add_argument("--iou_threshold", type=float, default=0.5, help="Minimal IoU of two matched objects.")
+    parser.add_argument("--n_workers", type=int, default=None, help="Number of pairs compared in parallel.")
+    args = parser.parse_args()
+
+    conn = connect_to_omero(args)
+    compare_segmentations(
+        conn, args.collection_id, args.reference, iou_threshold=args.iou_threshold, n_workers=args.n_workers,
+    )
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
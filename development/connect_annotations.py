@@ -48,10 +48,10 @@ def write_annotations_to_image_and_labels(conn, image_id, label_id):
     omero_annotation._add_node_annotation(conn, label_id, "Labels", ann_id, "Cell_Segmentation")
 
     # Finally, let's build a pseudo-network by linking all links.
+    # Every node links to all images of the collection, the links are written in a single call.
     all_image_ids = image_id + [label_id]
-    for iid in all_image_ids:
-        link = omero_annotation._build_image_url(iid)
-        omero_annotation._append_link_to_node_annotation(conn, iid, link)
+    links = [omero_annotation._build_image_url(iid) for iid in all_image_ids]
+    omero_annotation._append_links_to_node_annotations(conn, {iid: links for iid in all_image_ids}, ann_id)
 
 
 def main():
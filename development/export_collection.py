@@ -0,0 +1,18 @@
+from biohack_utils.util import connect_to_omero, omero_credential_parser
+from biohack_utils.zarr_export import export_collection
+
+
+def main():
+    parser = omero_credential_parser()
+    parser.add_argument("--collection_id", type=int, required=True, help="ID of the collection annotation.")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Path of the exported OME-Zarr collection.")
+    parser.add_argument("--n_readers", type=int, default=8, help="Number of parallel tile readers.")
+    args = parser.parse_args()
+
+    conn = connect_to_omero(args)
+    export_collection(conn, args.collection_id, args.output, n_readers=args.n_readers)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
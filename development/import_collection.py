@@ -0,0 +1,24 @@
+from biohack_utils.util import connect_to_omero, omero_credential_parser
+from biohack_utils.zarr_import import import_collection
+
+
+def main():
+    parser = omero_credential_parser()
+    parser.add_argument("-i", "--input", type=str, required=True, help="Path to the OME-Zarr collection.")
+    parser.add_argument("--dataset_id", type=int, default=None, help="Dataset the images are added to.")
+    parser.add_argument("--n_uploads", type=int, default=4, help="Number of images uploaded in parallel.")
+    parser.add_argument(
+        "--max_tiles", type=int, default=16, help="Maximal number of tiles held in memory per upload."
+    )
+    args = parser.parse_args()
+
+    conn = connect_to_omero(args)
+    coll_id = import_collection(
+        conn, args.input, dataset_id=args.dataset_id, n_uploads=args.n_uploads, max_tiles=args.max_tiles,
+    )
+    print(f"Created collection with ID: {coll_id}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
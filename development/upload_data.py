@@ -3,21 +3,36 @@ import imageio.v3 as imageio
 
 from skimage.measure import label
 
-from biohack_utils.util import connect_to_omero, _upload_image, _upload_volume
+from biohack_utils.labeling import _smallest_label_dtype, label_blockwise
+from biohack_utils.util import connect_to_omero, _upload_image, _upload_volume, _upload_volume_tiled
 
 
-def upload_data(conn, fpath, name, labels=False):
+def upload_data(conn, fpath, name, labels=False, stream=False, max_tiles=16):
     """Upload image or label data.
 
     Args:
         conn: BlitzGateway conection to omero.web.
         fpath: File path to data.
         name: Name for uploaded data.
-        labels: Specify uploaded data as labels to set data type to uint16.
+        labels: Specify uploaded data as labels. Their connected components are labelled
+            and stored with the smallest data type that holds all labels.
+        stream: Read the data lazily and upload it tile by tile, for data larger than memory.
+            Labels are then labelled blockwise out-of-core.
+        max_tiles: Maximal number of tiles held in memory when streaming.
     """
+    if stream:
+        if labels:
+            with label_blockwise(fpath) as volume:
+                img_id = _upload_volume_tiled(conn, volume, name, max_tiles=max_tiles)
+        else:
+            img_id = _upload_volume_tiled(conn, fpath, name, max_tiles=max_tiles)
+        print(f"Created image with ID: {img_id}")
+        return
+
     arr = imageio.imread(fpath)
     if labels:
-        arr = label(arr).astype("uint16")
+        arr = label(arr)
+        arr = arr.astype(_smallest_label_dtype(arr.max()))
 
     if len(arr.shape) == 2:
         img_id = _upload_image(conn, arr, name)
@@ -46,11 +61,19 @@ def main():
         "--label", action="store_true",
         help="Specify that the uploaded data is a label. Default: Image data."
     )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="Read the data lazily (TIFF or Zarr) and upload it tile by tile."
+    )
+    parser.add_argument(
+        "--max_tiles", type=int, default=16,
+        help="Maximal number of tiles held in memory when streaming."
+    )
 
     args = parser.parse_args()
 
     conn = connect_to_omero(args)
-    upload_data(conn, args.input, args.name, args.label)
+    upload_data(conn, args.input, args.name, args.label, args.stream, args.max_tiles)
 
     conn.close()
 
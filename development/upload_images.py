@@ -1,6 +1,7 @@
 import imageio.v3 as imageio
 from skimage.measure import label
 
+from biohack_utils.labeling import _smallest_label_dtype
 from biohack_utils.util import omero_credential_parser, connect_to_omero
 
 
@@ -9,8 +10,9 @@ def upload_3d_images(conn):
     image = imageio.imread("/home/anwai/data/M_LR_000167_R_crop_1137-0669-1044.tif")
     labels = imageio.imread("/home/anwai/data/M_LR_000167_R_crop_1137-0669-1044_annotations.tif")
 
-    # Run connected components and reduce precision
-    labels = label(labels).astype("uint16")
+    # Run connected components and reduce precision as far as the number of labels allows
+    labels = label(labels)
+    labels = labels.astype(_smallest_label_dtype(labels.max()))
 
     def _upload_volume(curr, iname):
         # Upload the image and corresponding labels
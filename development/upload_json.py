@@ -0,0 +1,22 @@
+from biohack_utils.json_ingest import upload_json
+from biohack_utils.util import connect_to_omero, omero_credential_parser
+
+
+def main():
+    parser = omero_credential_parser()
+    parser.add_argument("-i", "--input", type=str, required=True, help="Path to the JSON collection document.")
+    parser.add_argument("--batch_size", type=int, default=1000, help="Number of nodes saved per call.")
+    parser.add_argument(
+        "--skip_validation", action="store_true",
+        help="Do not validate the whole collection in a first pass, which keeps the memory bounded by one batch.",
+    )
+    args = parser.parse_args()
+
+    conn = connect_to_omero(args)
+    coll_id = upload_json(conn, args.input, batch_size=args.batch_size, validate=not args.skip_validation)
+    print(f"Created collection with ID: {coll_id}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
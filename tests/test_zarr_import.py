@@ -0,0 +1,41 @@
+import contextlib
+import io
+
+import pytest
+
+pytest.importorskip("omero")
+
+from biohack_utils.config_utils import download, flatten, upload  # noqa: E402
+from biohack_utils.fake_gateway import FakeGateway  # noqa: E402
+from biohack_utils.zarr_import import _build_wrapper, _node_attributes  # noqa: E402
+
+
+def test_nested_attributes_round_trip():
+    """Nested attributes of an imported collection are downloaded unchanged."""
+    conn = FakeGateway()
+    voxel_size = {"unit": "micrometer", "z": 1.0, "y": 0.5, "x": 0.5}
+    ome = {
+        "version": "0.x",
+        "name": "imported",
+        "nodes": [
+            {"name": "raw", "type": "multiscale", "path": "./raw",
+             "attributes": {"voxel_size": voxel_size}},
+            {"name": "cells", "type": "multiscale", "path": "./raw/labels/cells",
+             "attributes": {"voxel_size": voxel_size}},
+        ],
+    }
+    intensity_nodes = [("raw", "raw")]
+    node_attributes = {
+        "raw": _node_attributes(ome["nodes"][0], "intensities", "raw", intensity_nodes),
+        "cells": _node_attributes(ome["nodes"][1], "annotations", "raw/labels/cells", intensity_nodes),
+    }
+    image_ids = {"raw": conn.add_image("raw"), "cells": conn.add_image("cells")}
+    wrapper = _build_wrapper(ome, image_ids, node_attributes)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        coll_id = upload(conn, wrapper, bulk=True)
+        records = {record["path"]: record for record in flatten(download(conn, coll_id))}
+
+    assert records["raw"]["voxel_size"] == voxel_size
+    assert records["cells"]["voxel_size"] == voxel_size
+    assert records["cells"]["source"] == "raw"